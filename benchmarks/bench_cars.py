@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of CARS extractions
+"""
+
+import os
+
+import numpy as np
+
+from oceansdb import CARS
+
+from . import fixtures
+from .bench_woa import track
+
+
+class CARSExtract(object):
+    """ Harmonics evaluated on request, or precomputed on 12 months
+    """
+    params = [None, 12]
+    param_names = ['precompute']
+    timeout = 1200
+
+    def setup_cache(self):
+        return fixtures.prepare(os.path.abspath('oceansdb'), woa=[],
+                                cars=True, etopo=[])
+
+    def setup(self, path, precompute):
+        os.environ['OCEANSDB_DIR'] = path
+        self.db = CARS(precompute=precompute)
+        self.var = self.db['sea_water_temperature']
+        self.track = track(1000)
+
+    def teardown(self, path, precompute):
+        self.db.close()
+
+    def time_point(self, path, precompute):
+        self.var.extract(doy=136.875, depth=10.2, lat=17.3, lon=322.8)
+
+    def time_profile(self, path, precompute):
+        self.var.extract(doy=136.875, lat=17.3, lon=322.8)
+
+    def time_profile_fast(self, path, precompute):
+        self.var.profile(doy=136.875, lat=17.3, lon=322.8)
+
+    def time_many_days(self, path, precompute):
+        self.var.extract(doy=np.arange(1, 366, 5), depth=[0, 100], lat=17.3,
+                         lon=322.8)
+
+    def time_track(self, path, precompute):
+        self.var.track(**self.track)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of the grid indexing and of locating the data files
+"""
+
+import os
+
+import numpy as np
+
+from oceansdb.common import GridAxis, cropIndices
+from oceansdb.utils import dbsource
+
+from . import fixtures
+
+
+class CropIndices(object):
+    """ Crop on the WOA 0.25 degree grid, from arrays or GridAxis
+    """
+    params = [False, True]
+    param_names = ['axes']
+
+    def setup(self, axes):
+        lat, lon = fixtures.grid(0.25)
+        self.dims = {'lat': lat, 'lon': lon, 'depth': fixtures.WOA_DEPTH,
+                     'time': 365.25 / 12 * np.array([1.5, 4.5, 7.5, 10.5])}
+        if axes:
+            self.dims = dict((d, GridAxis(self.dims[d], period=p)) for d, p
+                             in (('lat', None), ('lon', 360),
+                                 ('depth', None), ('time', 365.25)))
+
+    def time_point(self, axes):
+        cropIndices(self.dims, np.array([17.3]), np.array([-37.2]),
+                    np.array([10.2]), np.array([136.875]))
+
+    def time_dateline(self, axes):
+        cropIndices(self.dims, np.array([-10, 10.]), np.array([170, 190.]),
+                    np.array([0, 5000.]), np.array([360, 370.]))
+
+
+class DBSource(object):
+    """ Files of a database already verified, i.e. in the manifest
+    """
+    timeout = 600
+
+    def setup_cache(self):
+        return fixtures.prepare(os.path.abspath('oceansdb'), woa=['5deg'],
+                                cars=True, etopo=[])
+
+    def setup(self, path):
+        os.environ['OCEANSDB_DIR'] = path
+
+    def time_woa(self, path):
+        for nc in dbsource('WOA18', 'sea_water_temperature'):
+            nc.close()
+
+    def time_cars(self, path):
+        for nc in dbsource('CARS', 'sea_water_temperature'):
+            nc.close()
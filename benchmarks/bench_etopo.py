@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of ETOPO extractions
+"""
+
+import os
+
+import numpy as np
+
+from oceansdb import ETOPO
+
+from . import fixtures
+
+
+class ETOPOExtract(object):
+    """ Point, region and track on ETOPO5 and ETOPO1
+    """
+    params = (['5min', '1min'], [100, 100000])
+    param_names = ['resolution', 'n']
+    timeout = 1200
+
+    def setup_cache(self):
+        return fixtures.prepare(os.path.abspath('oceansdb'), woa=[],
+                                cars=False, etopo=['5min', '1min'])
+
+    def setup(self, path, resolution, n):
+        os.environ['OCEANSDB_DIR'] = path
+        self.db = ETOPO(resolution=resolution)
+        rng = np.random.RandomState(0)
+        self.lat = rng.uniform(-80, 80, n)
+        self.lon = rng.uniform(-180, 180, n)
+
+    def teardown(self, path, resolution, n):
+        self.db.close()
+
+    def time_point(self, path, resolution, n):
+        self.db['topography'].extract(lat=17.3, lon=-37.2)
+
+    def time_region(self, path, resolution, n):
+        self.db['topography'].extract(lat=np.arange(10, 12, 0.1),
+                                      lon=np.arange(-40, -38, 0.1))
+
+    def time_track(self, path, resolution, n):
+        self.db['topography'].track(lat=self.lat, lon=self.lon)
+
+    def peakmem_track(self, path, resolution, n):
+        self.db['topography'].track(lat=self.lat, lon=self.lon)
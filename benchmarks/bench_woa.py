@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of WOA extractions
+"""
+
+import os
+
+import numpy as np
+
+from oceansdb import WOA
+from oceansdb.woa import WOA_var_nc
+from oceansdb.utils import Dataset_flex
+
+from . import fixtures
+
+
+def track(n, seed=0):
+    """ A random track with n positions
+    """
+    rng = np.random.RandomState(seed)
+    return {'doy': rng.uniform(1, 366, n), 'depth': rng.uniform(0, 2000, n),
+            'lat': rng.uniform(-60, 60, n), 'lon': rng.uniform(-180, 180, n)}
+
+
+class WOAExtract(object):
+    """ Point, profile and section on the WOA18 grids of the catalog
+    """
+    params = (['5deg', '1deg'], [False, True])
+    param_names = ['resolution', 'preload']
+    timeout = 1200
+
+    def setup_cache(self):
+        return fixtures.prepare(os.path.abspath('oceansdb'),
+                                woa=['5deg', '1deg'], cars=False, etopo=[])
+
+    def setup(self, path, resolution, preload):
+        os.environ['OCEANSDB_DIR'] = path
+        self.db = WOA(resolution=resolution, preload=preload)
+        self.var = self.db['sea_water_temperature']
+        # Opening the files and the preload are not part of the timing
+        self.var.extract(doy=136.875, depth=0, lat=17.5, lon=-37.5)
+
+    def teardown(self, path, resolution, preload):
+        self.db.close()
+
+    def time_point(self, path, resolution, preload):
+        self.var.extract(doy=136.875, depth=10.2, lat=17.3, lon=-37.2)
+
+    def time_profile(self, path, resolution, preload):
+        self.var.extract(doy=136.875, lat=17.3, lon=-37.2)
+
+    def time_profile_fast(self, path, resolution, preload):
+        self.var.profile(doy=136.875, lat=17.3, lon=-37.2)
+
+    def time_section(self, path, resolution, preload):
+        self.var.extract(doy=136.875, depth=[0, 100, 500], lat=17.3,
+                         lon=np.arange(-60, -10, 0.5))
+
+    def time_nearest(self, path, resolution, preload):
+        self.var.extract(doy=136.875, depth=[0, 100, 500], lat=17.3,
+                         lon=np.arange(-60, -10, 0.5), mode='nearest')
+
+    def time_interpolate(self, path, resolution, preload):
+        self.var.interpolate(np.array([136.875]), np.array([0., 100, 500]),
+                             np.arange(10, 20, 0.5), np.arange(-40, -30, 0.5),
+                             self.var.KEYS)
+
+
+class WOATrack(object):
+    """ Vectorized track of n positions
+    """
+    params = (['5deg', '1deg'], [100, 10000])
+    param_names = ['resolution', 'n']
+    timeout = 1200
+
+    def setup_cache(self):
+        return fixtures.prepare(os.path.abspath('oceansdb'),
+                                woa=['5deg', '1deg'], cars=False, etopo=[])
+
+    def setup(self, path, resolution, n):
+        os.environ['OCEANSDB_DIR'] = path
+        self.db = WOA(resolution=resolution)
+        self.var = self.db['sea_water_temperature']
+        self.track = track(n)
+
+    def teardown(self, path, resolution, n):
+        self.db.close()
+
+    def time_track(self, path, resolution, n):
+        self.var.track(**self.track)
+
+    def time_track_nearest(self, path, resolution, n):
+        self.var.track(mode='nearest', **self.track)
+
+    def peakmem_track(self, path, resolution, n):
+        self.var.track(**self.track)
+
+
+class WOAQuarterDegree(object):
+    """ An eddy resolving grid, 0.25 degree, not in the catalog
+    """
+    timeout = 1200
+
+    def setup_cache(self):
+        path = os.path.abspath('woa_025')
+        if not os.path.exists(path):
+            os.makedirs(path)
+        filename = os.path.join(path, 'woa18_decav_t00_04.nc')
+        if not os.path.exists(filename):
+            fixtures.write_woa(filename, 't', '0.25deg', tn=0,
+                               suffixes=('mn',))
+        return filename
+
+    def setup(self, filename):
+        self.var = WOA_var_nc(source=[Dataset_flex(filename)])
+        self.track = track(1000)
+
+    def teardown(self, filename):
+        self.var.close()
+
+    def time_profile(self, filename):
+        self.var.extract(doy=136.875, lat=17.3, lon=-37.2)
+
+    def time_track(self, filename):
+        self.var.track(**self.track)
+
+    def peakmem_section(self, filename):
+        self.var.extract(doy=136.875, depth=[0, 100, 500],
+                         lat=np.arange(-60, 60, 0.25), lon=-37.2)
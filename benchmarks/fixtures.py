@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+""" Synthetic data files with the shapes of the real databases
+
+    The benchmarks don't require network access, the data files are
+    generated locally with the same names, dimensions and variables of
+    WOA18, CARS and ETOPO, with smooth fields, a land mask and a bottom.
+    Once written, they are recorded in the manifest of that directory, so
+    oceansdb uses them as if they were downloaded:
+
+        prepare('/tmp/oceansdb', woa=['5deg'], cars=True, etopo=['5min'])
+        os.environ['OCEANSDB_DIR'] = '/tmp/oceansdb'
+"""
+
+import os
+
+import numpy as np
+from numpy import ma
+from netCDF4 import Dataset
+
+from oceansdb.utils import catalog, datafile, md5sum, save_manifest
+
+
+# Standard depths of WOA18 seasonal and annual climatologies
+WOA_DEPTH = np.concatenate([
+    np.arange(0, 100, 5), np.arange(100, 500, 25), np.arange(500, 2000, 50),
+    np.arange(2000, 5501, 100)]).astype('f4')
+
+RESOLUTION = {'5deg': 5., '1deg': 1., '0.25deg': 0.25}
+
+# Middle of each season or month, as WOA time in months
+MONTH = dict([(0, 6.)] + [(m, m - 0.5) for m in range(1, 13)] +
+             [(13, 1.5), (14, 4.5), (15, 7.5), (16, 10.5)])
+
+
+def grid(step, lat0=-90, lon0=-180):
+    """ Centers of the cells of a regular grid with step degrees
+    """
+    lat = np.arange(lat0 + step / 2., 90, step)
+    lon = np.arange(lon0 + step / 2., lon0 + 360, step)
+    return lat, lon
+
+
+def field(doy, depth, lat, lon, base=20.):
+    """ A smooth field, decreasing with depth, with a seasonal cycle
+    """
+    Z, Y, X = np.meshgrid(depth, lat, lon, indexing='ij', sparse=True)
+    return base * np.exp(-Z / 800.) + 3 * np.cos(np.deg2rad(Y)) + \
+        np.sin(2 * np.deg2rad(X)) + 2 * np.cos(2 * np.pi * doy / 365.25)
+
+
+def landmask(depth, lat, lon):
+    """ Continents plus a bottom that changes with the position
+    """
+    Y, X = np.meshgrid(lat, lon, indexing='ij')
+    land = (np.sin(3 * np.deg2rad(X)) * np.cos(2 * np.deg2rad(Y)) > 0.6) | \
+        (Y > 80)
+    bottom = 3000 + 2000 * np.sin(np.deg2rad(X + Y))
+    return land[np.newaxis] | (depth[:, None, None] > bottom[np.newaxis])
+
+
+def write_woa(filename, var='t', resolution='5deg', tn=13,
+              suffixes=('mn', 'sd', 'se', 'dd')):
+    """ A WOA18 like file, one time (season tn), for var (t, s or o)
+    """
+    lat, lon = grid(RESOLUTION[resolution])
+    depth = WOA_DEPTH
+    with Dataset(filename, 'w') as nc:
+        nc.createDimension('time', 1)
+        nc.createDimension('depth', depth.size)
+        nc.createDimension('lat', lat.size)
+        nc.createDimension('lon', lon.size)
+        t = nc.createVariable('time', 'f4', ('time',))
+        t.units = 'months since 1955-01-01 00:00:00'
+        t[:] = [MONTH[tn]]
+        nc.createVariable('depth', 'f4', ('depth',))[:] = depth
+        nc.createVariable('lat', 'f4', ('lat',))[:] = lat
+        nc.createVariable('lon', 'f4', ('lon',))[:] = lon
+
+        doy = MONTH[tn] * 365.25 / 12
+        base = {'t': 20., 's': 35., 'o': 250.}[var]
+        scale = {'mn': 1, 'sd': 0.05, 'se': 0.01, 'dd': 10}
+        variables = {}
+        for s in suffixes:
+            dtype, fill = ('i4', -2147483647) if s == 'dd' else \
+                ('f4', np.float32(9.96921e36))
+            variables[s] = nc.createVariable(
+                '%s_%s' % (var, s), dtype, ('time', 'depth', 'lat', 'lon'),
+                fill_value=fill, zlib=True, complevel=1,
+                chunksizes=(1, 1, min(lat.size, 90), min(lon.size, 180)))
+        # One level at a time, to limit the memory on the finer grids
+        for k, z in enumerate(depth):
+            mask = landmask(depth[k:k + 1], lat, lon)
+            value = field(doy, depth[k:k + 1], lat, lon, base)
+            for s in suffixes:
+                v = value * scale[s]
+                if s == 'dd':
+                    v = v.astype('i4')
+                variables[s][0, k:k + 1] = ma.masked_where(mask, v)
+    return filename
+
+
+def write_cars(filename, step=0.5):
+    """ A CARS2009 like file, mean plus annual and semi-annual harmonics
+
+        Not compressed, like the original files.
+    """
+    lat = np.arange(-75, 90 + step / 2., step)
+    lon = np.arange(0, 360, step)
+    depth = np.concatenate([WOA_DEPTH[:37], np.arange(550, 2000, 50),
+                            np.arange(2000, 5501, 100)])[:79]
+    rng = np.random.RandomState(0)
+    with Dataset(filename, 'w') as nc:
+        nc.createDimension('depth', depth.size)
+        nc.createDimension('depth_ann', 64)
+        nc.createDimension('depth_semiann', 55)
+        nc.createDimension('lat', lat.size)
+        nc.createDimension('lon', lon.size)
+        nc.createVariable('depth', 'f4', ('depth',))[:] = depth
+        nc.createVariable('depth_ann', 'f4', ('depth_ann',))[:] = depth[:64]
+        nc.createVariable('depth_semiann', 'f4',
+                          ('depth_semiann',))[:] = depth[:55]
+        nc.createVariable('lat', 'f4', ('lat',))[:] = lat
+        nc.createVariable('lon', 'f4', ('lon',))[:] = lon
+
+        variables = {}
+        for name, dim in (('mean', 'depth'), ('std_dev', 'depth'),
+                          ('an_cos', 'depth_ann'), ('an_sin', 'depth_ann'),
+                          ('sa_cos', 'depth_semiann'),
+                          ('sa_sin', 'depth_semiann')):
+            variables[name] = nc.createVariable(
+                name, 'f4', (dim, 'lat', 'lon'), fill_value=np.float32(-999))
+        variables['nq'] = nc.createVariable(
+            'nq', 'i2', ('depth', 'lat', 'lon'), fill_value=np.int16(-1))
+
+        for k in range(depth.size):
+            mask = landmask(depth[k:k + 1], lat, lon)
+            value = field(0., depth[k:k + 1], lat, lon)
+            variables['mean'][k:k + 1] = ma.masked_where(mask, value)
+            variables['std_dev'][k:k + 1] = ma.masked_where(mask, 0.1 * value)
+            variables['nq'][k:k + 1] = ma.masked_where(
+                mask, (3 * value).astype('i2'))
+            for name, n in (('an_cos', 64), ('an_sin', 64), ('sa_cos', 55),
+                            ('sa_sin', 55)):
+                if k < n:
+                    variables[name][k:k + 1] = ma.masked_where(
+                        mask, rng.rand(1, lat.size, lon.size))
+    return filename
+
+
+def write_etopo(filename, resolution='5min'):
+    """ An ETOPO5 or ETOPO1 like topography, with their variable names
+    """
+    if resolution == '5min':
+        x = np.arange(0, 360, 1 / 12.)
+        y = np.arange(-90, 90, 1 / 12.)
+        xname, yname, zname, dtype = 'ETOPO05_X', 'ETOPO05_Y', 'ROSE', 'f4'
+    else:
+        x = np.linspace(-180, 180, 21601)
+        y = np.linspace(-90, 90, 10801)
+        xname, yname, zname, dtype = 'x', 'y', 'z', 'i4'
+
+    with Dataset(filename, 'w') as nc:
+        nc.createDimension(yname, y.size)
+        nc.createDimension(xname, x.size)
+        nc.createVariable(xname, 'f8', (xname,))[:] = x
+        nc.createVariable(yname, 'f8', (yname,))[:] = y
+        z = nc.createVariable(zname, dtype, (yname, xname), zlib=True,
+                              complevel=1, chunksizes=(256, 256))
+        # By blocks of rows, to limit the memory for ETOPO1
+        for j in range(0, y.size, 1024):
+            Y, X = np.meshgrid(y[j:j + 1024], x, indexing='ij', sparse=True)
+            z[j:j + 1024] = (3000 * np.sin(3 * np.deg2rad(X)) *
+                             np.cos(2 * np.deg2rad(Y)) - 2000).astype(dtype)
+    return filename
+
+
+def prepare(path, woa=('5deg',), cars=True, etopo=('5min',)):
+    """ Data files for WOA18, CARS and ETOPO at path, as OCEANSDB_DIR
+
+        woa is a sequence of resolutions of WOA18 (seasonal temperature),
+          and etopo of ETOPO ('5min', '1min'). Files already there are
+          kept. Returns path.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    cfg = catalog()
+    written = []
+
+    for resolution in woa:
+        entries = cfg['WOA18']['vars']['sea_water_temperature'][resolution]
+        for c, tn in zip(entries['seasonal'], (13, 14, 15, 16)):
+            filename = datafile(c, path)
+            if not os.path.exists(filename):
+                written.append(write_woa(filename, 't', resolution, tn))
+
+    if cars:
+        for c in cfg['CARS']['vars']['sea_water_temperature']['30min'][
+                'stationary']:
+            filename = datafile(c, path)
+            if not os.path.exists(filename):
+                written.append(write_cars(filename))
+
+    for resolution in etopo:
+        for c in cfg['ETOPO']['vars']['topography'][resolution]['stationary']:
+            filename = datafile(c, path)
+            if not os.path.exists(filename):
+                written.append(write_etopo(filename, resolution))
+
+    entries = {}
+    for filename in written:
+        st = os.stat(filename)
+        entries[os.path.basename(filename)] = {
+            'size': st.st_size, 'mtime': st.st_mtime,
+            'md5': md5sum(filename)}
+    if entries:
+        save_manifest(entries, path)
+    return path
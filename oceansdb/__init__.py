@@ -21,6 +21,7 @@ except DistributionNotFound:
 from oceansdb.woa import WOA
 from oceansdb.etopo import ETOPO
 from oceansdb.cars import CARS
+from oceansdb.utils import catalog
 #from WOA.woa import woa_profile
 #from WOA.woa import woa_profile_from_dap
 #from WOA.woa import woa_track_from_file
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+""" Command line interface
+
+    oceansdb verify [dbname]
+      Hash again all the local data files, check them against the catalog
+      and update the manifest.
+
+    oceansdb cache [dbname]
+      Convert the local data files into uncompressed memory maps, which
+      are used from then on instead of the netCDF files.
+"""
+
+import argparse
+import sys
+
+from .utils import oceansdb_dir, verify, build_cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='oceansdb')
+    subparsers = parser.add_subparsers(dest='command')
+    p_verify = subparsers.add_parser(
+            'verify', help='Verify the local data files')
+    p_verify.add_argument('dbname', nargs='?', default=None,
+            help='Database to verify, like WOA18. Default: all')
+    p_cache = subparsers.add_parser(
+            'cache', help='Convert the local data files into memory maps')
+    p_cache.add_argument('dbname', nargs='?', default=None,
+            help='Database to convert, like WOA18. Default: all')
+    args = parser.parse_args(argv)
+
+    if args.command == 'verify':
+        print("Verifying data files in %s" % oceansdb_dir())
+        status = verify(args.dbname)
+        for f in sorted(status):
+            print("%s: %s" % (f, status[f]))
+        if any(s != 'ok' for s in status.values()):
+            return 1
+        return 0
+
+    if args.command == 'cache':
+        for path in build_cache(args.dbname):
+            print("Cached %s" % path)
+        return 0
+
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+""" asyncio front-end for the databases
+
+    The extract() and track() of AsyncWOA, AsyncCARS and AsyncETOPO are
+    awaitable, and run in a pool of threads (see utils.netcdf_lock):
+
+        async with AsyncWOA() as db:
+            t = await db['TEMP'].extract(doy=136.875, depth=[0, 10],
+                                         lat=17.5, lon=-37.5)
+
+    The requests arriving within a short window are processed together,
+    and the tracks of the same variable are merged into a single
+    vectorized read. The number of batches being read at once is limited
+    by max_reads.
+"""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .woa import WOA
+from .cars import CARS
+from .etopo import ETOPO
+
+
+def _call(db, name, method, mode, kwargs):
+    """ Run one request, returning (True, output) or (False, exception)
+    """
+    try:
+        return True, getattr(db[name], method)(mode=mode, **kwargs)
+    except Exception as e:
+        return False, e
+
+
+def _track_key(name, method, mode, kwargs):
+    """ Requests with the same key can be merged into a single track
+
+        Returns None if it can't be merged, like an extract(), or a track
+          without depth (all the levels), with datetimes, or invalid.
+    """
+    if method != 'track':
+        return None
+    coords = tuple(k for k in ('doy', 'depth', 'lat', 'lon') if k in kwargs)
+    if coords not in (('doy', 'depth', 'lat', 'lon'), ('lat', 'lon')):
+        return None
+    if set(kwargs) - set(coords) - {'var'}:
+        return None
+    for k in coords:
+        if np.asanyarray(kwargs[k]).dtype.kind not in 'iuf':
+            return None
+    if np.shape(np.atleast_1d(kwargs['lat'])) != \
+            np.shape(np.atleast_1d(kwargs['lon'])):
+        return None
+    var = None
+    if 'var' in kwargs:
+        var = tuple(np.atleast_1d(kwargs['var']).tolist())
+    return (name, mode, var, coords)
+
+
+def _merged_track(db, requests):
+    """ Run many track requests as a single one, and split the output
+    """
+    name, method, mode, kwargs = requests[0]
+    coords = [k for k in ('doy', 'depth', 'lat', 'lon') if k in kwargs]
+    points = []
+    for _, _, _, kw in requests:
+        points.append(np.broadcast_arrays(
+            *[np.atleast_1d(kw[k]) for k in coords]))
+
+    merged = dict(
+            (k, np.concatenate([p[i] for p in points]))
+            for i, k in enumerate(coords))
+    if 'var' in kwargs:
+        merged['var'] = kwargs['var']
+    output = db[name].track(mode=mode, **merged)
+
+    results = []
+    start = 0
+    for p in points:
+        stop = start + p[0].size
+        results.append((True, OrderedDict(
+            (v, output[v][start:stop]) for v in output)))
+        start = stop
+    return results
+
+
+def run_batch(db, requests):
+    """ Run a batch of requests on the database db
+
+        Each request is (name, method, mode, kwargs), like ('TEMP',
+          'track', None, {'doy': ..., 'lat': ...}). The tracks that can be
+          merged (same variable, mode and var) are extracted at once. If
+          that fails, each one is run individually, so that an invalid
+          request doesn't affect the others.
+
+        Returns a list with (True, output) or (False, exception) for each
+          request.
+    """
+    results = [None] * len(requests)
+    groups = OrderedDict()
+    for i, r in enumerate(requests):
+        key = _track_key(*r)
+        if key is None:
+            results[i] = _call(db, *r)
+        else:
+            groups.setdefault(key, []).append(i)
+
+    for idx in groups.values():
+        if len(idx) > 1:
+            try:
+                merged = _merged_track(db, [requests[i] for i in idx])
+                for i, r in zip(idx, merged):
+                    results[i] = r
+                continue
+            except Exception:
+                pass
+        for i in idx:
+            results[i] = _call(db, *requests[i])
+
+    return results
+
+
+class AsyncVariable(object):
+    """ One variable of an asynchronous database, like db['TEMP']
+    """
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.name = name
+
+    def keys(self):
+        return self.parent.db[self.name].keys()
+
+    async def extract(self, mode=None, **kwargs):
+        """ Same as the extract() of the database, but awaitable
+        """
+        return await self.parent.submit(self.name, 'extract', mode, kwargs)
+
+    async def track(self, mode=None, **kwargs):
+        """ Same as the track() of the database, but awaitable
+
+            Concurrent tracks are merged into a single vectorized read.
+        """
+        return await self.parent.submit(self.name, 'track', mode, kwargs)
+
+
+class AsyncDatabase(object):
+    """ Asynchronous front-end of a database, like WOA()
+
+        The requests submitted within window seconds are processed
+          together (see run_batch()) in a thread pool, with up to
+          max_reads batches at once. A different executor can be given.
+
+        The counters in stats, the number of requests and batches, show
+          how much the requests are being grouped.
+    """
+    def __init__(self, db, window=0.001, max_reads=4, executor=None):
+        assert max_reads > 0
+        self.db = db
+        self.window = window
+        self.max_reads = max_reads
+        self._executor = executor
+        self._own_executor = executor is None
+        self._semaphore = None
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+        self._variables = {}
+        self.stats = {'requests': 0, 'batches': 0}
+
+    def __getitem__(self, item):
+        if item not in self._variables:
+            self._variables[item] = AsyncVariable(self, item)
+        return self._variables[item]
+
+    def keys(self):
+        return self.db.keys()
+
+    def submit(self, name, method, mode, kwargs):
+        """ Queue a request, returning a future with its output
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((name, method, mode, kwargs, future))
+        self.stats['requests'] += 1
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return future
+
+    def _flush(self):
+        self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_reads)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_reads)
+
+        self.stats['batches'] += 1
+        requests = [b[:4] for b in batch]
+        async with self._semaphore:
+            try:
+                results = await loop.run_in_executor(
+                        self._executor, run_batch, self.db, requests)
+            except Exception as e:
+                results = len(batch) * [(False, e)]
+
+        for b, (ok, output) in zip(batch, results):
+            future = b[-1]
+            if future.done():
+                continue
+            if ok:
+                future.set_result(output)
+            else:
+                future.set_exception(output)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """ Wait for the requests already submitted, and close
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        self.close()
+
+    def close(self):
+        """ Close the database. Use aclose() to wait for pending requests
+        """
+        if self._own_executor and (self._executor is not None):
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.db.close()
+
+
+class AsyncWOA(AsyncDatabase):
+    """ Asynchronous WOA, with the same arguments of WOA()
+    """
+    def __init__(self, *args, **kwargs):
+        options = dict((k, kwargs.pop(k)) for k in
+                ('window', 'max_reads', 'executor') if k in kwargs)
+        super(AsyncWOA, self).__init__(WOA(*args, **kwargs), **options)
+
+
+class AsyncCARS(AsyncDatabase):
+    """ Asynchronous CARS, with the same arguments of CARS()
+    """
+    def __init__(self, *args, **kwargs):
+        options = dict((k, kwargs.pop(k)) for k in
+                ('window', 'max_reads', 'executor') if k in kwargs)
+        super(AsyncCARS, self).__init__(CARS(*args, **kwargs), **options)
+
+
+class AsyncETOPO(AsyncDatabase):
+    """ Asynchronous ETOPO, with the same arguments of ETOPO()
+    """
+    def __init__(self, *args, **kwargs):
+        options = dict((k, kwargs.pop(k)) for k in
+                ('window', 'max_reads', 'executor') if k in kwargs)
+        super(AsyncETOPO, self).__init__(ETOPO(*args, **kwargs), **options)
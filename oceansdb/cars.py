@@ -14,8 +14,11 @@ download_file('http://www.marine.csiro.au/atlas/export/salinity_cars2009a.nc.gz'
 
 import os
 from os.path import expanduser
+import hashlib
 import re
+import threading
 from datetime import datetime
+from collections import OrderedDict
 
 import numpy as np
 from numpy import ma
@@ -24,8 +27,14 @@ from scipy.interpolate import interp1d
 # RectBivariateSpline
 from scipy.interpolate import griddata
 
-from .utils import dbsource
-from .common import cropIndices
+from .utils import dbsource, extract_many, as_memo, stream_track
+from .utils import cached_plan
+from .utils import cache_path, orthogonal_index
+from .utils import as_instrument, timed_call, timed_stage
+from .common import cropIndices, GridAxis, PERIOD
+from .common import rectilinear, rectilinear_points, as_masked
+from .common import rectilinear_profile, rectilinear_casts, cast_index
+from .common import RegridWeights, InterpolationPlan
 
 
 def extract(filename, doy, latitude, longitude, depth):
@@ -106,6 +115,33 @@ def cars_profile(filename, doy, latitude, longitude, depth):
         return output
 
 
+def harmonics(nc, doy, zn, yn, xn):
+    """ Climatology from the mean and harmonics for many days of year
+
+        Each coefficient (mean, an_cos, an_sin, sa_cos, sa_sin) is read
+          only once, on the depth range required, and evaluated for all
+          the days at once. The annual and semi-annual harmonics are only
+          defined on the top levels (depth_ann & depth_semiann).
+
+        Returns a (time, depth, lat, lon) masked array.
+    """
+    doy = np.atleast_1d(doy)
+    zidx = np.arange(nc['mean'].shape[0])[zn]
+    z0 = np.min(zidx) if np.size(zidx) > 0 else 0
+    z1 = np.max(zidx) + 1 if np.size(zidx) > 0 else 0
+
+    value = nc['mean'][z0:z1, yn, xn]
+    value = ma.repeat(value[np.newaxis], doy.size, axis=0)
+    t = 2 * np.pi * doy/366
+    t = t.reshape((-1,) + (1,) * (value.ndim - 1))
+    for c, s, k in (('an_cos', 'an_sin', 1), ('sa_cos', 'sa_sin', 2)):
+        zk = min(z1, nc[c].shape[0])
+        if z0 < zk:
+            value[:, :zk - z0] += nc[c][z0:zk, yn, xn] * np.cos(k*t) + \
+                    nc[s][z0:zk, yn, xn] * np.sin(k*t)
+    return value[:, zidx - z0]
+
+
 class cars_data(object):
     """ Returns temperature/salinity from a CARS' file
 
@@ -123,24 +159,72 @@ class cars_data(object):
         """ t, z, y, x
         """
         tn, zn, yn, xn = item
+        return harmonics(self.nc, np.arange(1, 367)[tn], zn, yn, xn)
 
-        #if type(zn) is not slice:
-        #    zn = slice(zn, zn+1)
-        #zn_an = slice(zn.start, min(64, zn.stop), zn.step)
-        #zn_sa = slice(zn.start, min(55, zn.stop), zn.step)
 
-        output = []
-        d = 2 * np.pi * (np.arange(1, 367)[tn])/366
-        for t in np.atleast_1d(d):
-            tmp = self.nc['mean'][:, yn, xn]
+def harmonics_cube(nc, days, output, max_bytes=256 * 2**20):
+    """ Evaluate the climatology on the given days over the whole grid
 
-            tmp[:64] += self.nc['an_cos'][:, yn, xn] * np.cos(t) + \
-                    self.nc['an_sin'][:, yn, xn] * np.sin(t)
-            tmp[:55] += self.nc['sa_cos'][:, yn, xn] * np.cos(2*t) + \
-                    self.nc['sa_sin'][:, yn, xn] * np.sin(2*t)
-            output.append(tmp[zn])
+        Fills output, an array (time, depth, lat, lon) like a memory map,
+          with the harmonics (see harmonics()) evaluated on days, and NaN
+          where masked. It is done by groups of depth levels, one day at a
+          time, so that no more than about max_bytes are required at once
+          whatever the number of days.
+    """
+    days = np.asanyarray(days)
+    T, Z, Y, X = output.shape
+    t = 2 * np.pi * days/366
+    # The five coefficients, the value and its temporaries, about ten
+    #   masked float64 (9 bytes with the mask) on each gridpoint of a level
+    step = max(1, int(max_bytes // (10 * 9 * Y * X)))
+    for z0 in range(0, Z, step):
+        z1 = min(Z, z0 + step)
+        mean = nc['mean'][z0:z1]
+        coefs = []
+        for c, s, k in (('an_cos', 'an_sin', 1), ('sa_cos', 'sa_sin', 2)):
+            zk = min(z1, nc[c].shape[0])
+            if z0 < zk:
+                coefs.append((zk - z0, nc[c][z0:zk], nc[s][z0:zk],
+                    np.cos(k*t), np.sin(k*t)))
+        for i in range(T):
+            value = ma.array(mean, copy=True)
+            for n, a, b, cos, sin in coefs:
+                value[:n] += a * cos[i] + b * sin[i]
+            output[i, z0:z1] = ma.filled(value.astype('f4'), np.nan)
+    return output
+
+
+class cars_points(object):
+    """ Climatology from the harmonics on scattered points, like a track
+
+        Reads once the hyperslab (zn, yn, xn) of the mean and harmonics,
+          and combines them on the fly for the day of year of each point,
+          the same way than harmonics(). Indexed by (p, z, y, x) with an
+          array of indices for each, p being the point, i.e. its doy.
+
+          data = cars_points(nc, doy, zn, yn, xn)
+          data[np.arange(doy.size), z, y, x]
+    """
+    ndim = 4
 
-        return ma.asanyarray(output)
+    def __init__(self, nc, doy, zn, yn, xn):
+        self.t = 2 * np.pi * np.asanyarray(doy)/366
+        self.coefs = {'mean': nc['mean'][zn, yn, xn]}
+        for c in ('an_cos', 'an_sin', 'sa_cos', 'sa_sin'):
+            zk = slice(zn.start, min(zn.stop, nc[c].shape[0]))
+            self.coefs[c] = nc[c][zk, yn, xn]
+
+    def __getitem__(self, item):
+        p, zn, yn, xn = item
+        t = self.t[p]
+        value = ma.array(self.coefs['mean'][zn, yn, xn])
+        for c, s, k in (('an_cos', 'an_sin', 1), ('sa_cos', 'sa_sin', 2)):
+            idx = zn < self.coefs[c].shape[0]
+            if idx.any():
+                i = (zn[idx], yn[idx], xn[idx])
+                value[idx] += self.coefs[c][i] * np.cos(k*t[idx]) + \
+                        self.coefs[s][i] * np.sin(k*t[idx])
+        return value
 
 
 class CARS_var_nc(object):
@@ -149,11 +233,22 @@ class CARS_var_nc(object):
     returns the corresponding values of salinity or temperature mean and
     standard deviation for the given time, lat, lon, depth.
     """
-    def __init__(self, source):
+    def __init__(self, source, preload=False, memo=None, precompute=None,
+            instrument=None):
         self.ncs = source
+        self.memo = memo
+        self.instrument = instrument
+        self.cube = None
+        self.cube_axis = None
 
         self.load_dims(dims=['lat', 'lon', 'depth'])
         self.set_keys()
+        if preload:
+            self.preload(None if preload is True else preload)
+        if isinstance(precompute, dict):
+            self.precompute(**precompute)
+        elif precompute is not None:
+            self.precompute(precompute)
 
     def __enter__(self):
         return self
@@ -178,6 +273,89 @@ class CARS_var_nc(object):
     def keys(self):
         return self.KEYS
 
+    def preload(self, var=None):
+        """Read the variables into memory
+
+           Once loaded, extractions don't require any I/O. By default
+           loads all the variables, otherwise only the given list, like
+           ['mn', 'sd']. The climatology 'mn' requires the mean and its
+           harmonics. Returns the memory used, in bytes.
+        """
+        if var is None:
+            var = self.KEYS
+        elif isinstance(var, str):
+            var = [var]
+        varnames = []
+        for v in var:
+            if v == 'mn':
+                varnames.extend(['mean', 'an_cos', 'an_sin', 'sa_cos',
+                    'sa_sin'])
+            else:
+                varnames.append(self[v].name)
+        self.ncs[0].preload(varnames)
+        return self.nbytes
+
+    @property
+    def nbytes(self):
+        """Memory used by the preloaded variables, in bytes
+        """
+        return sum(nc.nbytes for nc in self.ncs)
+
+    def precompute(self, days=12, cache=False, max_bytes=2 * 2**30):
+        """Evaluate the climatology 'mn' once on a set of days
+
+           days is a number of days evenly distributed along the year,
+           like 12 (monthly), 73 (pentads) or 366 (daily), or a sequence
+           of days of year. From then on, the linear interpolation of
+           'mn' (mode=None) is interpolated in time from these days,
+           instead of evaluating the harmonics at each request. With 366
+           days, the integer days of year are exactly the same as the
+           harmonics.
+
+           The cube (time, depth, lat, lon) is in memory, or with
+           cache=True, memory-mapped from OCEANSDB_DIR/cache, where it is
+           saved the first time and reused while the data file is not
+           modified. In memory, a cube larger than max_bytes is refused,
+           like 366 days of CARS at 0.5 degrees (about 27 GB), use
+           cache=True instead. Returns the cube.
+        """
+        if np.ndim(days) == 0:
+            days = 366. * np.arange(int(days)) / int(days)
+        days = np.asanyarray(days, dtype='f8')
+        shape = (days.size,) + self.ncs[0]['mean'].shape
+        nbytes = 4 * np.prod(shape, dtype='i8')
+        if (not cache) and (nbytes > max_bytes):
+            raise ValueError(
+                    "The cube of %d days takes %.1f GB, more than max_bytes. "
+                    "Use cache=True to memory-map it from OCEANSDB_DIR/cache"
+                    % (days.size, nbytes / 2.**30))
+
+        if not cache:
+            cube = harmonics_cube(self.ncs[0], days, np.empty(shape, 'f4'))
+        else:
+            filename = self.ncs[0].filename
+            digest = hashlib.md5(days.tobytes()).hexdigest()[:8]
+            path = "%s.mn_%d_%s.npy" % (cache_path(filename), days.size,
+                    digest)
+            if (not os.path.exists(path)) or \
+                    (os.path.getmtime(path) < os.path.getmtime(filename)):
+                cachedir = os.path.dirname(path)
+                if not os.path.exists(cachedir):
+                    os.makedirs(cachedir)
+                tmp = path + '.tmp%d' % os.getpid()
+                cube = np.lib.format.open_memmap(tmp, mode='w+',
+                        dtype='f4', shape=shape)
+                harmonics_cube(self.ncs[0], days, cube)
+                cube.flush()
+                del cube
+                os.replace(tmp, path)
+            cube = np.load(path, mmap_mode='r')
+            assert cube.shape == shape
+
+        self.cube = cube
+        self.cube_axis = GridAxis(days, period=366)
+        return cube
+
     def load_dims(self, dims):
         self.dims = {}
         for d in dims:
@@ -192,6 +370,11 @@ class CARS_var_nc(object):
         #    self.dims['time'].append(mfrac * nc.variables['time'][0])
         self.dims['time'] = np.array([])
 
+        self.axes = {}
+        for d in self.dims:
+            if np.size(self.dims[d]) > 0:
+                self.axes[d] = GridAxis(self.dims[d], period=PERIOD.get(d))
+
     def set_keys(self):
         """
         """
@@ -207,11 +390,11 @@ class CARS_var_nc(object):
 
     def __getitem__(self, item):
         if item in self.KEYS:
-            return self.ncs[0].variables[item]
+            return self.ncs[0][item]
         elif re.match('(?:[s,t]_)?sd', item):
-            return self.ncs[0].variables['std_dev']
+            return self.ncs[0]['std_dev']
         elif re.match('(?:[s,t]_)?dd', item):
-            return self.ncs[0].variables['nq']
+            return self.ncs[0]['nq']
 
         return "yooo"
 
@@ -231,60 +414,311 @@ class CARS_var_nc(object):
                a longitude sequence like [352, 358, 364, 369, 380], and
                the equivalent for day of year above 365.
         """
-        dims, idx = cropIndices(self.dims, lat, lon, depth)
+        with timed_stage(self.instrument, 'cropIndices'):
+            dims, idx = cropIndices(self.axes, lat, lon, depth)
 
         dims['time'] = np.atleast_1d(doy)
         idx['tn'] = np.arange(dims['time'].size)
 
-        # Temporary solution. Create an object for CARS dataset
-        xn = idx['xn']
-        yn = idx['yn']
-        zn = idx['zn']
-        tn = idx['tn']
+        subset = self._read(doy, idx['zn'], idx['yn'], idx['xn'], var)
+        return subset, dims
 
+    def _read(self, doy, zn, yn, xn, var):
+        """ Read each var on the given indices for each day of year
+
+            Returns a dictionary with (time, depth, lat, lon) masked arrays.
+        """
         subset = {}
         for v in var:
             if v == 'mn':
-                mn = []
-                for d in doy:
-                    t = 2 * np.pi * d/366
-                    # Naive solution
-                    # FIXME: This is not an efficient solution.
-                    value = self.ncs[0]['mean'][:, yn, xn]
-                    value[:64] += self.ncs[0]['an_cos'][:, yn, xn] * np.cos(t) + \
-                        self.ncs[0]['an_sin'][:, yn, xn] * np.sin(t)
-                    value[:55] += self.ncs[0]['sa_cos'][:, yn, xn] * np.cos(2*t) + \
-                        self.ncs[0]['sa_sin'][:, yn, xn] * np.sin(2*t)
-                    mn.append(value[zn])
-
-                subset['mn'] = ma.asanyarray(mn)
+                with timed_stage(self.instrument, 'harmonics') as stage:
+                    subset['mn'] = harmonics(self.ncs[0], doy, zn, yn, xn)
+                    stage.count(subset['mn'])
             else:
-                subset[v] = ma.asanyarray(
-                        doy.size * [self[v][zn, yn, xn]])
-        return subset, dims
+                with timed_stage(self.instrument, 'read') as stage:
+                    data = self[v][zn, yn, xn]
+                    stage.count(data)
+                subset[v] = ma.asanyarray(doy.size * [data])
+        return subset
+
+    def _read_cube(self, doy, zn, yn, xn):
+        """ Read from the precomputed cube only the days around each doy
+
+            Returns the time weights, relative to the days read even
+              across the end of the year, and the (time, depth, lat, lon)
+              array.
+        """
+        i0, i1, w, valid = self.cube_axis.weights(doy)
+        tn = np.unique(np.concatenate([i0, i1]))
+        t = (np.searchsorted(tn, i0), np.searchsorted(tn, i1), w, valid)
+        with timed_stage(self.instrument, 'read') as stage:
+            cube = orthogonal_index(self.cube, (tn, zn, yn, xn))
+            stage.count(cube)
+        return t, cube
 
     def nearest(self, doy, depth, lat, lon, var):
+        """ Nearest value of each var on the coordinates requested
+
+            The indices are obtained with a binary search on each axis,
+              considering the cyclic longitude, hence the output is filled
+              at once from the smallest hyperslab that contains all the
+              required grid points, with only the longitudes required.
+        """
+        zn = self.axes['depth'].nearest(depth)
+        yn = self.axes['lat'].nearest(lat)
+        xn = self.axes['lon'].nearest(lon)
+
+        zn_in = slice(zn.min(), zn.max() + 1)
+        yn_in = slice(yn.min(), yn.max() + 1)
+        # Only the longitudes required, even across the end of the axis
+        xn_in, xn_out = np.unique(xn, return_inverse=True)
+        xn_in = xn_in.tolist()
+        idx = np.ix_(np.arange(doy.size), zn - zn_in.start,
+                yn - yn_in.start, np.ravel(xn_out))
+
+        subset = self._read(doy, zn_in, yn_in, xn_in, var)
         output = {}
         for v in var:
-            output[v] = ma.masked_all((doy.size, depth.size, lat.size,
-                lon.size), dtype='f')
-            for tn_out, t in enumerate(doy):
-                subset, dims = self.crop(np.array([t]), depth, lat, lon, [v])
-                for yn_out, y in enumerate(lat):
-                    yn_in = np.absolute(dims['lat']-y).argmin()
-                    for xn_out, x in enumerate(lon):
-                        xn_in = np.absolute(dims['lon']-x).argmin()
-                        for zn_out, z in enumerate(depth):
-                            zn_in = np.absolute(dims['depth']-z).argmin()
-                            output[v][tn_out, zn_out, yn_out, xn_out] = \
-                                    subset[v][0,zn_in, yn_in, xn_in]
+            output[v] = ma.asanyarray(subset[v][idx], dtype='f')
         return output
 
-    def interpolate(self, doy, depth, lat, lon, var):
+    def interpolate(self, doy, depth, lat, lon, var, mode=None):
         """ Interpolate each var on the coordinates requested
 
+            The harmonics are evaluated on the requested days, and the
+              default is a linear interpolation on the rectilinear grid,
+              i.e. linear in depth, and bilinear in lat x lon ignoring the
+              masked corners (see common.rectilinear()).
+
+            With mode='griddata' it uses the previous interpolator, which
+              triangulates the valid data with scipy.interpolate.griddata.
+        """
+        if mode == 'griddata':
+            with timed_stage(self.instrument, 'griddata'):
+                return self._interpolate_griddata(doy, depth, lat, lon, var)
+
+        zn, z = self.axes['depth'].hyperslab(depth)
+        yn, y = self.axes['lat'].hyperslab(lat)
+        xn, x = self.axes['lon'].hyperslab(lon)
+
+        output = {}
+        if (self.cube is not None) and ('mn' in var):
+            t, cube = self._read_cube(doy, zn, yn, xn)
+            with timed_stage(self.instrument, 'interpolate'):
+                values = rectilinear(cube.astype('f8'), (t, z, y, x))
+                output['mn'] = as_masked(values, cube.dtype)
+            var = [v for v in var if v != 'mn']
+
+        subset = self._read(doy, zn, yn, xn, var)
+        for v in var:
+            with timed_stage(self.instrument, 'interpolate'):
+                values = rectilinear(
+                        ma.filled(subset[v].astype('f8'), np.nan),
+                        (None, z, y, x))
+                output[v] = as_masked(values, subset[v].dtype)
+
+        return output
+
+    def profile(self, doy, lat, lon, depth=None, var=None):
+        """ Fast linear interpolation of a single vertical profile
+
+            The same as extract(doy=doy, depth=depth, lat=lat, lon=lon)
+              with mode=None, but the harmonics are evaluated only on the
+              2 x 2 columns around the position, also across the date line
+              (or taken from the precomputed days, see precompute()), and
+              the horizontal weights are computed once for all the levels
+              (see common.rectilinear_profile()).
+
+              t = db['TEMP'].profile(doy=136.875, lat=17.5, lon=-37.5)
         """
+        with timed_call(self.instrument, 'profile'):
+            return self._profile(doy, lat, lon, depth, var)
+
+    def _profile(self, doy, lat, lon, depth=None, var=None):
+        if var is None:
+            var = self.KEYS
+        else:
+            var = np.atleast_1d(var)
+        if isinstance(doy, datetime):
+            doy = int(doy.strftime('%j'))
+        doy = np.atleast_1d(doy)
+        if depth is None:
+            depth = self.dims['depth']
+        depth = np.atleast_1d(ma.getdata(depth))
+        assert np.all(depth >= 0), "Depth was supposed to be positive."
+
+        zn, z = self.axes['depth'].hyperslab(depth)
+        yn, y = self.axes['lat'].hyperslab([lat])
+        xn, x = self.axes['lon'].hyperslab([lon])
+
+        output = OrderedDict()
+        for v in var:
+            t = None
+            if (v == 'mn') and (self.cube is not None):
+                t = self.cube_axis.weights(doy)
+                tn = np.unique((t[0][0], t[1][0]))
+                t = (np.searchsorted(tn, t[0]), np.searchsorted(tn, t[1]),
+                        t[2], t[3])
+                with timed_stage(self.instrument, 'read') as stage:
+                    data = orthogonal_index(self.cube, (tn, zn, yn, xn))
+                    stage.count(data)
+            elif v == 'mn':
+                with timed_stage(self.instrument, 'harmonics') as stage:
+                    data = harmonics(self.ncs[0], doy, zn, yn, xn)
+                    stage.count(data)
+            else:
+                with timed_stage(self.instrument, 'read') as stage:
+                    data = ma.asanyarray(self[v][zn, yn, xn])[np.newaxis]
+                    stage.count(data)
+            dtype = data.dtype
+            data = ma.filled(data.astype('f8'), np.nan)
+            with timed_stage(self.instrument, 'interpolate'):
+                output[v] = as_masked(
+                        rectilinear_profile(data, (t, z, y, x)), dtype)
+        return output
+
+    def profiles(self, doy, lat, lon, depth, offsets, var=None):
+        """ Linear interpolation of many profiles, each on its own depths
+
+            Like an extract() for each cast (profile), as from an archive
+              of CTDs, but all at once. The casts are given by their doy,
+              lat and lon, and their depths concatenated in a single flat
+              array, the i-th cast being depth[offsets[i]:offsets[i + 1]].
+              The output has the same layout as depth.
+
+              t = db['TEMP'].profiles(doy=[136.875, 140], lat=[17.5, 10],
+                      lon=[-37.5, -30], depth=[0, 10, 0, 10, 100],
+                      offsets=[0, 2, 5])
+
+            The harmonics are evaluated only on the columns around each
+              cast (or taken from the precomputed days), and the horizontal
+              weights are applied once for all the levels of each cast (see
+              common.rectilinear_casts()).
+        """
+        with timed_call(self.instrument, 'profiles'):
+            return self._profiles(doy, lat, lon, depth, offsets, var)
+
+    def _profiles(self, doy, lat, lon, depth, offsets, var=None):
+        if var is None:
+            var = self.KEYS
+        else:
+            var = np.atleast_1d(var)
+        doy = np.atleast_1d(doy)
+        if (doy.size > 0) and (type(doy[0]) is datetime):
+            doy = np.array([int(d.strftime('%j')) for d in doy])
+        lat = np.atleast_1d(lat)
+        lon = np.atleast_1d(lon)
+        depth = np.atleast_1d(ma.getdata(depth))
+        assert np.all(depth >= 0), "Depth was supposed to be positive."
+        cast = cast_index(offsets, depth.size)
+        assert doy.shape == lat.shape == lon.shape == (np.size(offsets) - 1,), \
+                "One doy, lat and lon for each cast"
 
+        zn, z = self.axes['depth'].hyperslab(depth)
+        yn, y = self.axes['lat'].hyperslab(lat)
+        xn, x = self.axes['lon'].hyperslab(lon)
+
+        output = OrderedDict()
+        for v in var:
+            t = None
+            if (v == 'mn') and (self.cube is not None):
+                t, data = self._read_cube(doy, zn, yn, xn)
+                dtype = self.cube.dtype
+            elif v == 'mn':
+                # Each cast on its own day, no interpolation in time
+                p = np.arange(doy.size)
+                t = (p, p, np.zeros(doy.size), np.ones(doy.size, dtype=bool))
+                with timed_stage(self.instrument, 'read') as stage:
+                    data = cars_points(self.ncs[0], doy, zn, yn, xn)
+                    for c in data.coefs.values():
+                        stage.count(c)
+                dtype = data.coefs['mean'].dtype
+            else:
+                with timed_stage(self.instrument, 'read') as stage:
+                    data = ma.asanyarray(self[v][zn, yn, xn])
+                    stage.count(data)
+                dtype = data.dtype
+            with timed_stage(self.instrument, 'interpolate'):
+                values = rectilinear_casts(data, (t, z, y, x), cast)
+                output[v] = as_masked(values, dtype)
+        return output
+
+    def regrid_weights(self, lat, lon, depth=None):
+        """ Weights to regrid onto lat x lon x depth, see regrid()
+        """
+        if depth is None:
+            depth = self.dims['depth']
+        return RegridWeights(self.axes, lat, lon, depth)
+
+    def regrid(self, doy, lat=None, lon=None, depth=None, var=None,
+            weights=None):
+        """ Linear interpolation of the whole field onto a target grid
+
+            The same as extract(doy=doy, depth=depth, lat=lat, lon=lon)
+              with mode=None, i.e. on lat x lon x depth, but the weights
+              are computed once, as sparse matrices applied to all the
+              levels and days at once (see common.RegridWeights). The
+              weights can be reused, like for another variable:
+
+              w = db['TEMP'].regrid_weights(lat=lat, lon=lon, depth=depth)
+              t = db['TEMP'].regrid(doy=136.875, weights=w)
+
+            The harmonics are evaluated on each doy (or interpolated from
+              the precomputed days, see precompute()). Returns (depth,
+              lat, lon) arrays for each var, or (doy, depth, lat, lon) if
+              doy is a sequence.
+        """
+        with timed_call(self.instrument, 'regrid'):
+            return self._regrid(doy, lat, lon, depth, var, weights)
+
+    def _regrid(self, doy, lat, lon, depth, var, weights):
+        if var is None:
+            var = self.KEYS
+        else:
+            var = np.atleast_1d(var)
+        if weights is None:
+            assert (lat is not None) and (lon is not None), \
+                    "Requires lat and lon, or weights"
+            weights = self.regrid_weights(lat, lon, depth)
+        assert weights.matches(self.axes), "Weights of a different grid"
+        scalar = np.ndim(doy) == 0
+        doy = np.atleast_1d(doy)
+        if type(doy[0]) is datetime:
+            doy = np.array([int(d.strftime('%j')) for d in doy])
+        zn, yn, xn = weights.zn, weights.yn, weights.xn
+
+        output = OrderedDict()
+        for v in var:
+            t = None
+            if (v == 'mn') and (self.cube is not None):
+                t = self.cube_axis.weights(doy)
+                tn = np.unique(np.concatenate((t[0], t[1])))
+                t = (np.searchsorted(tn, t[0]), np.searchsorted(tn, t[1]),
+                        t[2], t[3])
+                with timed_stage(self.instrument, 'read') as stage:
+                    data = orthogonal_index(self.cube, (tn, zn, yn, xn))
+                    stage.count(data)
+            elif v == 'mn':
+                with timed_stage(self.instrument, 'harmonics') as stage:
+                    data = harmonics(self.ncs[0], doy, zn, yn, xn)
+                    stage.count(data)
+            else:
+                with timed_stage(self.instrument, 'read') as stage:
+                    data = ma.asanyarray(self[v][zn, yn, xn])[np.newaxis]
+                    stage.count(data)
+            dtype = data.dtype
+            with timed_stage(self.instrument, 'interpolate'):
+                values = weights.apply(
+                        ma.filled(data.astype('f8'), np.nan), t)
+                if values.shape[0] != doy.size:
+                    # Stationary, the same for every doy
+                    values = np.repeat(values, doy.size, axis=0)
+                output[v] = as_masked(values[0] if scalar else values, dtype)
+        return output
+
+    def _interpolate_griddata(self, doy, depth, lat, lon, var):
+        """ Interpolate each var using scipy's griddata
+        """
         subset, dims = self.crop(doy, depth, lat, lon, var)
 
         if np.all([d in dims['time'] for d in doy]) & \
@@ -364,6 +798,13 @@ class CARS_var_nc(object):
 
               - Track:   doy{1,n}, depth{1,n2},  lat{n},lon{n}
         """
+        with timed_call(self.instrument, 'extract'):
+            if self.memo is not None:
+                return self.memo.call(('extract', self.ncs[0].filename),
+                        self._extract, mode, kwargs)
+            return self._extract(mode=mode, **kwargs)
+
+    def _extract(self, mode=None, **kwargs):
         for k in kwargs:
             assert k in ['var', 'doy', 'depth', 'lat', 'lon'], \
                     "Wrong dimension to extract, check the manual"
@@ -391,24 +832,225 @@ class CARS_var_nc(object):
         if mode == 'nearest':
             output = self.nearest(doy, depth, lat, lon, var)
         else:
-            output = self.interpolate(doy, depth, lat, lon, var)
+            output = self.interpolate(doy, depth, lat, lon, var, mode=mode)
             for v in output:
                 output[v] = np.atleast_1d(np.squeeze(output[v]))
 
         return output
 
+    def track(self, mode=None, **kwargs):
+        """
+
+            Possible scenarios:
+              - Track:   doy{1,n}, depth{1,n2}, lat{n}, lon{n}
+        """
+        with timed_call(self.instrument, 'track'):
+            if self.memo is not None:
+                return self.memo.call(('track', self.ncs[0].filename),
+                        self._track, mode, kwargs)
+            return self._track(mode=mode, **kwargs)
+
+    def _track(self, mode=None, **kwargs):
+        for k in kwargs:
+            assert k in ['var', 'doy', 'depth', 'lat', 'lon'], \
+                    "Wrong dimension to extract, check the manual"
+
+        if 'var' in kwargs:
+            var = np.atleast_1d(kwargs['var'])
+        else:
+            var = np.asanyarray(self.KEYS)
+
+        doy = np.atleast_1d(kwargs['doy'])
+        if type(doy[0]) is datetime:
+            doy = np.array([int(d.strftime('%j')) for d in doy])
+
+        if 'depth' in kwargs:
+            depth = np.atleast_1d(kwargs['depth'])
+        else:
+            depth = self.dims['depth'][:]
+
+        assert np.all(depth >= 0), "Depth was supposed to be positive."
+
+        lat = np.atleast_1d(kwargs['lat'])
+        lon = np.atleast_1d(kwargs['lon'])
+
+        assert lat.shape == lon.shape
+
+        N = max(doy.size, depth.size, lat.size)
+
+        if doy.shape == (1,):
+            doy = doy * np.ones(N)
+        if depth.shape == (1,):
+            depth = depth * np.ones(N)
+        if lat.shape == (1,):
+            lat = lat * np.ones(N)
+            lon = lon * np.ones(N)
+
+        if mode not in ('nearest', 'griddata'):
+            return self._linear_track(doy, depth, lat, lon, var)
+
+        output = {}
+        for v in var:
+            output[v] = []
+
+        for t, z, y, x in zip(doy, depth, lat, lon):
+            if mode == 'nearest':
+                tmp = self.nearest(np.array([t]), np.array([z]),
+                        np.array([y]), np.array([x]), var)
+            else:
+                tmp = self.interpolate(np.array([t]), np.array([z]),
+                        np.array([y]), np.array([x]), var, mode=mode)
+
+            for v in tmp:
+                output[v].append(tmp[v])
+
+        for v in output:
+            output[v] = np.atleast_1d(ma.array(output[v]).squeeze())
+
+        return output
+
+    def stream(self, records, chunk_size=1024, mode=None, var=None):
+        """ Values along an iterable of records, possibly unbounded
+
+            Each record is (doy, depth, lat, lon), or a dictionary with
+              those keys. The records are consumed lazily, chunk_size at a
+              time, each chunk evaluated with a single track(). Yields a
+              dictionary with the values of each var for each record, in
+              the same order (see utils.stream_track()).
+
+              for t in db['TEMP'].stream(feed, chunk_size=256):
+                  t['t_mn']
+        """
+        kwargs = {'mode': mode}
+        if var is not None:
+            kwargs['var'] = var
+        return stream_track(self.track, records,
+                ('doy', 'depth', 'lat', 'lon'), chunk_size, **kwargs)
+
+    def _linear_track(self, doy, depth, lat, lon, var):
+        """ Linear interpolation of each var along a track, at once
+
+            Reads once the hyperslab that contains the whole track, and
+              evaluates all the points together, each one with the
+              harmonics of its own day of year (see cars_points()).
+        """
+        plan = InterpolationPlan(self.axes, depth, lat, lon)
+        return self._interpolate_plan(plan, doy, var)
+
+    def plan(self, depth, lat, lon, cache=False):
+        """ Interpolation plan of a fixed set of points, see apply()
+
+            depth, lat and lon of N points, like the levels of a list of
+              stations. Their indices and weights on the grid are computed
+              once (see common.InterpolationPlan) and, with cache=True,
+              saved in OCEANSDB_DIR/cache, keyed by the dataset and the
+              points.
+        """
+        if cache:
+            return cached_plan(self.ncs[0].filename, self.axes, depth, lat,
+                    lon)
+        return InterpolationPlan(self.axes, depth, lat, lon)
+
+    def apply(self, plan, doy, var=None):
+        """ Linear interpolation of each var on the points of a plan
+
+            The same as track() on the points of the plan, but without
+              computing again the indices and weights. doy is one day of
+              year for all the points, or one for each point.
+
+              p = db['TEMP'].plan(depth=[0, 10, 0], lat=[17.5, 17.5, 10],
+                      lon=[322.5, 322.5, 330], cache=True)
+              t = db['TEMP'].apply(p, doy=136.875)
+        """
+        with timed_call(self.instrument, 'apply'):
+            return self._apply(plan, doy, var)
+
+    def _apply(self, plan, doy, var=None):
+        if var is None:
+            var = self.KEYS
+        else:
+            var = np.atleast_1d(var)
+        assert plan.matches(self.axes), "Plan of a different grid"
+        doy = np.atleast_1d(doy)
+        if type(doy[0]) is datetime:
+            doy = np.array([int(d.strftime('%j')) for d in doy])
+        if doy.shape == (1,):
+            doy = doy * np.ones(len(plan), dtype='i')
+        assert doy.shape == (len(plan),), "One doy, or one for each point"
+        return self._interpolate_plan(plan, doy, var)
+
+    def _interpolate_plan(self, plan, doy, var):
+        zn, yn, xn = plan.zn, plan.yn, plan.xn
+        z, y, x = plan.z, plan.y, plan.x
+        p = np.arange(doy.size)
+        t = (p, p, np.zeros(doy.size), np.ones(doy.size, dtype=bool))
+
+        output = {}
+        for v in var:
+            if (v == 'mn') and (self.cube is not None):
+                tc, cube = self._read_cube(doy, zn, yn, xn)
+                with timed_stage(self.instrument, 'interpolate'):
+                    values = rectilinear_points(
+                            _filled_points(cube), (tc, z, y, x))
+                dtype = self.cube.dtype
+            elif v == 'mn':
+                with timed_stage(self.instrument, 'read') as stage:
+                    data = cars_points(self.ncs[0], doy, zn, yn, xn)
+                    for c in data.coefs.values():
+                        stage.count(c)
+                # The harmonics are evaluated while interpolating
+                with timed_stage(self.instrument, 'interpolate'):
+                    values = rectilinear_points(
+                            _filled_points(data), (t, z, y, x))
+                dtype = data.coefs['mean'].dtype
+            else:
+                with timed_stage(self.instrument, 'read') as stage:
+                    subset = ma.asanyarray(self[v][zn, yn, xn])
+                    stage.count(subset)
+                with timed_stage(self.instrument, 'interpolate'):
+                    values = rectilinear_points(
+                            ma.filled(subset.astype('f8'), np.nan), (z, y, x))
+                dtype = subset.dtype
+            output[v] = as_masked(values, dtype)
+
+        return output
+
     def get_profile(var, doy, depth, lat, lon):
         print("get_profile is deprecated. You should migrate to extract()")
         return extract(var=var, doy=doy, depth=depth, lat=lat, lon=lon)
 
 
+class _filled_points(object):
+    """ Float values with NaN for the masked ones, like from cars_points
+    """
+    def __init__(self, data):
+        self.data = data
+        self.ndim = data.ndim
+
+    def __getitem__(self, item):
+        return ma.filled(self.data[item].astype('f8'), np.nan)
+
+
 class CARS(object):
     """
     """
-    def __init__(self, dbname='CARS'):
+    def __init__(self, dbname='CARS', preload=False, memo=None,
+            precompute=None, instrument=None):
         self.dbname = dbname
         self.data = {'sea_water_temperature': None,
                 'sea_water_salinity': None}
+        self.preload = preload
+        self.memo = memo
+        self.precompute = precompute
+        self.instrument = as_instrument(instrument)
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """Timings of the extractions, if instrumented (see Instrument)
+        """
+        if self.instrument is not None:
+            return self.instrument.stats
 
     def keys(self):
         return self.data.keys()
@@ -419,10 +1061,26 @@ class CARS(object):
         elif item == 'PSAL':
             return self['sea_water_salinity']
 
-        if self.data[item] is None:
-            self.data[item] = CARS_var_nc(source=dbsource(self.dbname, item))
+        with self._lock:
+            if self.data[item] is None:
+                with timed_stage(self.instrument, 'dbsource'):
+                    source = dbsource(self.dbname, item)
+                self.data[item] = CARS_var_nc(
+                    source=source, preload=self.preload,
+                    memo=as_memo(self.memo), precompute=self.precompute,
+                    instrument=self.instrument)
         return self.data[item]
 
+    def extract_many(self, variables, workers=None, **kwargs):
+        """Extract many variables concurrently, one thread for each
+
+           db.extract_many(['TEMP', 'PSAL'], doy=136.875, depth=[0, 10],
+                           lat=17.5, lon=322.5)
+
+           See utils.extract_many()
+        """
+        return extract_many(self, variables, workers=workers, **kwargs)
+
     def __enter__(self):
         return self
 
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+""" Coalesce concurrent point queries into fewer reads
+
+    Many threads asking for single profiles, like a web service, can share
+      the same database variable through a Coalescer:
+
+        db = WOA()
+        temp = Coalescer(db['TEMP'])
+        # in each thread
+        t = temp.extract(doy=136.875, depth=[0, 10], lat=17.5, lon=-37.5)
+
+    The queries arriving within window seconds are grouped by the
+      variables requested, and each group is extracted with a single
+      track(), i.e. a single read. The results are then dispatched back
+      to each caller, identical to an extract().
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class _Request(object):
+    """ One pending query, waiting for its output
+    """
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self.event = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class Coalescer(object):
+    """ Micro-batching of point and profile queries of a variable
+
+        var_nc is a variable of a database, like WOA()['TEMP'] or
+          CARS()['sea_water_temperature'], i.e. with track(). The first
+          query of a batch waits window seconds for others, or
+          until max_batch queries arrive, and then runs the whole batch.
+
+        Only linear interpolation (mode=None) of scalar doy, lat and lon
+          is coalesced, anything else goes straight to extract().
+
+        The counters in stats, number of requests, batches and groups
+          (reads), show how much the queries are being grouped.
+    """
+    def __init__(self, var_nc, window=0.001, max_batch=1024):
+        assert max_batch > 0
+        self.var_nc = var_nc
+        self.window = window
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = []
+        self._collecting = False
+        self.stats = {'requests': 0, 'batches': 0, 'groups': 0}
+
+    def keys(self):
+        return self.var_nc.keys()
+
+    def __getitem__(self, item):
+        return self.var_nc[item]
+
+    def extract(self, mode=None, **kwargs):
+        """ Same as the extract() of the variable, but coalesced
+        """
+        if (mode is not None) or (not self._mergeable(kwargs)):
+            return self.var_nc.extract(mode=mode, **kwargs)
+
+        request = _Request(kwargs)
+        with self._cond:
+            self.stats['requests'] += 1
+            self._pending.append(request)
+            leader = not self._collecting
+            if leader:
+                self._collecting = True
+            elif len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+
+        if leader:
+            with self._cond:
+                self._cond.wait_for(
+                        lambda: len(self._pending) >= self.max_batch,
+                        timeout=self.window)
+                batch, self._pending = self._pending, []
+                self._collecting = False
+            self.run(batch)
+
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def _mergeable(self, kwargs):
+        for k in kwargs:
+            if k not in ('var', 'doy', 'depth', 'lat', 'lon'):
+                return False
+        for k in ('doy', 'lat', 'lon'):
+            if k not in kwargs:
+                return False
+            value = np.asanyarray(kwargs[k])
+            if (value.size != 1) or (value.dtype.kind not in 'iuf'):
+                return False
+        if 'depth' in kwargs:
+            if np.asanyarray(kwargs['depth']).dtype.kind not in 'iuf':
+                return False
+        return True
+
+    def _key(self, kwargs):
+        """ Group of a query: its var
+        """
+        if 'var' in kwargs:
+            return tuple(np.atleast_1d(kwargs['var']).tolist())
+        return None
+
+    def run(self, batch):
+        """ Run a list of requests, grouped, setting their outputs
+        """
+        with self._cond:
+            self.stats['batches'] += 1
+        groups = OrderedDict()
+        for r in batch:
+            try:
+                groups.setdefault(self._key(r.kwargs), []).append(r)
+            except Exception:
+                self._run_one(r)
+
+        for requests in groups.values():
+            with self._cond:
+                self.stats['groups'] += 1
+            if len(requests) == 1:
+                self._run_one(requests[0])
+                continue
+            try:
+                self._run_group(requests)
+            except Exception:
+                for r in requests:
+                    if not r.event.is_set():
+                        self._run_one(r)
+
+    def _run_one(self, request):
+        try:
+            request.output = self.var_nc.extract(**request.kwargs)
+        except Exception as e:
+            request.error = e
+        request.event.set()
+
+    def _run_group(self, requests):
+        """ One track() with all the levels of all the requests
+        """
+        points = {'doy': [], 'depth': [], 'lat': [], 'lon': []}
+        for r in requests:
+            if 'depth' in r.kwargs:
+                depth = np.atleast_1d(r.kwargs['depth'])
+            else:
+                depth = self.var_nc.dims['depth'][:]
+            points['depth'].append(depth)
+            for k in ('doy', 'lat', 'lon'):
+                points[k].append(np.repeat(
+                    np.atleast_1d(r.kwargs[k]), depth.size))
+
+        kwargs = dict((k, np.concatenate(points[k])) for k in points)
+        if 'var' in requests[0].kwargs:
+            kwargs['var'] = requests[0].kwargs['var']
+        output = self.var_nc.track(**kwargs)
+
+        start = 0
+        for r, depth in zip(requests, points['depth']):
+            stop = start + depth.size
+            r.output = OrderedDict((v, output[v][start:stop]) for v in output)
+            start = stop
+        for r in requests:
+            r.event.set()
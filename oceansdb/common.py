@@ -1,7 +1,158 @@
 # -*- coding: utf-8 -*-
 
 
+import itertools
+
 import numpy as np
+from numpy import ma
+from scipy import sparse
+
+
+# Cyclic coordinates: longitude, and day of year of the climatologies
+PERIOD = {'lon': 360, 'time': 365.25}
+
+
+class GridAxis(object):
+    """ Precomputed index of one coordinate of a rectilinear grid
+
+        Built once per dataset (see load_dims()), it answers all the
+          bracketing queries along that axis with a binary search, without
+          rebuilding any auxiliary array. If period is given, the axis is
+          considered cyclic, like longitude (360) or day of year (365.25).
+
+          lon = GridAxis(nc['lon'][:], period=360)
+          i0, i1, w, valid = lon.weights([-38.2, 359.9])
+    """
+    def __init__(self, values, period=None):
+        self.values = np.array(values, dtype='f8')
+        self.values.flags.writeable = False
+        self.period = period
+        self.size = self.values.size
+
+        if (period is not None) and (self.size > 1):
+            n = self.size
+            # Grid registered datasets repeat the first position in the end.
+            if self.values[-1] - self.values[0] >= period:
+                n -= 1
+            self._n = n
+            self._wrap = np.append(self.values[:n], self.values[0] + period)
+            self._wrap.flags.writeable = False
+
+            # Extended around the axis, to crop across the discontinuity,
+            #   like a ship track with longitudes [352, 358, 364, 369].
+            self._ext = np.concatenate(
+                    [self.values + k * period for k in (-2, -1, 0, 1)])
+            self._ext.flags.writeable = False
+            self._ext_idx = np.tile(np.arange(self.size), 4)
+
+    def __len__(self):
+        return self.size
+
+    def weights(self, x):
+        """ Bracketing indices and linear weights of x on this axis
+
+            Returns i0, i1, w, valid, such that the linear interpolation of
+              a field f along this axis is (1 - w) * f[i0] + w * f[i1].
+
+            On a cyclic axis, x is wrapped around and there are no out of
+              bounds values. Otherwise, valid is False for the positions
+              outside the axis limits.
+        """
+        axis = self.values
+        x = np.asanyarray(x, dtype='f8')
+
+        if self.size == 1:
+            # Source has only one position, like the annual mean.
+            i0 = np.zeros(x.shape, dtype='i')
+            w = np.zeros(x.shape, dtype='f8')
+            if self.period is None:
+                valid = (x == axis[0])
+            else:
+                valid = np.ones(x.shape, dtype=bool)
+            return i0, i0, w, valid
+
+        if self.period is not None:
+            n = self._n
+            axis_ext = self._wrap
+            x = axis[0] + np.mod(x - axis[0], self.period)
+            i0 = np.clip(
+                    np.searchsorted(axis_ext, x, side='right') - 1, 0, n - 1)
+            w = (x - axis_ext[i0]) / (axis_ext[i0 + 1] - axis_ext[i0])
+            return i0, (i0 + 1) % n, w, np.ones(x.shape, dtype=bool)
+
+        valid = (x >= axis[0]) & (x <= axis[-1])
+        i0 = np.clip(
+                np.searchsorted(axis, x, side='right') - 1, 0, axis.size - 2)
+        w = (x - axis[i0]) / (axis[i0 + 1] - axis[i0])
+        w[~valid] = 0
+        return i0, i0 + 1, w, valid
+
+    def hyperslab(self, x):
+        """ Smallest hyperslab with the positions around each x
+
+            Same as hyperslab(self.weights(x)), but on a cyclic axis the
+              positions around x can go across the end of the axis, like
+              a longitude between the last and the first positions.
+        """
+        n = None
+        if (self.period is not None) and (self.size > 1):
+            n = self._n
+        return hyperslab(self.weights(x), cyclic=n)
+
+    def nearest(self, x):
+        """ Index of the nearest position on this axis for each x
+
+            Equivalent to np.absolute(axis - x).argmin() for each x. On a
+              non cyclic axis, x beyond the limits of the axis returns the
+              closest edge.
+        """
+        x = np.asanyarray(x, dtype='f8')
+        i0, i1, w, valid = self.weights(x)
+        idx = np.where(w > 0.5, i1, i0)
+        if self.period is None:
+            idx[x > self.values[-1]] = self.size - 1
+        return idx
+
+    def crop(self, xmin, xmax, closed=False):
+        """ Indices and coordinates of the positions around [xmin, xmax]
+
+            From the last position before xmin to the first one after
+              xmax, or including the positions equal to the limits if
+              closed. A non cyclic axis returns a slice, and a cyclic
+              one the list of indices, which can go around the axis, and
+              the coordinates extended accordingly (monotonic).
+
+            Raises ValueError if the range is not inside the axis.
+        """
+        side = ('right', 'left') if closed else ('left', 'right')
+
+        if self.period is None:
+            axis = self.values
+        elif self.size == 1:
+            return [0], self.values
+        else:
+            axis = self._ext
+
+        start = np.searchsorted(axis, xmin, side=side[0]) - 1
+        end = np.searchsorted(axis, xmax, side=side[1])
+        if (start < 0) or (end >= axis.size):
+            raise ValueError(
+                    "Range [%s, %s] beyond the grid limits" % (xmin, xmax))
+
+        if self.period is None:
+            idx = slice(start, end + 1)
+            return idx, np.atleast_1d(axis[idx])
+
+        coords, i = np.unique(axis[start:end + 1], return_index=True)
+        return self._ext_idx[start:end + 1][i].tolist(), coords
+
+
+def as_axis(axis, period=None):
+    """ GridAxis of the given coordinates, if it is not one already
+    """
+    if isinstance(axis, GridAxis):
+        return axis
+    return GridAxis(axis, period=period)
 
 
 def cropIndices(dims, lat, lon, depth=None, doy=None):
@@ -11,6 +162,9 @@ def cropIndices(dims, lat, lon, depth=None, doy=None):
           dims, this function return the indices to conform with
           the given coordinates (lat, lon, ...)
 
+        The dimensions can be coordinates arrays or, better, GridAxis
+          prebuilt once for the dataset.
+
         ATTENTION: To address a bug when only lat, or only lon, are coincident
           to the input, cropIndices is now taking one extra point around the
           required to cover the desired output. This is not the optimal
@@ -18,54 +172,465 @@ def cropIndices(dims, lat, lon, depth=None, doy=None):
     """
     dims_out = {}
     idx = {}
-    
-    yn = slice(
-            np.nonzero(dims['lat'] < lat.min())[0].max(),
-            np.nonzero(dims['lat'] > lat.max())[0].min() + 1)
-    dims_out['lat'] = np.atleast_1d(dims['lat'][yn])
-    idx['yn'] = yn
-
-    lon_ext = np.array(
-            (dims['lon'] - 2*360).tolist() +
-            (dims['lon'] - 360).tolist() +
-            dims['lon'].tolist() +
-            (dims['lon'] + 360).tolist())
-    xn_ext = list(4 * list(range(dims['lon'].shape[0])))
-    xn_start = np.nonzero(lon_ext < lon.min())[0].max()
-    xn_end = np.nonzero(lon_ext > lon.max())[0].min()
-    xn = xn_ext[xn_start:xn_end+1]
-    dims_out['lon'], i = np.unique(lon_ext[xn_start:xn_end+1], return_index=True)
-    idx['xn'] = [xn[ii] for ii in i]
+
+    idx['yn'], dims_out['lat'] = as_axis(dims['lat']).crop(
+            lat.min(), lat.max())
+
+    idx['xn'], dims_out['lon'] = as_axis(dims['lon'], period=360).crop(
+            lon.min(), lon.max())
 
     if depth is not None:
-        zn = slice(
-                np.nonzero(dims['depth'] <= depth.min())[0].max(),
-                np.nonzero(dims['depth'] >= min(dims['depth'].max(), depth.max())
-                    )[0].min() + 1
-                                                        )
+        axis = as_axis(dims['depth'])
         # If a higher degree interpolation system uses more than one data
         #   point in the edge, I should extend this selection one point on
         #   each side, without go beyond 0
-        # if zn.start < 0:
-        #    zn = slice(0, zn.stop, zn.step)
-        dims_out['depth'] = np.atleast_1d(dims['depth'][zn])
-        idx['zn'] = zn
+        idx['zn'], dims_out['depth'] = axis.crop(
+                depth.min(), min(axis.values.max(), depth.max()),
+                closed=True)
 
     if doy is not None:
-        # Source has only one time, like total mean field, or annual mean.
-        if dims['time'].shape == (1,):
-            dims_out['time'] = dims['time']
-            idx['tn'] = [0]
-        else:
-            time_ext = np.array(
-                    [dims['time'][-1] - 365.25] +
-                            dims['time'].tolist() +
-                            [dims['time'][0] + 365.25])
-            tn_ext = list(range(dims['time'].size))
-            tn_ext = [tn_ext[-1]] + tn_ext + [tn_ext[0]]
-            tn_start = np.nonzero(time_ext <= doy.min())[0].max()
-            tn_end = np.nonzero(time_ext >= doy.max())[0].min()
-            dims_out['time'] = np.atleast_1d(time_ext[tn_start:tn_end+1])
-            idx['tn'] = tn_ext[tn_start:tn_end+1]
+        idx['tn'], dims_out['time'] = as_axis(
+                dims['time'], period=365.25).crop(
+                        doy.min(), doy.max(), closed=True)
 
     return dims_out, idx
+
+
+def lerp(a, b, w):
+    """ Linear combination (1 - w) * a + w * b
+
+        A NaN is only propagated if its weight is not null, so positions
+          exactly on a grid point do not depend on its neighbor.
+    """
+    return np.where(w == 0, a, np.where(w == 1, b, (1 - w) * a + w * b))
+
+
+def horizontal_weighted(values, weights):
+    """ Weighted average of the valid (finite) horizontal corners
+
+        NaN aware bilinear interpolation. Given the values and weights of
+          each corner around the target, the invalid ones are ignored and
+          the weights of the remaining ones are renormalized. If there is
+          no valid corner with a non null weight, it returns NaN.
+    """
+    num = np.zeros(np.shape(values[0]), dtype='f8')
+    den = np.zeros(np.shape(values[0]), dtype='f8')
+    for v, w in zip(values, weights):
+        good = np.isfinite(v) & (w > 0)
+        num += np.where(good, v, 0) * w
+        den += np.where(good, w, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 0, num / den, np.nan)
+
+
+def hyperslab(weights, cyclic=None):
+    """ Smallest slice containing the required indices
+
+        Given the output of GridAxis.weights() for one axis, returns the
+          slice to read from the dataset, and the same weights with the
+          indices relative to that slice. Invalid positions (out of range)
+          are not considered.
+
+        On a cyclic axis with cyclic positions, like the longitude, the
+          indices can go across the end of the axis. In that case, instead
+          of a slice covering the whole axis, it returns the list of
+          indices, like [358, 359, 0, 1], as GridAxis.crop().
+    """
+    i0, i1, w, valid = weights
+    if not valid.any():
+        return slice(0, 1), (np.zeros_like(i0), np.zeros_like(i1), w, valid)
+
+    idx = np.unique(np.concatenate((i0[valid], i1[valid])))
+    start, stop = idx[0], idx[-1] + 1
+    if (cyclic is not None) and (idx.size > 1):
+        # The largest gap between the required indices, around the axis,
+        #   is left out. If it is the one across the end, it's a slice.
+        gaps = np.diff(np.append(idx, idx[0] + cyclic))
+        k = np.argmax(gaps)
+        if gaps[k] > gaps[-1]:
+            start = idx[k + 1]
+            n = (idx[k] + 1 - start) % cyclic
+            i0 = (i0 - start) % cyclic
+            i1 = (i1 - start) % cyclic
+            return (np.arange(start, start + n) % cyclic).tolist(), \
+                (i0.clip(0, n - 1), i1.clip(0, n - 1), w, valid)
+
+    n = stop - start
+    return slice(start, stop), \
+        ((i0 - start).clip(0, n - 1), (i1 - start).clip(0, n - 1), w, valid)
+
+
+def rectilinear(data, weights, horizontal=(-2, -1)):
+    """ Linear interpolation of a rectilinear grid, one axis at a time
+
+        data is an N-dimensional array with NaN for the missing values, and
+          weights a sequence with, for each axis of data, the output of
+          GridAxis.weights() or None to keep that axis as it is. The output
+          is the cartesian product of the requested coordinates.
+
+        On the horizontal axes the interpolation is NaN aware, i.e. the
+          masked corners are ignored and the weights of the valid ones
+          renormalized, so that coastal cells are still defined. Along
+          the other axes (time, depth), a NaN with a non null weight
+          results in NaN.
+    """
+    ndim = data.ndim
+    horizontal = [a % ndim for a in horizontal]
+
+    def expand(w, axis):
+        shape = [1] * ndim
+        shape[axis] = -1
+        return np.reshape(w, shape)
+
+    good = np.isfinite(data)
+    num = np.where(good, data, 0)
+    den = good.astype('f8')
+    for axis in horizontal:
+        if weights[axis] is None:
+            continue
+        i0, i1, w, valid = weights[axis]
+        w = expand(w, axis)
+        num = np.take(num, i0, axis) * (1 - w) + np.take(num, i1, axis) * w
+        den = np.take(den, i0, axis) * (1 - w) + np.take(den, i1, axis) * w
+    with np.errstate(invalid='ignore', divide='ignore'):
+        data = np.where(den > 0, num / den, np.nan)
+
+    for axis in range(ndim):
+        if (axis in horizontal) or (weights[axis] is None):
+            continue
+        i0, i1, w, valid = weights[axis]
+        data = lerp(np.take(data, i0, axis), np.take(data, i1, axis),
+                expand(w, axis))
+
+    # Outside the domain, like beyond the deepest level
+    for axis in range(ndim):
+        if (weights[axis] is not None) and not weights[axis][3].all():
+            idx = [slice(None)] * ndim
+            idx[axis] = ~weights[axis][3]
+            data[tuple(idx)] = np.nan
+
+    return data
+
+
+def rectilinear_points(data, weights, horizontal=(-2, -1)):
+    """ Linear interpolation of a rectilinear grid on scattered points
+
+        Similar to rectilinear(), but each axis has the weights for the
+          same N points, like a track, instead of a cartesian product.
+          Returns an array with N values.
+    """
+    ndim = data.ndim
+    horizontal = [a % ndim for a in horizontal]
+    strict = [a for a in range(ndim) if a not in horizontal]
+    valid = np.all([w[3] for w in weights], axis=0)
+
+    def corner(axis, side):
+        i0, i1, w, _ = weights[axis]
+        return (i1, w) if side else (i0, 1 - w)
+
+    output = np.zeros(valid.shape, dtype='f8')
+    for s_sides in itertools.product((0, 1), repeat=len(strict)):
+        idx = [None] * ndim
+        w_strict = np.ones(valid.shape, dtype='f8')
+        for axis, side in zip(strict, s_sides):
+            idx[axis], w = corner(axis, side)
+            w_strict = w_strict * w
+
+        values = []
+        w_horizontal = []
+        for h_sides in itertools.product((0, 1), repeat=len(horizontal)):
+            w_h = np.ones(valid.shape, dtype='f8')
+            for axis, side in zip(horizontal, h_sides):
+                idx[axis], w = corner(axis, side)
+                w_h = w_h * w
+            values.append(data[tuple(idx)])
+            w_horizontal.append(w_h)
+        value = horizontal_weighted(values, w_horizontal)
+        # A NaN only matters if it has some weight
+        output += np.where(w_strict > 0, value * w_strict, 0)
+
+    output[~valid] = np.nan
+    return output
+
+
+def rectilinear_profile(data, weights):
+    """ Linear interpolation of a single vertical profile
+
+        Same as rectilinear() on data (time, depth, lat, lon), like the
+          2 x 2 columns around the position at the bracketing times, but
+          for a single time, lat and lon, hence the horizontal and time
+          weights are applied only once for all the levels. The time
+          weights can be None if data has a single time. Returns the
+          values on the depths of weights[1].
+    """
+    t, z, y, x = weights
+    good = np.isfinite(data)
+    num = np.where(good, data, 0)
+    den = good.astype('f8')
+    # Horizontal, NaN aware. Same sequence of operations of rectilinear()
+    i0, i1, w, valid = y
+    w = w[0]
+    num = num[:, :, i0[0]] * (1 - w) + num[:, :, i1[0]] * w
+    den = den[:, :, i0[0]] * (1 - w) + den[:, :, i1[0]] * w
+    i0, i1, w, valid = x
+    w = w[0]
+    num = num[:, :, i0[0]] * (1 - w) + num[:, :, i1[0]] * w
+    den = den[:, :, i0[0]] * (1 - w) + den[:, :, i1[0]] * w
+    with np.errstate(invalid='ignore', divide='ignore'):
+        column = np.where(den > 0, num / den, np.nan)
+
+    if t is None:
+        column = column[0]
+    else:
+        column = lerp(column[t[0][0]], column[t[1][0]], t[2][0])
+
+    i0, i1, w, valid = z
+    values = lerp(column[i0], column[i1], w)
+    values[~valid] = np.nan
+    if not (y[3].all() and x[3].all() and (t is None or t[3].all())):
+        values[:] = np.nan
+    return values
+
+
+def cast_index(offsets, size):
+    """ Cast (profile) of each value of a ragged array
+
+        The values of the casts are concatenated in a flat array of size
+          values, with the i-th cast in [offsets[i], offsets[i + 1]), so
+          offsets has one more element than the number of casts.
+    """
+    offsets = np.asanyarray(offsets)
+    assert offsets.ndim == 1 and offsets.size > 0, \
+            "offsets must be 1D, with one more element than casts"
+    assert offsets.dtype.kind in 'iu', "offsets must be integers"
+    counts = np.diff(offsets)
+    assert (offsets[0] == 0) and (offsets[-1] == size) and \
+            np.all(counts >= 0), \
+            "offsets must increase from 0 to the number of depths"
+    return np.repeat(np.arange(counts.size), counts)
+
+
+def rectilinear_casts(data, weights, cast):
+    """ Linear interpolation of many profiles, each on its own depths
+
+        data is (time, depth, lat, lon), or (depth, lat, lon) if the time
+          weights are None, indexable with arrays of indices like in
+          rectilinear_points(), with NaN or masked for the missing values.
+          The time, lat and lon weights are for each of the N casts, and
+          the depth weights for each of the M depths, cast being the cast
+          of each depth (see cast_index()).
+
+        As in rectilinear_profile(), the columns around each cast are
+          interpolated on the horizontal and in time only once for all
+          the levels, all the casts together, and then on the depths of
+          each cast. Returns M values.
+    """
+    t, z, y, x = weights
+    nz = 1
+    if z[0].size > 0:
+        nz = int(max(z[0].max(), z[1].max())) + 1
+    levels = np.arange(nz)[np.newaxis]
+
+    def corner(tn, yn, xn):
+        idx = [yn[:, np.newaxis], xn[:, np.newaxis]]
+        idx = [levels] + idx if tn is None else \
+            [tn[:, np.newaxis], levels] + idx
+        c = data[tuple(np.broadcast_arrays(*idx))]
+        c = ma.filled(ma.asanyarray(c).astype('f8'), np.nan)
+        good = np.isfinite(c)
+        return np.where(good, c, 0), good.astype('f8')
+
+    wy = y[2][:, np.newaxis]
+    wx = x[2][:, np.newaxis]
+
+    def columns(tn):
+        # Horizontal, NaN aware. Same sequence of operations of rectilinear()
+        num, den = [], []
+        for xn in (x[0], x[1]):
+            n0, d0 = corner(tn, y[0], xn)
+            n1, d1 = corner(tn, y[1], xn)
+            num.append(n0 * (1 - wy) + n1 * wy)
+            den.append(d0 * (1 - wy) + d1 * wy)
+        num = num[0] * (1 - wx) + num[1] * wx
+        den = den[0] * (1 - wx) + den[1] * wx
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(den > 0, num / den, np.nan)
+
+    valid = y[3] & x[3]
+    if t is None:
+        column = columns(None)
+    else:
+        column = columns(t[0])
+        # The second time is only required where it has some weight
+        if np.any(t[2] != 0):
+            column = lerp(column, columns(t[1]), t[2][:, np.newaxis])
+        valid = valid & t[3]
+
+    i0, i1, w, z_valid = z
+    values = lerp(column[cast, i0], column[cast, i1], w)
+    values[~(z_valid & valid[cast])] = np.nan
+    return values
+
+
+class InterpolationPlan(object):
+    """ Indices and weights to interpolate on a fixed set of points
+
+        For the source axes (a dictionary of GridAxis with depth, lat and
+          lon), the hyperslab (zn, yn, xn) containing the N points (depth,
+          lat, lon), and the weights of each point relative to it, as from
+          hyperslab(). It doesn't depend on the time or the variable, so
+          the same plan can be applied to any day of year and variable of
+          the same grid, like for a fixed list of stations (see
+          WOA_var_nc.plan()). The masked corners depend on the data, so
+          they are handled when applied (see rectilinear_points()).
+
+        It can be saved into, and loaded from, a .npz file.
+    """
+    AXES = ('depth', 'lat', 'lon')
+    WEIGHTS = ('i0', 'i1', 'w', 'valid')
+
+    def __init__(self, axes, depth, lat, lon):
+        depth, lat, lon = np.broadcast_arrays(
+                np.atleast_1d(ma.getdata(depth)), np.atleast_1d(lat),
+                np.atleast_1d(lon))
+        self.source = [axes[d].values for d in self.AXES]
+        self.zn, self.z = axes['depth'].hyperslab(depth)
+        self.yn, self.y = axes['lat'].hyperslab(lat)
+        self.xn, self.x = axes['lon'].hyperslab(lon)
+
+    def __len__(self):
+        return self.z[0].size
+
+    def matches(self, axes):
+        """ True if this plan was computed for the grid of axes
+        """
+        return all(np.array_equal(v, axes[d].values) for v, d in
+                zip(self.source, self.AXES))
+
+    def save(self, file):
+        """ Save as .npz into file, a filename or an open file
+        """
+        arrays = {}
+        for d, v, n, w in zip(self.AXES, self.source,
+                (self.zn, self.yn, self.xn), (self.z, self.y, self.x)):
+            arrays['source_' + d] = v
+            if isinstance(n, slice):
+                arrays[d + '_slice'] = [n.start, n.stop]
+            else:
+                arrays[d + '_index'] = n
+            for k, a in zip(self.WEIGHTS, w):
+                arrays['%s_%s' % (d, k)] = a
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        """ A plan saved with save()
+        """
+        plan = cls.__new__(cls)
+        with np.load(file) as data:
+            plan.source = [data['source_' + d] for d in cls.AXES]
+            for d, attr in zip(cls.AXES, ('z', 'y', 'x')):
+                if d + '_slice' in data:
+                    start, stop = data[d + '_slice']
+                    n = slice(int(start), int(stop))
+                else:
+                    n = data[d + '_index'].tolist()
+                setattr(plan, attr + 'n', n)
+                setattr(plan, attr, tuple(
+                    data['%s_%s' % (d, k)] for k in cls.WEIGHTS))
+        return plan
+
+
+class RegridWeights(object):
+    """ Linear interpolation of a rectilinear grid onto a target grid
+
+        Precomputes, for the source axes (a dictionary of GridAxis with
+          depth, lat and lon), the weights to interpolate onto the
+          cartesian product of the target depth, lat and lon. The
+          horizontal weights are sparse matrices, one for lat and one for
+          lon (target x source positions of the hyperslab yn, xn),
+          applied to every level and time at once, and the vertical ones
+          are the same as rectilinear().
+
+        They depend only on the grid, so the same weights can be used for
+          any variable of the same grid (see WOA_var_nc.regrid()).
+
+          w = RegridWeights(axes, lat, lon, depth)
+          values = w.apply(data[:, w.zn, w.yn, w.xn])
+    """
+    def __init__(self, axes, lat, lon, depth):
+        depth = np.atleast_1d(ma.getdata(depth))
+        self.source = [axes[d].values for d in ('depth', 'lat', 'lon')]
+        self.zn, self.z = axes['depth'].hyperslab(depth)
+        self.yn, self.lat_matrix = self._matrix(axes['lat'], lat)
+        self.xn, self.lon_matrix = self._matrix(axes['lon'], lon)
+        self.shape = (depth.size, self.lat_matrix.shape[0],
+                self.lon_matrix.shape[0])
+
+    @staticmethod
+    def _matrix(axis, x):
+        """ Hyperslab of axis, and the sparse weights of each x on it
+        """
+        n, (i0, i1, w, valid) = axis.hyperslab(np.atleast_1d(x))
+        rows = np.arange(w.size)[valid]
+        # Out of the domain has no weights, hence it results in NaN
+        matrix = sparse.csr_matrix(
+                (np.concatenate(((1 - w)[valid], w[valid])),
+                    (np.concatenate((rows, rows)),
+                        np.concatenate((i0[valid], i1[valid])))),
+                shape=(w.size, np.arange(axis.size)[n].size))
+        return n, matrix
+
+    def matches(self, axes):
+        """ True if these weights were computed for the grid of axes
+        """
+        return all(np.array_equal(v, axes[d].values) for v, d in
+                zip(self.source, ('depth', 'lat', 'lon')))
+
+    def apply(self, data, t=None):
+        """ Interpolate data (time, depth, lat, lon) on the target grid
+
+            data is the hyperslab (zn, yn, xn) of the source, for each
+              time, with NaN for the missing values. The horizontal
+              interpolation is NaN aware, with the same sequence of
+              operations of rectilinear(). If given, the time weights t,
+              like from GridAxis.weights(), interpolate the times of data,
+              otherwise each one is kept.
+
+            Returns an array (time, depth, lat, lon) of the target grid.
+        """
+        T, Z, Y, X = data.shape
+        Z, ny, nx = (Z,) + self.shape[1:]
+
+        def horizontal(a):
+            a = self.lat_matrix.dot(a.transpose(2, 0, 1, 3).reshape(Y, -1))
+            a = a.reshape(ny, T, Z, X).transpose(3, 1, 2, 0).reshape(X, -1)
+            a = self.lon_matrix.dot(a)
+            return a.reshape(nx, T, Z, ny).transpose(1, 2, 3, 0)
+
+        good = np.isfinite(data)
+        num = horizontal(np.where(good, data, 0))
+        den = horizontal(good.astype('f8'))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            data = np.where(den > 0, num / den, np.nan)
+
+        if t is not None:
+            i0, i1, w, valid = t
+            data = lerp(data[i0], data[i1], w[:, None, None, None])
+            data[~valid] = np.nan
+
+        i0, i1, w, valid = self.z
+        data = lerp(data[:, i0], data[:, i1], w[None, :, None, None])
+        data[:, ~valid] = np.nan
+        return data
+
+
+def as_masked(values, dtype):
+    """ Masked array of type dtype from values with NaN as missing values
+
+        Integer types, like the number of observations, are rounded.
+    """
+    if np.dtype(dtype).kind in 'iu':
+        values = np.round(values)
+    idx = np.isfinite(values)
+    return ma.array(np.where(idx, values, 0).astype(dtype), mask=~idx)
@@ -3,12 +3,16 @@
 """ Module to handle ETOPO bathymetry
 """
 
+import threading
+
 import numpy as np
 from numpy import ma
 import netCDF4
 
-from .utils import dbsource
-from .common import cropIndices
+from .utils import dbsource, TileCache, stream_track
+from .utils import as_instrument, timed_call, timed_stage
+from .common import cropIndices, GridAxis, PERIOD
+from .common import rectilinear, horizontal_weighted, as_masked
 
 from scipy.interpolate import griddata
 
@@ -72,9 +76,17 @@ def get_depth(lat, lon, cfg):
 class ETOPO_var_nc(object):
     """
     ETOPO global topography
+
+    The data is read in tiles of tile_size x tile_size gridpoints, kept in
+    a LRU cache of up to cache_size bytes (see utils.TileCache), so that
+    neighbour lookups, like along a track, don't read the file again. The
+    usage of the cache is available at .tiles.stats
     """
-    def __init__(self, source):
+    def __init__(self, source, tile_size=256, cache_size=64 * 2**20,
+            instrument=None):
         self.ncs = source
+        self.instrument = instrument
+        self.tiles = TileCache(tile_size=tile_size, max_bytes=cache_size)
 
         self.load_dims(dims=['lat', 'lon'])
         self.set_keys()
@@ -102,6 +114,11 @@ class ETOPO_var_nc(object):
             for nc in self.ncs[1:]:
                 assert (self.dims[d] == nc[d][:]).all()
 
+        self.axes = {}
+        for d in self.dims:
+            if np.size(self.dims[d]) > 0:
+                self.axes[d] = GridAxis(self.dims[d], period=PERIOD.get(d))
+
     def set_keys(self):
         self.KEYS = ['height']
 
@@ -120,32 +137,72 @@ class ETOPO_var_nc(object):
                of series. For example, a ship track can be requested with
                a longitude sequence like [352, 358, 364, 369, 380].
         """
-        dims, idx = cropIndices(self.dims, lat, lon)
+        with timed_stage(self.instrument, 'cropIndices'):
+            dims, idx = cropIndices(self.axes, lat, lon)
         subset = {}
         for v in var:
-            subset = {v: self.ncs[0][v][idx['yn'], idx['xn']]}
+            with timed_stage(self.instrument, 'read') as stage:
+                subset[v] = self.tiles.read(
+                        self.ncs[0][v], idx['yn'], idx['xn'])
+                stage.count(subset[v])
         return subset, dims
 
     def nearest(self, lat, lon, var):
+        """ Nearest value of each var on the coordinates requested
+
+            The indices are obtained with a binary search on each axis,
+              considering the cyclic longitude, hence the output is filled
+              at once from the smallest hyperslab that contains all the
+              required grid points, with only the longitudes required.
+        """
+        yn = self.axes['lat'].nearest(lat)
+        xn = self.axes['lon'].nearest(lon)
+
+        yn_in = slice(yn.min(), yn.max() + 1)
+        # Only the longitudes required, even across the end of the axis
+        xn_in, xn_out = np.unique(xn, return_inverse=True)
+        xn_in = xn_in.tolist()
+        idx = np.ix_(yn - yn_in.start, np.ravel(xn_out))
+
         output = {}
-        dims, idx = cropIndices(self.dims, lat, lon)
         for v in var:
-            if v == 'height':
-                v = 'z'
-            subset = self.ncs[0].variables[v][idx['yn'], idx['xn']]
-            output[v] = ma.masked_all((lat.size, lon.size), dtype='f')
-            for yn_out, y in enumerate(lat):
-                yn_in = np.absolute(dims['lat']-y).argmin()
-                for xn_out, x in enumerate(lon):
-                    xn_in = np.absolute(dims['lon']-x).argmin()
-                    output[v][yn_out, xn_out] = subset[yn_in, xn_in]
+            with timed_stage(self.instrument, 'read') as stage:
+                subset = self.tiles.read(self.ncs[0][v], yn_in, xn_in)
+                stage.count(subset)
+            output[v] = ma.asanyarray(subset[idx], dtype='f')
         return output
 
-    def interpolate(self, lat, lon, var):
+    def interpolate(self, lat, lon, var, mode=None):
         """ Interpolate each var on the coordinates requested
 
+            The default is a bilinear interpolation on the rectilinear
+              grid, ignoring the masked corners (see common.rectilinear()).
+
+            With mode='griddata' it uses the previous interpolator, which
+              triangulates the valid data with scipy.interpolate.griddata.
         """
+        if mode == 'griddata':
+            with timed_stage(self.instrument, 'griddata'):
+                return self._interpolate_griddata(lat, lon, var)
+
+        yn, y = self.axes['lat'].hyperslab(lat)
+        xn, x = self.axes['lon'].hyperslab(lon)
 
+        output = {}
+        for v in var:
+            with timed_stage(self.instrument, 'read') as stage:
+                subset = self.tiles.read(self.ncs[0][v], yn, xn)
+                stage.count(subset)
+            with timed_stage(self.instrument, 'interpolate'):
+                values = rectilinear(
+                        ma.filled(subset.astype('f8'), np.nan), (y, x))
+                output[v] = as_masked(values, subset.dtype)
+
+        return output
+
+    def _interpolate_griddata(self, lat, lon, var):
+        """ Interpolate each var using scipy's griddata
+        """
         subset, dims = self.crop(lat, lon, var)
 
         if np.all([y in dims['lat'] for y in lat]) & \
@@ -207,6 +264,10 @@ class ETOPO_var_nc(object):
             Possible scenarios:
               - Track:   doy{1,n}, depth{1,n2}, lat{n}, lon{n}
         """
+        with timed_call(self.instrument, 'track'):
+            return self._track(mode=mode, **kwargs)
+
+    def _track(self, mode=None, **kwargs):
         for k in kwargs:
             assert k in ['var', 'lat', 'lon'], \
                     "Wrong dimension to extract, check the manual"
@@ -221,6 +282,11 @@ class ETOPO_var_nc(object):
 
         assert lat.shape == lon.shape
 
+        if mode is None:
+            return self._linear_track(lat, lon, var)
+        elif mode == 'nearest':
+            return self._nearest_track(lat, lon, var)
+
         output = {}
         for v in var:
             output[v] = []
@@ -231,7 +297,7 @@ class ETOPO_var_nc(object):
                         np.array([y]), np.array([x]), var)
             else:
                 tmp = self.interpolate(
-                        np.array([y]), np.array([x]), var)
+                        np.array([y]), np.array([x]), var, mode=mode)
 
             for v in tmp:
                 output[v].append(tmp[v])
@@ -241,6 +307,67 @@ class ETOPO_var_nc(object):
 
         return output
 
+    def stream(self, records, chunk_size=1024, mode=None, var=None):
+        """ Values along an iterable of (lat, lon), possibly unbounded
+
+            The records, (lat, lon) or dictionaries with those keys, are
+              consumed lazily, chunk_size at a time, each chunk evaluated
+              with a single track(). Yields a dictionary with the values of
+              each var for each record, in the same order.
+        """
+        kwargs = {'mode': mode}
+        if var is not None:
+            kwargs['var'] = var
+        return stream_track(self.track, records, ('lat', 'lon'), chunk_size,
+                **kwargs)
+
+    def _linear_track(self, lat, lon, var):
+        """ Bilinear interpolation of each var along a track, at once
+
+            The indices and weights of all the points are obtained
+              together, considering the cyclic longitude, and the corners
+              are read from the tiles in memory (see utils.TileCache), so
+              only the tiles around the track are ever read. The masked
+              corners are ignored, renormalizing the weights of the valid
+              ones, as in interpolate().
+        """
+        y = self.axes['lat'].weights(lat)
+        x = self.axes['lon'].weights(lon)
+        corners = [(yn, xn, wy * wx)
+                for yn, wy in ((y[0], 1 - y[2]), (y[1], y[2]))
+                for xn, wx in ((x[0], 1 - x[2]), (x[1], x[2]))]
+
+        output = {}
+        for v in var:
+            values = []
+            with timed_stage(self.instrument, 'read') as stage:
+                for yn, xn, w in corners:
+                    values.append(self.tiles.take(self.ncs[0][v], yn, xn))
+                    stage.count(values[-1])
+            dtype = values[0].dtype
+            with timed_stage(self.instrument, 'interpolate'):
+                values = horizontal_weighted(
+                        [ma.filled(c.astype('f8'), np.nan) for c in values],
+                        [w for yn, xn, w in corners])
+                values[~(y[3] & x[3])] = np.nan
+                output[v] = as_masked(values, dtype)
+
+        return output
+
+    def _nearest_track(self, lat, lon, var):
+        """ Nearest value of each var along a track, at once
+        """
+        yn = self.axes['lat'].nearest(lat)
+        xn = self.axes['lon'].nearest(lon)
+
+        output = {}
+        for v in var:
+            with timed_stage(self.instrument, 'read') as stage:
+                output[v] = ma.asanyarray(
+                        self.tiles.take(self.ncs[0][v], yn, xn), dtype='f')
+                stage.count(output[v])
+        return output
+
     def extract(self, mode=None, **kwargs):
         """
 
@@ -250,6 +377,10 @@ class ETOPO_var_nc(object):
 
               - Track:   lat{n},lon{n}
         """
+        with timed_call(self.instrument, 'extract'):
+            return self._extract(mode=mode, **kwargs)
+
+    def _extract(self, mode=None, **kwargs):
         for k in kwargs:
             assert k in ['var', 'lat', 'lon'], \
                     "Wrong dimension to extract, check the manual"
@@ -265,7 +396,7 @@ class ETOPO_var_nc(object):
         if mode == 'nearest':
             output = self.nearest(lat, lon, var)
         else:
-            output = self.interpolate(lat, lon, var)
+            output = self.interpolate(lat, lon, var, mode=mode)
             for v in output:
                 output[v] = np.atleast_1d(np.squeeze(output[v]))
 
@@ -275,10 +406,22 @@ class ETOPO_var_nc(object):
 class ETOPO(ETOPO_var_nc):
     """
     """
-    def __init__(self, dbname='ETOPO', resolution=None):
+    def __init__(self, dbname='ETOPO', resolution=None, tile_size=256,
+            cache_size=64 * 2**20, instrument=None):
         self.dbname = dbname
         self.data = {'topography': None}
         self.resolution = resolution
+        self.tile_size = tile_size
+        self.cache_size = cache_size
+        self.instrument = as_instrument(instrument)
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """Timings of the extractions, if instrumented (see Instrument)
+        """
+        if self.instrument is not None:
+            return self.instrument.stats
 
     def keys(self):
         return self.data.keys()
@@ -290,9 +433,13 @@ class ETOPO(ETOPO_var_nc):
             time.sleep(3)
             return self['topography']
 
-        if self.data[item] is None:
-            self.data[item] = ETOPO_var_nc(source=dbsource(
-                self.dbname, item, self.resolution))
+        with self._lock:
+            if self.data[item] is None:
+                with timed_stage(self.instrument, 'dbsource'):
+                    source = dbsource(self.dbname, item, self.resolution)
+                self.data[item] = ETOPO_var_nc(source=source,
+                    tile_size=self.tile_size, cache_size=self.cache_size,
+                    instrument=self.instrument)
         return self.data[item]
 
     def __enter__(self):
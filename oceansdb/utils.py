@@ -8,11 +8,24 @@ import os
 import sys
 import pkg_resources
 import json
+import hashlib
+import tempfile
+import threading
+import time
+import shutil
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 
+import numpy as np
+from numpy import ma
 from netCDF4 import Dataset
 
 from supportdata import download_file
 
+from .common import InterpolationPlan
+
 if sys.version_info >= (3, 0):
     from urllib.parse import urlparse
 else:
@@ -45,44 +58,1227 @@ def oceansdb_dir():
     return os.path.expanduser(dbpath).replace('/', os.path.sep)
 
 
+# HDF5, under netCDF4, is not thread-safe, not even for different files,
+#   hence all the calls to the library are serialized with this lock.
+netcdf_lock = threading.RLock()
+
+
+class LockedVariable(object):
+    """A netCDF variable that can be read concurrently by many threads
+
+       Every access to the netCDF library (reading the data or the
+       attributes) holds netcdf_lock, while the returned arrays can be
+       processed by each thread in parallel.
+    """
+    def __init__(self, variable):
+        self.variable = variable
+
+    def __getattr__(self, name):
+        if name == 'variable':
+            raise AttributeError(name)
+        with netcdf_lock:
+            return getattr(self.variable, name)
+
+    def __getitem__(self, item):
+        with netcdf_lock:
+            return self.variable[item]
+
+    def __len__(self):
+        with netcdf_lock:
+            return len(self.variable)
+
+
+class DatasetPool(object):
+    """Process-wide pool of open netCDF datasets
+
+       Each file is opened only once and shared by all the database
+       objects (Dataset_flex) using it, with a reference counter. When
+       released by all of them, the dataset is kept open for a future use,
+       and the least recently used ones are closed when there are more
+       than max_open files open. Datasets in use are never closed.
+    """
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._datasets = OrderedDict()
+        self._refcount = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def __contains__(self, filename):
+        return os.path.abspath(filename) in self._datasets
+
+    def acquire(self, filename):
+        """Return the dataset for filename, opening it if required
+        """
+        key = os.path.abspath(filename)
+        with self._lock:
+            if key in self._datasets:
+                self._datasets.move_to_end(key)
+            else:
+                with netcdf_lock:
+                    self._datasets[key] = Dataset(filename, mode='r')
+                self._refcount[key] = 0
+            self._refcount[key] += 1
+            self._evict()
+            return self._datasets[key]
+
+    def release(self, filename):
+        """Release one reference to filename, keeping it open if possible
+        """
+        key = os.path.abspath(filename)
+        with self._lock:
+            self._refcount[key] -= 1
+            assert self._refcount[key] >= 0, \
+                    "Released more than acquired: %s" % filename
+            self._evict()
+
+    def refcount(self, filename):
+        return self._refcount.get(os.path.abspath(filename), 0)
+
+    def _evict(self):
+        idle = [k for k in self._datasets if self._refcount[k] == 0]
+        while (len(self._datasets) > self.max_open) and idle:
+            self._close(idle.pop(0))
+
+    def _close(self, key):
+        with netcdf_lock:
+            self._datasets.pop(key).close()
+        del self._refcount[key]
+
+    def clear(self):
+        """Close all the datasets not in use
+        """
+        with self._lock:
+            for k in [k for k in self._datasets if self._refcount[k] == 0]:
+                self._close(k)
+
+
+pool = DatasetPool()
+
+
+class TileCache(object):
+    """LRU cache of fixed size tiles of 2D variables, like a topography
+
+       A hyperslab is assembled from square tiles of tile_size x
+       tile_size gridpoints, read whole from the dataset the first time
+       they are required and kept in memory for the following reads,
+       so that repeated and neighbouring lookups don't require any I/O.
+       The least recently used tiles are dropped when the cache is
+       larger than max_bytes.
+
+       The counters hits, misses and evictions (see stats) allow to size
+       the cache for a given usage.
+    """
+    def __init__(self, tile_size=256, max_bytes=64 * 2**20):
+        assert tile_size > 0
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def tile(self, variable, ty, tx):
+        """Tile (ty, tx) of a variable, as a masked array
+        """
+        key = (variable.name, ty, tx)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key][0]
+            self.misses += 1
+
+        ts = self.tile_size
+        tile = ma.asanyarray(
+                variable[ty * ts:(ty + 1) * ts, tx * ts:(tx + 1) * ts])
+        nbytes = tile.nbytes
+        if tile.mask is not ma.nomask:
+            nbytes += tile.mask.nbytes
+
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = (tile, nbytes)
+                self.nbytes += nbytes
+                while (self.nbytes > self.max_bytes) and \
+                        (len(self._tiles) > 1):
+                    _, (_, n) = self._tiles.popitem(last=False)
+                    self.nbytes -= n
+                    self.evictions += 1
+        return tile
+
+    def read(self, variable, yn, xn):
+        """Read variable[yn, xn] from the tiles
+
+           yn and xn can be slices or sequences of indices, and each
+           dimension is indexed independently, like a netCDF variable.
+        """
+        ny, nx = variable.shape
+        yi = np.atleast_1d(np.arange(ny)[yn])
+        xi = np.atleast_1d(np.arange(nx)[xn])
+
+        ts = self.tile_size
+        output = ma.masked_all((yi.size, xi.size), dtype=variable.dtype)
+        for ty in np.unique(yi // ts):
+            rows = np.nonzero(yi // ts == ty)[0]
+            for tx in np.unique(xi // ts):
+                cols = np.nonzero(xi // ts == tx)[0]
+                tile = self.tile(variable, ty, tx)
+                output[np.ix_(rows, cols)] = tile[
+                        np.ix_(yi[rows] - ty * ts, xi[cols] - tx * ts)]
+        return output
+
+    def take(self, variable, yi, xi):
+        """Values of variable at the scattered points (yi, xi)
+
+           The points are grouped by tile, so each tile required is
+           fetched only once.
+        """
+        yi = np.asarray(yi)
+        xi = np.asarray(xi)
+        ts = self.tile_size
+        ntx = -(-variable.shape[1] // ts)
+        key = (yi // ts) * ntx + (xi // ts)
+
+        output = ma.masked_all(yi.shape, dtype=variable.dtype)
+        order = np.argsort(key, kind='stable')
+        splits = np.flatnonzero(np.diff(key[order])) + 1
+        for sel in np.split(order, splits):
+            if sel.size == 0:
+                continue
+            ty, tx = divmod(int(key[sel[0]]), ntx)
+            tile = self.tile(variable, ty, tx)
+            output[sel] = tile[yi[sel] - ty * ts, xi[sel] - tx * ts]
+        return output
+
+    @property
+    def stats(self):
+        """Counters of usage of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'tiles': len(self._tiles),
+                    'nbytes': self.nbytes}
+
+    def clear(self):
+        """Drop all the tiles and reset the counters
+        """
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+class MemoCache(object):
+    """LRU cache of the outputs of extract() and track()
+
+       The key of an output is the method, mode and arguments, with the
+       coordinates rounded to multiples of tolerance, so that repeated
+       requests, like re-transmitted profiles, are not interpolated
+       again. Requests within the tolerance share the output of the
+       first one. Coordinates that are not numbers, like datetimes, are
+       not cached.
+
+       The least recently used outputs are dropped when there are more
+       than max_entries, or when larger than max_bytes. The counters
+       hits, misses and evictions are in stats.
+    """
+    def __init__(self, max_entries=1024, max_bytes=64 * 2**20,
+            tolerance=1e-6):
+        assert max_entries > 0
+        assert tolerance > 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        """Pickled empty, only its options
+        """
+        return {'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes, 'tolerance': self.tolerance}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def key(self, method, mode, kwargs):
+        """Key of a request, or None if it can't be cached
+        """
+        key = [method, mode]
+        for k in sorted(kwargs):
+            value = np.asanyarray(kwargs[k])
+            if k == 'var':
+                if value.dtype.kind not in 'US':
+                    return None
+                key.append((k, tuple(value.ravel().tolist())))
+            elif value.dtype.kind in 'iuf':
+                q = np.round(value.astype('f8') / self.tolerance)
+                key.append((k, value.shape, q.astype('i8').tobytes()))
+            else:
+                return None
+        return tuple(key)
+
+    def get(self, key):
+        """A copy of the output cached with key, or None
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            output = self._entries[key][0]
+        return OrderedDict((v, output[v].copy()) for v in output)
+
+    def put(self, key, output):
+        """Keep a copy of output
+        """
+        output = OrderedDict((v, output[v].copy()) for v in output)
+        nbytes = 0
+        for v in output:
+            nbytes += output[v].nbytes
+            if ma.getmask(output[v]) is not ma.nomask:
+                nbytes += output[v].mask.nbytes
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (output, nbytes)
+            self.nbytes += nbytes
+            while (len(self._entries) > self.max_entries) or \
+                    (self.nbytes > self.max_bytes):
+                _, (_, n) = self._entries.popitem(last=False)
+                self.nbytes -= n
+                self.evictions += 1
+
+    def call(self, method, function, mode, kwargs):
+        """Output of function(mode=mode, **kwargs), cached
+
+           method is the name that identifies function in the key, like
+           'extract' or 'track', or a tuple with the source too, like
+           ('extract', filename), when the memo is shared.
+        """
+        key = self.key(method, mode, kwargs)
+        if key is None:
+            return function(mode=mode, **kwargs)
+        output = self.get(key)
+        if output is None:
+            output = function(mode=mode, **kwargs)
+            self.put(key, output)
+        return output
+
+    @property
+    def stats(self):
+        """Counters of usage of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries), 'nbytes': self.nbytes}
+
+    def clear(self):
+        """Drop all the outputs and reset the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+def as_memo(memo):
+    """A new MemoCache from the memo option of a database
+
+       False or None for no cache, True for the default one, a dict
+       with the arguments of MemoCache, like {'tolerance': 1e-3}, or a
+       MemoCache, to be shared.
+    """
+    if memo is None or memo is False:
+        return None
+    elif memo is True:
+        return MemoCache()
+    elif isinstance(memo, MemoCache):
+        return memo
+    return MemoCache(**memo)
+
+
+class _Untimed(object):
+    """Does nothing, in place of a stage when not instrumented
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+    def count(self, data):
+        pass
+
+
+_untimed = _Untimed()
+
+
+class _Stage(object):
+    """Time spent in a stage, and the data read there (see Instrument)
+    """
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.instrument._add(
+                'stages', self.name, time.perf_counter() - self.start)
+        return False
+
+    def count(self, data):
+        """Record the bytes and cells (gridpoints) of data as read
+        """
+        self.instrument._add('bytes', None, data.nbytes)
+        self.instrument._add('cells', None, data.size)
+
+
+class _Call(object):
+    """One call, like extract(), with all its stages (see Instrument)
+    """
+    def __init__(self, instrument, method):
+        self.instrument = instrument
+        self.method = method
+        self.record = None
+
+    def __enter__(self):
+        local = self.instrument._local
+        # Calls within a call, like a track() point by point, are stages
+        if getattr(local, 'record', None) is None:
+            self.record = {'method': self.method, 'seconds': 0.,
+                    'stages': {}, 'bytes': 0, 'cells': 0}
+            local.record = self.record
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.record is not None:
+            self.record['seconds'] = time.perf_counter() - self.start
+            self.instrument._local.record = None
+            self.instrument._done(self.record)
+        return False
+
+
+class Instrument(object):
+    """Timings of the stages of the extractions, opt-in
+
+       Each call of extract(), track() or profile() results in a record
+       with the method, the total seconds, the seconds of each stage, and
+       the bytes and cells (gridpoints) read:
+
+           {'method': 'extract', 'seconds': 0.002,
+            'stages': {'read': 0.0015, 'interpolate': 0.0004},
+            'bytes': 912, 'cells': 228}
+
+       The stages are dbsource (locating, verifying or downloading the
+       data files), cropIndices, read, harmonics (CARS), interpolate and
+       griddata, which includes its own reads. Each record is given to
+       callback, if any, like to export to a metrics system, and the
+       totals are accumulated in stats. A stage outside of a call, like
+       dbsource when a variable is first used, goes only to the stats.
+
+       When a database is not instrumented, each stage costs a function
+       call (see timed_stage()).
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __getstate__(self):
+        """Pickled empty and without callback, like to another process
+        """
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def call(self, method):
+        return _Call(self, method)
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    @staticmethod
+    def _accumulate(totals, key, name, value):
+        if name is None:
+            totals[key] += value
+        else:
+            totals[key][name] = totals[key].get(name, 0) + value
+
+    def _add(self, key, name, value):
+        """Add to the current call, or straight to the stats if none
+        """
+        record = getattr(self._local, 'record', None)
+        if record is not None:
+            self._accumulate(record, key, name, value)
+        else:
+            with self._lock:
+                self._accumulate(self._stats, key, name, value)
+
+    def _done(self, record):
+        with self._lock:
+            self._accumulate(self._stats, 'calls', record['method'], 1)
+            for key in ('seconds', 'bytes', 'cells'):
+                self._accumulate(self._stats, key, None, record[key])
+            for name, seconds in record['stages'].items():
+                self._accumulate(self._stats, 'stages', name, seconds)
+        if self.callback is not None:
+            self.callback(record)
+
+    @property
+    def stats(self):
+        """Totals: calls of each method, seconds, seconds of each stage,
+           bytes and cells
+        """
+        with self._lock:
+            return {'calls': dict(self._stats['calls']),
+                    'seconds': self._stats['seconds'],
+                    'stages': dict(self._stats['stages']),
+                    'bytes': self._stats['bytes'],
+                    'cells': self._stats['cells']}
+
+    def clear(self):
+        """Reset the totals
+        """
+        with self._lock:
+            self._stats = {'calls': {}, 'seconds': 0., 'stages': {},
+                    'bytes': 0, 'cells': 0}
+
+
+def as_instrument(instrument):
+    """An Instrument from the instrument option of a database
+
+       False or None for no instrumentation, True for one that only keeps
+       the stats, a callable to receive each record, or an Instrument.
+    """
+    if instrument is None or instrument is False:
+        return None
+    elif instrument is True:
+        return Instrument()
+    elif isinstance(instrument, Instrument):
+        return instrument
+    return Instrument(callback=instrument)
+
+
+def timed_call(instrument, method):
+    """Context of a call, like extract(), if instrumented
+    """
+    if instrument is None:
+        return _untimed
+    return instrument.call(method)
+
+
+def timed_stage(instrument, name):
+    """Context of a stage, like read, if instrumented
+
+           with timed_stage(self.instrument, 'read') as stage:
+               subset = self.ncs[0][v][zn, yn, xn]
+               stage.count(subset)
+    """
+    if instrument is None:
+        return _untimed
+    return instrument.stage(name)
+
+
+def orthogonal_index(data, item):
+    """Index an array like a netCDF variable
+
+       netCDF variables index each dimension independently (orthogonal
+       indexing), which differs from numpy when integers and sequences are
+       combined, like [0, :, :, [71, 0, 1]]. Returns always a copy, of
+       only the elements selected.
+    """
+    if not isinstance(item, tuple):
+        item = (item,)
+
+    basic = []
+    fancy = []
+    axis = 0
+    for i in item:
+        if isinstance(i, (int, np.integer)):
+            basic.append(i)
+        elif isinstance(i, slice):
+            basic.append(i)
+            axis += 1
+        else:
+            i = np.asanyarray(i)
+            if i.dtype == bool:
+                i = np.nonzero(i)[0]
+            basic.append(slice(None))
+            fancy.append((axis, i))
+            axis += 1
+
+    output = data[tuple(basic)]
+    if len(fancy) > 1:
+        # At once, instead of copying the output of each np.take()
+        idx = [np.arange(n) for n in output.shape]
+        for axis, i in fancy:
+            idx[axis] = i
+        return output[np.ix_(*idx)]
+    for axis, i in fancy:
+        output = np.take(output, i, axis=axis)
+    return np.array(output)
+
+
+class ArrayVariable(object):
+    """A netCDF variable held in memory
+
+       Behaves like the original netCDF variable for reading, returning
+       masked arrays, but without any I/O. The data and the mask can be
+       numpy arrays or memory maps.
+    """
+    def __init__(self, variable, data=None, mask=None):
+        self.variable = variable
+        if data is None:
+            data = variable[:]
+            mask = ma.getmaskarray(data) if ma.is_masked(data) else None
+            data = ma.getdata(data)
+        self.data = data
+        self.mask = mask
+
+    def __getattr__(self, name):
+        if name == 'variable':
+            raise AttributeError(name)
+        return getattr(self.variable, name)
+
+    def __getitem__(self, item):
+        data = orthogonal_index(self.data, item)
+        if self.mask is None:
+            return ma.masked_array(data)
+        return ma.masked_array(data, mask=orthogonal_index(self.mask, item))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def is_mapped(self):
+        return isinstance(self.data, np.memmap)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        nbytes = self.data.nbytes
+        if self.mask is not None:
+            nbytes += self.mask.nbytes
+        return nbytes
+
+
+def cache_path(filename):
+    """Directory with the memory-mappable cache of a data file
+
+       It is OCEANSDB_DIR/cache/<filename>/, with one .npy file per
+       variable, plus a .mask.npy file for the masked ones.
+    """
+    return os.path.join(os.path.dirname(filename), 'cache',
+            os.path.basename(filename))
+
+
+def cached_plan(filename, axes, depth, lat, lon):
+    """Interpolation plan of points on the grid of a data file, cached
+
+       The plan (see common.InterpolationPlan) is saved the first time in
+       OCEANSDB_DIR/cache, keyed by the data file, its grid (axes) and the
+       points, and loaded from there by any later session asking for the
+       same points on the same dataset.
+    """
+    points = np.broadcast_arrays(np.atleast_1d(ma.getdata(depth)),
+            np.atleast_1d(lat), np.atleast_1d(lon))
+    digest = hashlib.md5()
+    for a in [axes[d].values for d in InterpolationPlan.AXES] + list(points):
+        a = np.asarray(a, dtype='f8')
+        digest.update(np.array(a.shape).tobytes())
+        digest.update(a.tobytes())
+    path = "%s.plan_%s.npz" % (cache_path(filename),
+            digest.hexdigest()[:16])
+
+    if os.path.exists(path):
+        plan = InterpolationPlan.load(path)
+        if plan.matches(axes):
+            return plan
+
+    plan = InterpolationPlan(axes, *points)
+    cachedir = os.path.dirname(path)
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    tmp = path + '.tmp%d' % os.getpid()
+    with open(tmp, 'wb') as f:
+        plan.save(f)
+    os.replace(tmp, path)
+    return plan
+
+
+def write_cache(filename, varnames=None):
+    """Convert a netCDF file into an uncompressed, memory-mappable cache
+
+       By default all the variables with 2 or more dimensions are
+       converted. The values are stored as they are read from the netCDF
+       (scale and offset already applied), and the mask as a separate
+       boolean array. The cache is built in a temporary directory and
+       then moved in place, so a partial cache is never used, and a
+       process already using a previous one is not affected.
+    """
+    output = cache_path(filename)
+    cachedir = os.path.dirname(output)
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    tmpdir = tempfile.mkdtemp(dir=cachedir, suffix='.tmp')
+    try:
+        st = os.stat(filename)
+        with netcdf_lock:
+            nc = Dataset(filename, 'r')
+        try:
+            if varnames is None:
+                varnames = [v for v in nc.variables
+                        if nc.variables[v].ndim >= 2]
+            masked = []
+            for v in varnames:
+                variable = LockedVariable(nc.variables[v])
+                if _write_cache_var(variable, tmpdir):
+                    masked.append(v)
+        finally:
+            with netcdf_lock:
+                nc.close()
+        meta = {'size': st.st_size, 'mtime': st.st_mtime,
+                'variables': list(varnames), 'masked': masked}
+        with open(os.path.join(tmpdir, 'cache.json'), 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        if os.path.exists(output):
+            shutil.rmtree(output)
+        os.rename(tmpdir, output)
+    except:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return output
+
+
+def _write_cache_var(variable, outdir):
+    """Write one variable in outdir, one block at a time
+
+       Returns True if the variable has any masked value.
+    """
+    data = None
+    mask = None
+    # Iterate on the first dimension longer than 1, like depth on WOA
+    axis = ([i for i, n in enumerate(variable.shape) if n > 1] or [0])[0]
+    for i in range(variable.shape[axis]):
+        idx = axis * (slice(None),) + (i,)
+        block = variable[idx]
+        if data is None:
+            # The type of the values as read, i.e. unpacked if the
+            #   variable has scale_factor or add_offset
+            data = np.lib.format.open_memmap(
+                    os.path.join(outdir, variable.name + '.npy'),
+                    mode='w+', dtype=block.dtype, shape=variable.shape)
+        data[idx] = ma.getdata(block)
+        if ma.is_masked(block):
+            if mask is None:
+                mask = np.lib.format.open_memmap(
+                        os.path.join(outdir, variable.name + '.mask.npy'),
+                        mode='w+', dtype=bool, shape=variable.shape)
+            mask[idx] = ma.getmaskarray(block)
+    data.flush()
+    if mask is not None:
+        mask.flush()
+    return mask is not None
+
+
+def read_cache(filename):
+    """Memory maps of the cached variables of a data file
+
+       Returns a dictionary of (data, mask) for each variable, with mask
+       None if there is no masked value. The cache is only used if the
+       data file has the same size and mtime as when it was converted,
+       otherwise returns an empty dictionary.
+    """
+    path = cache_path(filename)
+    try:
+        with open(os.path.join(path, 'cache.json')) as f:
+            meta = json.load(f)
+        st = os.stat(filename)
+    except (IOError, OSError, ValueError):
+        return {}
+    if (st.st_size != meta['size']) or (st.st_mtime != meta['mtime']):
+        return {}
+
+    arrays = {}
+    for v in meta['variables']:
+        data = np.load(os.path.join(path, v + '.npy'), mmap_mode='r')
+        mask = None
+        if v in meta['masked']:
+            mask = np.load(os.path.join(path, v + '.mask.npy'),
+                    mmap_mode='r')
+        arrays[v] = (data, mask)
+    return arrays
+
+
 class Dataset_flex(object):
+    """A netCDF dataset from the pool, with aliases for the variables
+
+       Closing it only releases the shared dataset back to the pool.
+       Variables can be loaded in memory with preload(), after which
+       reading them doesn't require any I/O. If there is a cache of the
+       file (see write_cache()), its variables are read from the memory
+       maps instead of the netCDF.
+
+       It is safe to use from many threads: the variables returned are
+       LockedVariable, which serialize the access to the netCDF library.
+    """
     def __init__(self, filename, **kwargs):
-        self.ds = Dataset(filename, mode='r')
+        self.filename = filename
+        self.ds = pool.acquire(filename)
+        self._closed = False
+        with netcdf_lock:
+            self.variables = OrderedDict(
+                    (k, LockedVariable(v)) for k, v in self.ds.variables.items())
+        self.arrays = {}
+        for v, (data, mask) in read_cache(filename).items():
+            self.arrays[v] = ArrayVariable(
+                    self.variables[v], data=data, mask=mask)
         if 'aliases' in kwargs:
             self.aliases = kwargs['aliases']
         else:
             self.aliases = {}
     def __getitem__(self, item):
-        try:
-            return self.ds.variables[self.aliases[item]]
-        except:
-            return self.ds.variables[item]
+        name = self.aliases.get(item, item)
+        if name not in self.variables:
+            name = item
+        if name in self.arrays:
+            return self.arrays[name]
+        return self.variables[name]
     def __enter__(self):
         return self
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.close()
+    def __getstate__(self):
+        """Pickled as the filename, to be opened again by another process
+        """
+        return {'filename': self.filename, 'aliases': self.aliases}
+    def __setstate__(self, state):
+        self.__init__(state['filename'], aliases=state['aliases'])
     def close(self):
-        self.ds.close()
+        if not self._closed:
+            self._closed = True
+            self.arrays = {}
+            pool.release(self.filename)
+    def preload(self, varnames):
+        """Read the given variables into memory
+        """
+        for v in varnames:
+            v = self[v].name
+            if (v not in self.arrays) or self.arrays[v].is_mapped:
+                self.arrays[v] = ArrayVariable(self.variables[v])
     @property
-    def variables(self):
-        return self.ds.variables
+    def nbytes(self):
+        """Memory used by the preloaded variables, in bytes
+
+           The memory mapped variables are not accounted.
+        """
+        return sum(a.nbytes for a in self.arrays.values()
+                if not a.is_mapped)
+
+
+def extract_many(db, variables, workers=None, **kwargs):
+    """Extract many variables of a database concurrently
+
+       Each variable, like 'TEMP' or 'PSAL', is extracted in its own
+       thread (up to workers at once). The reading from the files is
+       serialized (see netcdf_lock), but the interpolation runs in
+       parallel. variables can be a list, or a dictionary with the var
+       to extract from each one, like {'TEMP': ['t_mn'], 'PSAL': None}.
+       The other arguments are the same of extract().
+
+       Returns a dictionary with the output of extract() for each one.
+    """
+    if not isinstance(variables, dict):
+        variables = OrderedDict((v, None) for v in variables)
+
+    def job(v):
+        kw = dict(kwargs)
+        if variables[v] is not None:
+            kw['var'] = variables[v]
+        return db[v].extract(**kw)
+
+    if workers is None:
+        workers = len(variables)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = OrderedDict((v, executor.submit(job, v)) for v in variables)
+        return OrderedDict((v, futures[v].result()) for v in futures)
+
+
+_worker_db = None
+
+
+def _init_worker(db):
+    global _worker_db
+    _worker_db = db
+
+
+def _track_worker(kwargs):
+    return _worker_db.track(**kwargs)
+
+
+def parallel_track(db, workers, **kwargs):
+    """Split a track in chunks, and extract them in a pool of processes
+
+       db is pickled once for each worker process, which opens its own
+       read-only datasets (or the memory-mapped cache, if available, see
+       write_cache()). The processes are started with 'spawn', so that
+       they don't inherit the HDF5 state. Each chunk is extracted with
+       db.track(**kwargs), and the outputs are concatenated in the same
+       order, hence the result is identical to the serial one.
+
+       All the arguments that are arrays with one value per point are
+       split, anything else, like var or mode, goes as it is to every
+       chunk. As with any use of multiprocessing, the main script must
+       be protected by if __name__ == '__main__'.
+    """
+    N = max(np.size(kwargs[k]) for k in ('doy', 'depth', 'lat', 'lon')
+            if k in kwargs)
+    chunks = np.array_split(np.arange(N), min(N, workers))
+    tasks = []
+    for c in chunks:
+        tasks.append(dict(
+            (k, v[c] if (np.ndim(v) > 0 and np.size(v) == N
+                and k != 'var') else v)
+            for k, v in kwargs.items()))
+
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+            initializer=_init_worker, initargs=(db,)) as executor:
+        results = list(executor.map(_track_worker, tasks))
+
+    output = OrderedDict()
+    for v in results[0]:
+        output[v] = ma.concatenate([r[v] for r in results])
+    return output
+
+
+def stream_track(track, records, coords, chunk_size=1024, **kwargs):
+    """Lazily run track() on a stream of records, chunk by chunk
+
+       records is any iterable, possibly unbounded, of tuples with the
+       coordinates coords, like ('doy', 'depth', 'lat', 'lon'), or of
+       dictionaries with those keys. Up to chunk_size records are taken
+       at a time and evaluated with a single track(**kwargs), so that
+       only one chunk is in memory at once.
+
+       Yields, in the same order of records, a dictionary with the value
+       of each var for each record.
+    """
+    assert chunk_size > 0
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        if isinstance(chunk[0], dict):
+            points = dict((k, [r[k] for r in chunk]) for k in coords)
+        else:
+            assert all(len(r) == len(coords) for r in chunk), \
+                    "Each record must be %s" % (tuple(coords),)
+            points = dict(zip(coords, zip(*chunk)))
+        for k in points:
+            points[k] = np.array(points[k])
+        points.update(kwargs)
+        output = track(**points)
+        for i in range(len(chunk)):
+            yield OrderedDict((v, output[v][i]) for v in output)
+
+
+_catalog = None
+
+
+def catalog(reload=False):
+    """Parsed configuration of all the available databases
+
+       The datasource/*.json files are read only once, on the first call,
+       and the same dictionary is shared by all the database objects. Use
+       reload=True to parse those files again.
+    """
+    global _catalog
+
+    if (_catalog is None) or reload:
+        db_cfg = {}
+        cfg_dir = 'datasource'
+        cfg_files = pkg_resources.resource_listdir('oceansdb', cfg_dir)
+        cfg_files = [f for f in cfg_files if f[-5:] == '.json']
+        for src_cfg in cfg_files:
+            text = pkg_resources.resource_string(
+                    'oceansdb', os.path.join(cfg_dir, src_cfg))
+            text = text.decode('UTF-8', 'replace')
+            cfg = json.loads(text)
+            for c in cfg:
+                assert c not in db_cfg, "Trying to overwrite %s"
+                db_cfg[c] = cfg[c]
+        _catalog = db_cfg
+
+    return _catalog
+
+
+def datafile(c, dbpath=None):
+    """Local path of a data file described by a catalog entry
+    """
+    if dbpath is None:
+        dbpath = oceansdb_dir()
+
+    if 'filename' in c:
+        return os.path.join(dbpath, c['filename'])
+    return os.path.join(dbpath, os.path.basename(urlparse(c['url']).path))
+
+
+def md5sum(filename, block_size=1048576):
+    """MD5 hash of a file, read in blocks
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def load_manifest(dbpath=None):
+    """Local files already verified, with their size, mtime and md5
+
+       A data file downloaded by dbsource(), or checked by verify(), is
+       recorded in manifest.json at OCEANSDB_DIR, so that it is known if
+       it changed since then by comparing its size and modification time
+       (a stat call) instead of hashing the whole file.
+    """
+    if dbpath is None:
+        dbpath = oceansdb_dir()
+
+    try:
+        with open(os.path.join(dbpath, 'manifest.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(entries, dbpath=None):
+    """Record in the manifest the given entries, if possible
+
+       The manifest is read again right before writing, and replaced
+       atomically, so concurrent processes don't corrupt it. It is only
+       a record, so if OCEANSDB_DIR is not writable, like a read-only
+       shared directory, it is skipped. Returns True if saved.
+    """
+    if dbpath is None:
+        dbpath = oceansdb_dir()
+
+    manifest = load_manifest(dbpath)
+    manifest.update(entries)
+    try:
+        with tempfile.NamedTemporaryFile(
+                'w', dir=dbpath, suffix='.tmp', delete=False) as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    except (IOError, OSError):
+        return False
+    try:
+        # NamedTemporaryFile is created 0600, but it is shared as the data
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(f.name, 0o666 & ~umask)
+        os.replace(f.name, os.path.join(dbpath, 'manifest.json'))
+    except (IOError, OSError):
+        os.remove(f.name)
+        return False
+    return True
+
+
+def is_compressed(c):
+    """True if the catalog entry is a compressed file (md5 of the download)
+    """
+    return urlparse(c['url']).path.endswith(('.gz', '.zip'))
+
+
+def manifest_entry(filename, md5=None):
+    """Manifest entry of a file: its size, mtime and the given md5
+
+       The md5 is None if unknown, like of a file decompressed after the
+       download. It is not computed here, see verify_file().
+    """
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5}
+
+
+def verify_file(c, dbpath=None):
+    """Verify a data file and return its manifest entry
+
+       The md5 hash expected by the catalog refers to the downloaded file,
+       so it can only be checked here for the files that were not
+       compressed.
+    """
+    filename = datafile(c, dbpath)
+    entry = manifest_entry(filename, md5sum(filename))
+    if ('md5hash' in c) and not is_compressed(c):
+        assert entry['md5'] == c['md5hash'], \
+                "%s doesn't match expected content (md5 hash: %s)" % (
+                        filename, entry['md5'])
+    return entry
+
+
+def is_verified(filename, manifest):
+    """True if filename has the same size and mtime as in the manifest
+    """
+    entry = manifest.get(os.path.basename(filename))
+    if entry is None:
+        return False
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+    return (st.st_size == entry['size']) and (st.st_mtime == entry['mtime'])
+
+
+def check_file(c, manifest, dbpath=None):
+    """Make sure that a data file is available, and not modified
+
+       A missing file is downloaded, and the md5 already checked by
+       download_file() is the one of the local file, unless it was
+       compressed. A file recorded in the manifest, but with a different
+       size or mtime, is hashed again and verified. The files never
+       verified are left to 'oceansdb verify'. Returns the new manifest
+       entry, or None if there is nothing to record.
+    """
+    if dbpath is None:
+        dbpath = oceansdb_dir()
+
+    filename = datafile(c, dbpath)
+    key = os.path.basename(filename)
+    if not os.path.exists(filename):
+        download_file(outputdir=dbpath, **c)
+        md5 = None if is_compressed(c) else c.get('md5hash')
+        return manifest_entry(filename, md5)
+
+    if (key not in manifest) or is_verified(filename, manifest):
+        return None
+
+    entry = verify_file(c, dbpath)
+    assert manifest[key].get('md5') in (None, entry['md5']), \
+            "%s was modified since it was verified (md5 hash: %s)" % (
+                    filename, entry['md5'])
+    return entry
+
+
+def catalog_entries(dbname=None):
+    """Iterate over all the data files described in the catalog
+    """
+    for db, cfg in catalog().items():
+        if (dbname is not None) and (db != dbname):
+            continue
+        for var in cfg['vars'].values():
+            for resolution in var.values():
+                if not isinstance(resolution, dict):
+                    continue
+                for tscale in resolution.values():
+                    if not isinstance(tscale, list):
+                        continue
+                    for c in tscale:
+                        if isinstance(c, dict) and ('url' in c):
+                            yield c
+
+
+def verify(dbname=None):
+    """Check all the local data files, hashing them again
+
+       Only the files already available locally are verified, and the
+       manifest is updated. Returns a dictionary with the status of each
+       file: 'ok', 'modified' (different from the previous verification),
+       or 'corrupted' (doesn't match the catalog).
+    """
+    dbpath = oceansdb_dir()
+    manifest = load_manifest(dbpath)
+    status = {}
+    entries = {}
+    for c in catalog_entries(dbname):
+        filename = datafile(c, dbpath)
+        key = os.path.basename(filename)
+        if (key in status) or not os.path.exists(filename):
+            continue
+        try:
+            entries[key] = verify_file(c, dbpath)
+        except AssertionError:
+            status[key] = 'corrupted'
+            continue
+        if (key in manifest) and \
+                (manifest[key].get('md5') not in (None, entries[key]['md5'])):
+            status[key] = 'modified'
+        else:
+            status[key] = 'ok'
+
+    if entries:
+        save_manifest(entries, dbpath)
+    return status
+
+
+def build_cache(dbname=None):
+    """Convert all the local data files into memory-mappable caches
+
+       One-time conversion of the data files already available locally
+       (see write_cache()). Afterwards, the databases read from the memory
+       maps, without decompressing the netCDF chunks, and the pages are
+       shared by all the processes using them. Returns the list of cache
+       directories.
+    """
+    dbpath = oceansdb_dir()
+    output = []
+    for c in catalog_entries(dbname):
+        filename = datafile(c, dbpath)
+        if (not os.path.exists(filename)) or (filename in output):
+            continue
+        output.append(filename)
+
+    return [write_cache(f) for f in output]
 
 
 def dbsource(dbname, var, resolution=None, tscale=None):
     """Return which file(s) to use according to dbname, var, etc
+
+       Files are downloaded if required, in which case the download is
+       checked against the catalog (see supportdata.download_file()) and
+       recorded in the manifest (see load_manifest()). The files already
+       available are opened straight away, unless modified since they were
+       recorded (see check_file()). Use 'oceansdb verify' to hash them all
+       again.
     """
-    db_cfg = {}
-    cfg_dir = 'datasource'
-    cfg_files = pkg_resources.resource_listdir('oceansdb', cfg_dir)
-    cfg_files = [f for f in cfg_files if f[-5:] == '.json']
-    for src_cfg in cfg_files:
-        text = pkg_resources.resource_string(
-                'oceansdb', os.path.join(cfg_dir, src_cfg))
-        text = text.decode('UTF-8', 'replace')
-        cfg = json.loads(text)
-        for c in cfg:
-            assert c not in db_cfg, "Trying to overwrite %s"
-            db_cfg[c] = cfg[c]
+    db_cfg = catalog()
 
     dbpath = oceansdb_dir()
     datafiles = []
@@ -94,14 +1290,14 @@ def dbsource(dbname, var, resolution=None, tscale=None):
     if (tscale is None):
         tscale = cfg['vars'][var][resolution]["default_tscale"]
 
+    manifest = load_manifest(dbpath)
+    updated = {}
     for c in cfg['vars'][var][resolution][tscale]:
-        download_file(outputdir=dbpath, **c)
+        filename = datafile(c, dbpath)
 
-        if 'filename' in c:
-            filename = os.path.join(dbpath, c['filename'])
-        else:
-            filename = os.path.join(dbpath,
-                    os.path.basename(urlparse(c['url']).path))
+        entry = check_file(c, manifest, dbpath)
+        if entry is not None:
+            updated[os.path.basename(filename)] = entry
 
         if 'varnames' in cfg['vars'][var][resolution]:
             datafiles.append(Dataset_flex(filename,
@@ -109,4 +1305,7 @@ def dbsource(dbname, var, resolution=None, tscale=None):
         else:
             datafiles.append(Dataset_flex(filename))
 
+    if updated:
+        save_manifest(updated, dbpath)
+
     return datafiles
@@ -5,7 +5,10 @@
 
 from os.path import expanduser
 import re
+import threading
 from datetime import datetime
+from functools import partial
+from collections import OrderedDict
 
 import numpy as np
 from numpy import ma
@@ -14,8 +17,13 @@ from scipy.interpolate import interp1d
 # RectBivariateSpline
 from scipy.interpolate import griddata
 
-from .utils import dbsource
-from .common import cropIndices
+from .utils import dbsource, extract_many, parallel_track, as_memo
+from .utils import stream_track, cached_plan
+from .utils import as_instrument, timed_call, timed_stage
+from .common import cropIndices, GridAxis, PERIOD
+from .common import rectilinear, rectilinear_points, as_masked
+from .common import rectilinear_profile, rectilinear_casts, cast_index
+from .common import RegridWeights, InterpolationPlan
 
 
 # ============================================================================
@@ -146,11 +154,15 @@ class WOA_var_nc(object):
     returns the corresponding WOA values of salinity or temperature mean and
     standard deviation for the given time, lat, lon, depth.
     """
-    def __init__(self, source):
+    def __init__(self, source, preload=False, memo=None, instrument=None):
         self.ncs = source
+        self.memo = memo
+        self.instrument = instrument
 
         self.load_dims(dims=['lat', 'lon', 'depth'])
         self.set_keys()
+        if preload:
+            self.preload(None if preload is True else preload)
 
     def __enter__(self):
         return self
@@ -168,6 +180,27 @@ class WOA_var_nc(object):
     def keys(self):
         return self.KEYS
 
+    def preload(self, var=None):
+        """Read the variables into memory
+
+           Once loaded, extractions don't require any I/O. By default
+           loads all the variables, otherwise only the given list, like
+           ['t_mn', 't_sd']. Returns the memory used, in bytes.
+        """
+        if var is None:
+            var = self.KEYS
+        elif isinstance(var, str):
+            var = [var]
+        for nc in self.ncs:
+            nc.preload(var)
+        return self.nbytes
+
+    @property
+    def nbytes(self):
+        """Memory used by the preloaded variables, in bytes
+        """
+        return sum(nc.nbytes for nc in self.ncs)
+
     def load_dims(self, dims):
         self.dims = {}
         for d in dims:
@@ -183,6 +216,11 @@ class WOA_var_nc(object):
             self.dims['time'].append(mfrac * (nc['time'][0] % 12))
         self.dims['time'] = np.array(self.dims['time'])
 
+        self.axes = {}
+        for d in self.dims:
+            if np.size(self.dims[d]) > 0:
+                self.axes[d] = GridAxis(self.dims[d], period=PERIOD.get(d))
+
     def set_keys(self):
         """
         """
@@ -212,36 +250,258 @@ class WOA_var_nc(object):
                a longitude sequence like [352, 358, 364, 369, 380], and
                the equivalent for day of year above 365.
         """
-        dims, idx = cropIndices(self.dims, lat, lon, depth, doy)
+        with timed_stage(self.instrument, 'cropIndices'):
+            dims, idx = cropIndices(self.axes, lat, lon, depth, doy)
         subset = {}
         for v in var:
-            subset[v] = ma.asanyarray([
-                self.ncs[tnn][v][0, idx['zn'], idx['yn'], idx['xn']]
-                for tnn in idx['tn']])
+            with timed_stage(self.instrument, 'read') as stage:
+                subset[v] = ma.asanyarray([
+                    self.ncs[tnn][v][0, idx['zn'], idx['yn'], idx['xn']]
+                    for tnn in idx['tn']])
+                stage.count(subset[v])
         return subset, dims
 
     def nearest(self, doy, depth, lat, lon, var):
+        """ Nearest value of each var on the coordinates requested
+
+            The indices are obtained with a binary search on each axis,
+              considering the cyclic longitude and day of year, hence the
+              output is filled at once from the smallest hyperslab that
+              contains all the required grid points, with only the
+              longitudes required.
+        """
+        tn = self.axes['time'].nearest(doy)
+        zn = self.axes['depth'].nearest(depth)
+        yn = self.axes['lat'].nearest(lat)
+        xn = self.axes['lon'].nearest(lon)
+
+        tn_in, tn_out = np.unique(tn, return_inverse=True)
+        zn_in = slice(zn.min(), zn.max() + 1)
+        yn_in = slice(yn.min(), yn.max() + 1)
+        # Only the longitudes required, even across the end of the axis
+        xn_in, xn_out = np.unique(xn, return_inverse=True)
+        xn_in = xn_in.tolist()
+        idx = np.ix_(np.ravel(tn_out), zn - zn_in.start, yn - yn_in.start,
+                np.ravel(xn_out))
+
         output = {}
-        dims, idx = cropIndices(self.dims, lat, lon, depth, doy)
         for v in var:
-            output[v] = ma.masked_all((doy.size, depth.size, lat.size,
-                lon.size), dtype='f')
-            for tn_out, t in enumerate(doy):
-                tn_in = np.absolute(dims['time']-t).argmin()
-                subset = self.ncs[tn_in][v][0, idx['zn'], idx['yn'], idx['xn']]
-                for yn_out, y in enumerate(lat):
-                    yn_in = np.absolute(dims['lat']-y).argmin()
-                    for xn_out, x in enumerate(lon):
-                        xn_in = np.absolute(dims['lon']-x).argmin()
-                        for zn_out, z in enumerate(depth):
-                            zn_in = np.absolute(dims['depth']-z).argmin()
-                            output[v][tn_out, zn_out, yn_out, xn_out] = \
-                                    subset[zn_in, yn_in, xn_in]
+            with timed_stage(self.instrument, 'read') as stage:
+                subset = ma.asanyarray([
+                    self.ncs[tnn][v][0, zn_in, yn_in, xn_in]
+                    for tnn in tn_in])
+                stage.count(subset)
+            output[v] = ma.asanyarray(subset[idx], dtype='f')
         return output
 
-    def interpolate(self, doy, depth, lat, lon, var):
+    def interpolate(self, doy, depth, lat, lon, var, mode=None):
         """ Interpolate each var on the coordinates requested
 
+            The default is a linear interpolation on the rectilinear grid,
+              i.e. linear in time and depth, and bilinear in lat x lon
+              ignoring the masked corners (see common.rectilinear()).
+
+            With mode='griddata' it uses the previous interpolator, which
+              triangulates the valid data on each level with
+              scipy.interpolate.griddata. Much slower.
+        """
+        if mode == 'griddata':
+            with timed_stage(self.instrument, 'griddata'):
+                return self._interpolate_griddata(doy, depth, lat, lon, var)
+
+        t = self.axes['time'].weights(doy)
+        # Each time is a different file
+        tn = np.unique(np.concatenate((t[0], t[1])))
+        t = (np.searchsorted(tn, t[0]), np.searchsorted(tn, t[1]),
+                t[2], t[3])
+        zn, z = self.axes['depth'].hyperslab(depth)
+        yn, y = self.axes['lat'].hyperslab(lat)
+        xn, x = self.axes['lon'].hyperslab(lon)
+
+        output = {}
+        for v in var:
+            with timed_stage(self.instrument, 'read') as stage:
+                subset = ma.asanyarray([
+                    self.ncs[tnn][v][0, zn, yn, xn] for tnn in tn])
+                stage.count(subset)
+            with timed_stage(self.instrument, 'interpolate'):
+                values = rectilinear(
+                        ma.filled(subset.astype('f8'), np.nan), (t, z, y, x))
+                output[v] = as_masked(values, subset.dtype)
+
+        return output
+
+    def profile(self, doy, lat, lon, depth=None, var=None):
+        """ Fast linear interpolation of a single vertical profile
+
+            The same as extract(doy=doy, depth=depth, lat=lat, lon=lon)
+              with mode=None, but only the 2 x 2 columns around the
+              position at the bracketing times are read (also across the
+              date line, see GridAxis.hyperslab()), and the time and
+              horizontal weights are computed once for all the levels (see
+              common.rectilinear_profile()). Mostly useful with preloaded
+              data, when there is no I/O cost.
+
+              t = db['TEMP'].profile(doy=136.875, lat=17.5, lon=-37.5)
+        """
+        with timed_call(self.instrument, 'profile'):
+            return self._profile(doy, lat, lon, depth, var)
+
+    def _profile(self, doy, lat, lon, depth=None, var=None):
+        if var is None:
+            var = self.KEYS
+        else:
+            var = np.atleast_1d(var)
+        if isinstance(doy, datetime):
+            doy = int(doy.strftime('%j'))
+        if depth is None:
+            depth = self.dims['depth']
+        depth = np.atleast_1d(ma.getdata(depth))
+        assert np.all(depth >= 0), "Depth was supposed to be positive."
+
+        t = self.axes['time'].weights([doy])
+        tn = np.unique((t[0][0], t[1][0]))
+        t = (np.searchsorted(tn, t[0]), np.searchsorted(tn, t[1]),
+                t[2], t[3])
+        zn, z = self.axes['depth'].hyperslab(depth)
+        yn, y = self.axes['lat'].hyperslab([lat])
+        xn, x = self.axes['lon'].hyperslab([lon])
+
+        output = OrderedDict()
+        for v in var:
+            with timed_stage(self.instrument, 'read') as stage:
+                columns = [self.ncs[tnn][v][0, zn, yn, xn] for tnn in tn]
+                for c in columns:
+                    stage.count(c)
+            dtype = columns[0].dtype
+            data = np.array([ma.filled(c.astype('f8'), np.nan)
+                for c in columns])
+            with timed_stage(self.instrument, 'interpolate'):
+                output[v] = as_masked(
+                        rectilinear_profile(data, (t, z, y, x)), dtype)
+        return output
+
+    def profiles(self, doy, lat, lon, depth, offsets, var=None):
+        """ Linear interpolation of many profiles, each on its own depths
+
+            Like an extract() for each cast (profile), as from an archive
+              of CTDs, but all at once. The casts are given by their doy,
+              lat and lon, and their depths concatenated in a single flat
+              array, the i-th cast being depth[offsets[i]:offsets[i + 1]].
+              The output has the same layout as depth, one value for each
+              depth.
+
+              t = db['TEMP'].profiles(doy=[136.875, 140], lat=[17.5, 10],
+                      lon=[-37.5, -30], depth=[0, 10, 0, 10, 100],
+                      offsets=[0, 2, 5])
+              casts = np.split(t['t_mn'], [2])
+
+            The time and horizontal weights are applied once for all the
+              levels of each cast, like in profile(), and all the casts are
+              interpolated together (see common.rectilinear_casts()).
+        """
+        with timed_call(self.instrument, 'profiles'):
+            return self._profiles(doy, lat, lon, depth, offsets, var)
+
+    def _profiles(self, doy, lat, lon, depth, offsets, var=None):
+        if var is None:
+            var = self.KEYS
+        else:
+            var = np.atleast_1d(var)
+        doy = np.atleast_1d(doy)
+        if (doy.size > 0) and (type(doy[0]) is datetime):
+            doy = np.array([int(d.strftime('%j')) for d in doy])
+        lat = np.atleast_1d(lat)
+        lon = np.atleast_1d(lon)
+        depth = np.atleast_1d(ma.getdata(depth))
+        assert np.all(depth >= 0), "Depth was supposed to be positive."
+        cast = cast_index(offsets, depth.size)
+        assert doy.shape == lat.shape == lon.shape == (np.size(offsets) - 1,), \
+                "One doy, lat and lon for each cast"
+
+        t = self.axes['time'].weights(doy)
+        tn = np.unique(np.concatenate((t[0], t[1])))
+        t = (np.searchsorted(tn, t[0]), np.searchsorted(tn, t[1]),
+                t[2], t[3])
+        zn, z = self.axes['depth'].hyperslab(depth)
+        yn, y = self.axes['lat'].hyperslab(lat)
+        xn, x = self.axes['lon'].hyperslab(lon)
+
+        output = OrderedDict()
+        for v in var:
+            with timed_stage(self.instrument, 'read') as stage:
+                subset = ma.asanyarray([
+                    self.ncs[tnn][v][0, zn, yn, xn] for tnn in tn])
+                stage.count(subset)
+            with timed_stage(self.instrument, 'interpolate'):
+                values = rectilinear_casts(subset, (t, z, y, x), cast)
+                output[v] = as_masked(values, subset.dtype)
+        return output
+
+    def regrid_weights(self, lat, lon, depth=None):
+        """ Weights to regrid onto lat x lon x depth, see regrid()
+        """
+        if depth is None:
+            depth = self.dims['depth']
+        return RegridWeights(self.axes, lat, lon, depth)
+
+    def regrid(self, doy, lat=None, lon=None, depth=None, var=None,
+            weights=None):
+        """ Linear interpolation of the whole field onto a target grid
+
+            The same as extract(doy=doy, depth=depth, lat=lat, lon=lon)
+              with mode=None, i.e. on lat x lon x depth, but the weights
+              are computed once, as a sparse matrix applied to all the
+              levels and times at once (see common.RegridWeights). The
+              weights can be reused, like for another variable of the same
+              database, instead of lat, lon and depth:
+
+              w = db['TEMP'].regrid_weights(lat=lat, lon=lon, depth=depth)
+              t = db['TEMP'].regrid(doy=136.875, weights=w)
+              s = db['PSAL'].regrid(doy=136.875, weights=w)
+
+            Returns (depth, lat, lon) arrays for each var, or (doy, depth,
+              lat, lon) if doy is a sequence.
+        """
+        with timed_call(self.instrument, 'regrid'):
+            return self._regrid(doy, lat, lon, depth, var, weights)
+
+    def _regrid(self, doy, lat, lon, depth, var, weights):
+        if var is None:
+            var = self.KEYS
+        else:
+            var = np.atleast_1d(var)
+        if weights is None:
+            assert (lat is not None) and (lon is not None), \
+                    "Requires lat and lon, or weights"
+            weights = self.regrid_weights(lat, lon, depth)
+        assert weights.matches(self.axes), "Weights of a different grid"
+        scalar = np.ndim(doy) == 0
+        doy = np.atleast_1d(doy)
+        if type(doy[0]) is datetime:
+            doy = np.array([int(d.strftime('%j')) for d in doy])
+
+        t = self.axes['time'].weights(doy)
+        tn = np.unique(np.concatenate((t[0], t[1])))
+        t = (np.searchsorted(tn, t[0]), np.searchsorted(tn, t[1]),
+                t[2], t[3])
+
+        output = OrderedDict()
+        for v in var:
+            with timed_stage(self.instrument, 'read') as stage:
+                subset = ma.asanyarray([
+                    self.ncs[tnn][v][0, weights.zn, weights.yn, weights.xn]
+                    for tnn in tn])
+                stage.count(subset)
+            with timed_stage(self.instrument, 'interpolate'):
+                values = weights.apply(
+                        ma.filled(subset.astype('f8'), np.nan), t)
+                output[v] = as_masked(values[0] if scalar else values,
+                        subset.dtype)
+        return output
+
+    def _interpolate_griddata(self, doy, depth, lat, lon, var):
+        """ Interpolate each var using scipy's griddata on each level
         """
         subset, dims = self.crop(doy, depth, lat, lon, var)
 
@@ -280,7 +540,8 @@ class WOA_var_nc(object):
                 subset[v] = f(doy)
             dims['time'] = np.atleast_1d(doy)
 
-        if not (np.all(lat == dims['lat']) and np.all(lon == dims['lon'])):
+        if not (np.array_equal(lat, dims['lat']) and
+                np.array_equal(lon, dims['lon'])):
             # Lat x Lon target coordinates are the same for all time and depth.
             points_out = []
             for latn in lat:
@@ -366,6 +627,13 @@ class WOA_var_nc(object):
 
               - Track:   doy{1,n}, depth{1,n2},  lat{n},lon{n}
         """
+        with timed_call(self.instrument, 'extract'):
+            if self.memo is not None:
+                return self.memo.call(('extract', self.ncs[0].filename),
+                        self._extract, mode, kwargs)
+            return self._extract(mode=mode, **kwargs)
+
+    def _extract(self, mode=None, **kwargs):
         for k in kwargs:
             assert k in ['var', 'doy', 'depth', 'lat', 'lon'], \
                     "Wrong dimension to extract, check the manual"
@@ -393,19 +661,29 @@ class WOA_var_nc(object):
         if mode == 'nearest':
             output = self.nearest(doy, depth, lat, lon, var)
         else:
-            output = self.interpolate(doy, depth, lat, lon, var)
+            output = self.interpolate(doy, depth, lat, lon, var, mode=mode)
 
         for v in output:
                 output[v] = np.atleast_1d(np.squeeze(output[v]))
 
         return output
 
-    def track(self, mode=None, **kwargs):
+    def track(self, mode=None, workers=None, **kwargs):
         """
 
             Possible scenarios:
               - Track:   doy{1,n}, depth{1,n2}, lat{n}, lon{n}
+
+            With workers=N, the track is split in chunks extracted by N
+              processes (see utils.parallel_track()), with the same result.
         """
+        with timed_call(self.instrument, 'track'):
+            if self.memo is not None:
+                return self.memo.call(('track', self.ncs[0].filename),
+                        partial(self._track, workers=workers), mode, kwargs)
+            return self._track(mode=mode, workers=workers, **kwargs)
+
+    def _track(self, mode=None, workers=None, **kwargs):
         for k in kwargs:
             assert k in ['var', 'doy', 'depth', 'lat', 'lon'], \
                     "Wrong dimension to extract, check the manual"
@@ -441,6 +719,13 @@ class WOA_var_nc(object):
             lat = lat * np.ones(N, dtype='i')
             lon = lon * np.ones(N, dtype='i')
 
+        if (workers is not None) and (workers > 1) and (N > 1):
+            return parallel_track(self, workers, mode=mode, var=var,
+                    doy=doy, depth=depth, lat=lat, lon=lon)
+
+        if mode not in ('nearest', 'griddata'):
+            return self._linear_track(doy, depth, lat, lon, var)
+
         output = {}
         for v in var:
             output[v] = []
@@ -451,7 +736,8 @@ class WOA_var_nc(object):
                         np.array([t]), np.array([z]), np.array([y]), np.array([x]), var)
             else:
                 tmp = self.interpolate(
-                        np.array([t]), np.array([z]), np.array([y]), np.array([x]), var)
+                        np.array([t]), np.array([z]), np.array([y]), np.array([x]), var,
+                        mode=mode)
 
             for v in tmp:
                 output[v].append(tmp[v])
@@ -461,6 +747,100 @@ class WOA_var_nc(object):
 
         return output
 
+    def stream(self, records, chunk_size=1024, mode=None, var=None):
+        """ Values along an iterable of records, possibly unbounded
+
+            Each record is (doy, depth, lat, lon), or a dictionary with
+              those keys. The records are consumed lazily, chunk_size at a
+              time, each chunk evaluated with a single track(). Yields a
+              dictionary with the values of each var for each record, in
+              the same order (see utils.stream_track()).
+
+              for t in db['TEMP'].stream(feed, chunk_size=256):
+                  t['t_mn']
+        """
+        kwargs = {'mode': mode}
+        if var is not None:
+            kwargs['var'] = var
+        return stream_track(self.track, records,
+                ('doy', 'depth', 'lat', 'lon'), chunk_size, **kwargs)
+
+    def _linear_track(self, doy, depth, lat, lon, var):
+        """ Linear interpolation of each var along a track, at once
+
+            Instead of cropping and interpolating point by point, it reads
+              once the hyperslab that contains the whole track, and
+              evaluates all the points together. It is linear in time and
+              depth, and bilinear in lat x lon, ignoring the masked corners
+              (coastline) and renormalizing the weights of the valid ones.
+        """
+        plan = InterpolationPlan(self.axes, depth, lat, lon)
+        return self._interpolate_plan(plan, doy, var)
+
+    def plan(self, depth, lat, lon, cache=False):
+        """ Interpolation plan of a fixed set of points, see apply()
+
+            depth, lat and lon of N points, like the levels of a list of
+              stations. Their indices and weights on the grid are computed
+              once (see common.InterpolationPlan) and, with cache=True,
+              saved in OCEANSDB_DIR/cache, keyed by the dataset and the
+              points, so that the next sessions load it from there.
+        """
+        if cache:
+            return cached_plan(self.ncs[0].filename, self.axes, depth, lat,
+                    lon)
+        return InterpolationPlan(self.axes, depth, lat, lon)
+
+    def apply(self, plan, doy, var=None):
+        """ Linear interpolation of each var on the points of a plan
+
+            The same as track() on the points of the plan, but without
+              computing again the indices and weights. doy is one day of
+              year for all the points, or one for each point.
+
+              p = db['TEMP'].plan(depth=[0, 10, 0], lat=[17.5, 17.5, 10],
+                      lon=[-37.5, -37.5, -30], cache=True)
+              t = db['TEMP'].apply(p, doy=136.875)
+        """
+        with timed_call(self.instrument, 'apply'):
+            return self._apply(plan, doy, var)
+
+    def _apply(self, plan, doy, var=None):
+        if var is None:
+            var = np.asanyarray(self.KEYS)
+        else:
+            var = np.atleast_1d(var)
+        assert plan.matches(self.axes), "Plan of a different grid"
+        doy = np.atleast_1d(doy)
+        if type(doy[0]) is datetime:
+            doy = np.array([int(d.strftime('%j')) for d in doy])
+        if doy.shape == (1,):
+            doy = doy * np.ones(len(plan), dtype='i')
+        assert doy.shape == (len(plan),), "One doy, or one for each point"
+        return self._interpolate_plan(plan, doy, var)
+
+    def _interpolate_plan(self, plan, doy, var):
+        t = self.axes['time'].weights(doy)
+        # Each time is a different file
+        tn = np.unique(np.concatenate((t[0], t[1])))
+        t = (np.searchsorted(tn, t[0]), np.searchsorted(tn, t[1]),
+                t[2], t[3])
+        zn, yn, xn = plan.zn, plan.yn, plan.xn
+
+        output = {}
+        for v in var:
+            with timed_stage(self.instrument, 'read') as stage:
+                subset = ma.asanyarray([
+                    self.ncs[tnn][v][0, zn, yn, xn] for tnn in tn])
+                stage.count(subset)
+            with timed_stage(self.instrument, 'interpolate'):
+                values = rectilinear_points(
+                        ma.filled(subset.astype('f8'), np.nan),
+                        (t, plan.z, plan.y, plan.x))
+                output[v] = as_masked(values, subset.dtype)
+
+        return output
+
     def get_profile(var, doy, depth, lat, lon):
         print("get_profile is deprecated. You should migrate to extract()")
         return extract(var=var, doy=doy, depth=depth, lat=lat, lon=lon)
@@ -469,7 +849,8 @@ class WOA_var_nc(object):
 class WOA(object):
     """
     """
-    def __init__(self, dbname='WOA18', resolution=None, tscale=None):
+    def __init__(self, dbname='WOA18', resolution=None, tscale=None,
+            preload=False, memo=None, instrument=None):
         self.dbname = dbname
         self.data = {'sea_water_temperature': None,
                 'sea_water_salinity': None,
@@ -477,6 +858,17 @@ class WOA(object):
                 }
         self.resolution = resolution
         self.tscale = tscale
+        self.preload = preload
+        self.memo = memo
+        self.instrument = as_instrument(instrument)
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """Timings of the extractions, if instrumented (see Instrument)
+        """
+        if self.instrument is not None:
+            return self.instrument.stats
 
     def keys(self):
         return self.data.keys()
@@ -489,11 +881,26 @@ class WOA(object):
         elif item in ['DOXY']:
             return self['dissolved_oxygen']
 
-        if self.data[item] is None:
-            self.data[item] = WOA_var_nc(source=dbsource(
-                self.dbname, item, self.resolution, self.tscale))
+        with self._lock:
+            if self.data[item] is None:
+                with timed_stage(self.instrument, 'dbsource'):
+                    source = dbsource(
+                        self.dbname, item, self.resolution, self.tscale)
+                self.data[item] = WOA_var_nc(source=source,
+                    preload=self.preload, memo=as_memo(self.memo),
+                    instrument=self.instrument)
         return self.data[item]
 
+    def extract_many(self, variables, workers=None, **kwargs):
+        """Extract many variables concurrently, one thread for each
+
+           db.extract_many(['TEMP', 'PSAL'], doy=136.875, depth=[0, 10],
+                           lat=17.5, lon=-37.5)
+
+           See utils.extract_many()
+        """
+        return extract_many(self, variables, workers=workers, **kwargs)
+
     def __enter__(self):
         return self
 
@@ -8,6 +8,7 @@ from datetime import datetime
 
 import numpy as np
 from numpy import ma
+import pytest
 
 from oceansdb.cars import CARS
 
@@ -99,5 +100,231 @@ def test_special_cases_near_land():
 
         coords = [[-67.4683, 109.91, -1.55866820], [-4.32, 114.65, 28.42269382], [-66.95, 111.7, -1.47608867]]
         for (lat, lon, ans) in coords:
-            t = db["sea_water_temperature"].extract(var="mn", doy=90, depth=0, lat=lat, lon=lon)
+            t = db["sea_water_temperature"].extract(var="mn", doy=90, depth=0, lat=lat, lon=lon, mode="griddata")
             assert np.allclose(t["mn"], ans)
+
+
+def test_linear_special_cases_near_land():
+    """Same as test_special_cases_near_land(), with the default interpolator
+
+       Only the valid gridpoints around are used, with the bilinear
+       weights renormalized.
+    """
+    with CARS() as db:
+        y = db['sea_water_temperature'].dims['lat']
+        x = db['sea_water_temperature'].dims['lon']
+        for lat, lon in [[-67.4683, 109.91], [-4.32, 114.65], [-66.95, 111.7]]:
+            t = db["sea_water_temperature"].extract(var="mn", doy=90,
+                    depth=0, lat=lat, lon=lon)
+            j = np.searchsorted(y, lat, side='right') - 1
+            i = np.searchsorted(x, lon, side='right') - 1
+            corners = db["sea_water_temperature"].extract(var="mn", doy=90,
+                    depth=0, lat=y[j:j + 2], lon=x[i:i + 2])
+            corners = ma.filled(corners["mn"].astype('f8'), np.nan)
+            wy = (lat - y[j]) / (y[j + 1] - y[j])
+            wx = (lon - x[i]) / (x[i + 1] - x[i])
+            w = np.outer([1 - wy, wy], [1 - wx, wx])
+            good = np.isfinite(corners)
+            if not good.any():
+                assert ma.getmaskarray(t["mn"]).all()
+                continue
+            ans = (corners[good] * w[good]).sum() / w[good].sum()
+            assert np.allclose(t["mn"], ans)
+
+
+def test_nearest():
+    with CARS() as db:
+        t = db['sea_water_temperature'].extract(var='mn', doy=100,
+                depth=[0, 10], lat=[17.5, 12.5], lon=322.5, mode='nearest')
+        assert np.allclose(np.squeeze(t['mn']),
+                [[24.61333538, 23.78240879], [24.7047015, 23.97279877]])
+
+        t = db['sea_water_temperature'].extract(var='mn', doy=100,
+                depth=1, lat=17.3, lon=-37.4, mode='nearest')
+        assert np.allclose(t['mn'], [23.78240879])
+
+
+def test_nearest_lon_cyclic():
+    """Across the end of the longitude, only the points around are read
+    """
+    with CARS() as db:
+        t = db['sea_water_temperature'].extract(var='mn', doy=100,
+                depth=0, lat=17.5, lon=[359.8, 0.3], mode='nearest')
+        for i, lon in enumerate([359.8, 0.3]):
+            ans = db['sea_water_temperature'].extract(var='mn', doy=100,
+                    depth=0, lat=17.5, lon=lon, mode='nearest')
+            assert ma.allequal(np.ravel(t['mn'])[i], ans['mn'])
+
+
+def test_interpolate_griddata():
+    """The default interpolator must match griddata on the gridpoints
+    """
+    with CARS() as db:
+        params = {"var": "mn", "doy": [100, 150], "depth": [0, 10, 12],
+                  "lat": [17.5, 12.5], "lon": [322.5, 327.5]}
+        t1 = db['sea_water_temperature'].extract(mode='griddata', **params)
+        t2 = db['sea_water_temperature'].extract(**params)
+        assert t1['mn'].shape == t2['mn'].shape
+        assert ma.allclose(t1['mn'], t2['mn'])
+
+
+def test_preload():
+    """Preloaded in memory must give the same values than from the files
+    """
+    params = {"var": ["mn", "sd"], "doy": [10, 200],
+              "depth": [0, 10, 500], "lat": [17.5, -30.2],
+              "lon": [322.5, 179.9]}
+    with CARS() as db:
+        t1 = db['sea_water_temperature'].extract(**params)
+    with CARS(preload=True) as db:
+        assert db['sea_water_temperature'].nbytes > 0
+        t2 = db['sea_water_temperature'].extract(**params)
+    for v in params['var']:
+        assert ma.allequal(t1[v], t2[v])
+        assert (ma.getmaskarray(t1[v]) == ma.getmaskarray(t2[v])).all()
+
+
+def test_harmonics_many_days():
+    """Evaluating many days at once must be the same as day by day
+    """
+    from oceansdb.cars import harmonics
+
+    with CARS() as db:
+        nc = db['sea_water_temperature'].ncs[0]
+        doy = np.array([1, 45.5, 200, 366])
+        zn, yn, xn = slice(50, 70), slice(100, 103), [359, 0, 1]
+        t = harmonics(nc, doy, zn, yn, xn)
+        assert t.shape == (4, 20, 3, 3)
+        for i, d in enumerate(doy):
+            ti = harmonics(nc, d, zn, yn, xn)
+            assert ma.allequal(t[i], ti[0])
+            assert (ma.getmaskarray(t[i]) == ma.getmaskarray(ti[0])).all()
+
+
+def test_extract_many():
+    """Concurrent extraction must be the same as one at a time
+    """
+    params = {"var": "mn", "doy": 136.875, "depth": [0, 10, 100],
+              "lat": [17.5, 20], "lon": 322.5}
+    with CARS() as db:
+        output = db.extract_many(['TEMP', 'PSAL'], **params)
+        for v in output:
+            ans = db[v].extract(**params)
+            assert ma.allequal(output[v]['mn'], ans['mn'])
+
+
+def test_track():
+    """A track must be the same as each point extracted at a time
+    """
+    doy = [10, 45.5, 200, 366]
+    depth = [0, 10, 500, 1200]
+    lat = [17.5, -30.2, 10.1, 45]
+    lon = [322.5, 179.9, 0.3, 359.8]
+    with CARS() as db:
+        t = db['sea_water_temperature'].track(
+                doy=doy, depth=depth, lat=lat, lon=lon)
+        for i in range(len(doy)):
+            ans = db['sea_water_temperature'].extract(
+                    doy=doy[i], depth=depth[i], lat=lat[i], lon=lon[i])
+            for v in ans:
+                assert ma.allequal(t[v][i], ans[v])
+                assert ma.getmaskarray(t[v])[i] == ma.getmaskarray(ans[v])
+
+
+def test_precompute():
+    """Interpolating in time the precomputed days
+    """
+    params = {"var": "mn", "depth": [0, 10, 500], "lat": [17.5, -30.2],
+              "lon": [322.5, 179.9]}
+    with CARS() as db:
+        t100 = db['TEMP'].extract(doy=100, **params)['mn']
+        t200 = db['TEMP'].extract(doy=200, **params)['mn']
+        # Across the end of the longitude, from a list of indices
+        p = db['TEMP'].plan(depth=[0, 10], lat=[17.5, 17.5], lon=[359.8, 0.3])
+        ans = db['TEMP'].apply(p, doy=100, var='mn')['mn']
+        casts = {"doy": [100, 100], "lat": [17.5, 17.5], "lon": [359.8, 0.3],
+                 "depth": [0, 10], "offsets": [0, 1, 2], "var": "mn"}
+        ans_casts = db['TEMP'].profiles(**casts)['mn']
+        db['TEMP'].precompute([100, 200])
+        assert db['TEMP'].cube.shape[0] == 2
+        assert ma.allequal(db['TEMP'].apply(p, doy=100, var='mn')['mn'], ans)
+        assert ma.allequal(db['TEMP'].profiles(**casts)['mn'], ans_casts)
+        t = db['TEMP'].extract(doy=100, **params)['mn']
+        assert ma.allequal(t, t100)
+        assert (ma.getmaskarray(t) == ma.getmaskarray(t100)).all()
+        t = db['TEMP'].extract(doy=150, **params)['mn']
+        assert np.allclose(t, (t100.astype('f8') + t200) / 2, atol=1e-5)
+        t = db['TEMP'].track(doy=[100, 200], depth=10, lat=17.5,
+                             lon=322.5, var='mn')['mn']
+        assert ma.allequal(t, [t100[1, 0, 0], t200[1, 0, 0]])
+
+        # A sequence of a single day, not a number of days
+        db['TEMP'].precompute([100])
+        assert db['TEMP'].cube.shape[0] == 1
+        t = db['TEMP'].extract(doy=100, **params)['mn']
+        assert ma.allequal(t, t100)
+        db['TEMP'].precompute(np.array(4))
+        assert db['TEMP'].cube.shape[0] == 4
+
+        # Too large to be kept in memory
+        with pytest.raises(ValueError):
+            db['TEMP'].precompute(4, max_bytes=2**20)
+
+
+def test_profile():
+    """The profile fast path is the same as extract()
+    """
+    with CARS() as db:
+        for depth in (None, [0, 10, 12.5, 5000]):
+            kwargs = {} if depth is None else {'depth': depth}
+            ans = db['TEMP'].extract(doy=136.875, lat=17.3, lon=322.8,
+                                     **kwargs)
+            t = db['TEMP'].profile(doy=136.875, lat=17.3, lon=322.8,
+                                   depth=depth)
+            for v in ans:
+                assert t[v].shape == ans[v].shape
+                assert ma.allequal(t[v], ans[v])
+                assert (ma.getmaskarray(t[v]) ==
+                        ma.getmaskarray(ans[v])).all()
+
+
+def test_profiles():
+    """Many casts at once are the same as one extract() for each cast
+    """
+    doy = [136.875, 10, 300]
+    lat = [17.3, -10.2, 40.6]
+    lon = [322.8, 5.1, 199.7]
+    depth = [0, 10, 12.5, 5000, 20, 1000, 7.5]
+    offsets = [0, 4, 4, 7]
+    with CARS() as db:
+        t = db['TEMP'].profiles(doy=doy, lat=lat, lon=lon, depth=depth,
+                                offsets=offsets)
+        for i in (0, 2):
+            ans = db['TEMP'].extract(doy=doy[i], lat=lat[i], lon=lon[i],
+                                     depth=depth[offsets[i]:offsets[i + 1]])
+            for v in ans:
+                assert t[v].shape == (len(depth),)
+                tv = t[v][offsets[i]:offsets[i + 1]]
+                assert ma.allequal(tv, ans[v])
+                assert (ma.getmaskarray(tv) == ma.getmaskarray(ans[v])).all()
+
+
+def test_regrid():
+    """Regrid is the same as extract() on the target grid
+    """
+    lat = np.arange(10, 20, 1 / 3.)
+    lon = np.arange(320, 335, 1 / 3.)
+    depth = [0, 12.5, 1000]
+    with CARS() as db:
+        t = db['TEMP'].regrid(doy=136.875, lat=lat, lon=lon, depth=depth)
+        ans = db['TEMP'].extract(doy=136.875, lat=lat, lon=lon, depth=depth)
+        for v in ans:
+            assert t[v].shape == ans[v].shape
+            assert t[v].dtype == ans[v].dtype
+            assert ma.allequal(t[v], ans[v])
+            assert (ma.getmaskarray(t[v]) == ma.getmaskarray(ans[v])).all()
+
+        w = db['TEMP'].regrid_weights(lat=lat, lon=lon, depth=depth)
+        t = db['TEMP'].regrid(doy=[10, 136.875], weights=w, var='mn')
+        assert t['mn'].shape == (2, 3, lat.size, lon.size)
+        assert ma.allequal(t['mn'][1], ans['mn'])
@@ -87,3 +87,63 @@ def test_track():
 
         h = db['topography'].track(lat=[12, 15], lon=[-38, -35])
         assert np.allclose(h['height'], [-4895.982 , -5959.1216])
+
+
+def test_nearest():
+    """On coincident gridpoints nearest must be the same as interpolate
+    """
+    with ETOPO() as db:
+        h1 = db['topography'].extract(lat=[17.5, 18.5], lon=[0, 0.25],
+                mode='nearest')
+        h2 = db['topography'].extract(lat=[17.5, 18.5], lon=[0, 0.25])
+        assert np.allclose(h1['height'], h2['height'])
+
+        h1 = db['topography'].extract(lat=17.5, lon=-177.5, mode='nearest')
+        h2 = db['topography'].extract(lat=17.5, lon=182.5, mode='nearest')
+        assert np.allclose(h1['height'], h2['height'])
+
+        # Across the end of the longitude, only the points around are read
+        h = db['topography'].extract(lat=17.5, lon=[179.9, -179.9],
+                mode='nearest')
+        for i, lon in enumerate([179.9, -179.9]):
+            ans = db['topography'].extract(lat=17.5, lon=lon, mode='nearest')
+            assert np.allclose(np.ravel(h['height'])[i], ans['height'])
+
+
+def test_interpolate_griddata():
+    """The default interpolator must match griddata on the gridpoints
+    """
+    with ETOPO() as db:
+        h1 = db['topography'].extract(lat=[17.5, 18.5], lon=[0, 0.25],
+                mode='griddata')
+        h2 = db['topography'].extract(lat=[17.5, 18.5], lon=[0, 0.25])
+        assert np.allclose(h1['height'], h2['height'])
+
+
+def test_tile_cache():
+    """Neighbour lookups are served from the tiles in memory
+    """
+    with ETOPO(tile_size=16) as db:
+        etopo = db['topography']
+        lat = np.linspace(10, 10.5, 20)
+        lon = np.linspace(38, 38.5, 20)
+        z = etopo.track(lat=lat, lon=lon)
+        assert z['height'].shape == (20,)
+        stats = etopo.tiles.stats
+        assert stats['hits'] > stats['misses'] > 0
+
+
+def test_track_vectorized():
+    """A track must be the same as each point extracted individually
+
+       Including across Greenwich and the date line.
+    """
+    lat = [10, 10.51, -45.1, 0.02, 89.9]
+    lon = [38, -180, 359.97, 0.03, 540.2]
+    with ETOPO() as db:
+        for mode in [None, 'nearest']:
+            z = db['topography'].track(lat=lat, lon=lon, mode=mode)
+            assert z['height'].shape == (5,)
+            for y, x, h in zip(lat, lon, z['height']):
+                ans = db['topography'].extract(lat=y, lon=x, mode=mode)
+                assert np.allclose(h, ans['height'])
@@ -10,6 +10,7 @@ import numpy as np
 from numpy import ma
 
 from oceansdb.woa import WOA
+from oceansdb.utils import MemoCache
 
 
 def test_import():
@@ -141,7 +142,8 @@ def test_no_data_available():
     with WOA() as db:
         out = db['sea_water_temperature'].extract(
                 doy=155, lat=48.1953, lon=-69.5855,
-                depth=[2.0, 5.0, 6.0, 21.0, 44.0, 79.0, 5000])
+                depth=[2.0, 5.0, 6.0, 21.0, 44.0, 79.0, 5000],
+                mode='griddata')
         varnames = [u't_dd', u't_mn', u't_sd', u't_se']
         for v in varnames:
             assert v in out.keys()
@@ -189,7 +191,7 @@ def test_get_point_inland():
     with WOA() as db:
 
         t = db['sea_water_temperature'].extract(var='t_mn', doy=90,
-                depth=0, lat=-19.9, lon=-43.9)
+                depth=0, lat=-19.9, lon=-43.9, mode='griddata')
         assert t['t_mn'].mask.all()
 
 
@@ -197,11 +199,11 @@ def test_get_profile():
     with WOA(dbname='WOA13') as db:
 
         t = db['sea_water_temperature'].extract(var='mean', doy=10,
-                depth=[0,10], lat=10, lon=330)
+                depth=[0,10], lat=10, lon=330, mode='griddata')
         assert np.allclose(t['mean'], [ 26.07524300,  26.12986183])
 
         t = db['sea_water_temperature'].extract(doy=10,
-                depth=[0,10], lat=10, lon=330)
+                depth=[0,10], lat=10, lon=330, mode='griddata')
         assert np.allclose(t['t_se'], [ 0.02941939,  0.0287159 ])
         assert np.allclose(t['t_sd'], [ 0.8398821,  0.8142529])
         assert np.allclose(t['t_mn'], [ 26.07524300,  26.12986183])
@@ -252,7 +254,8 @@ def test_track():
                 ]
 
         for p in params:
-            t = db['sea_water_temperature'].track(var='t_mn', **p[0])
+            t = db['sea_water_temperature'].track(var='t_mn',
+                    mode='griddata', **p[0])
             assert np.allclose(t['t_mn'], p[1])
 
 def test_dev():
@@ -278,6 +281,7 @@ def test_track_on_land():
     with WOA() as db:
         t = db["sea_water_temperature"].track(
             var="mean",
+            mode="griddata",
             doy=136.875,
             depth=0,
             lon=[1.4357, 1.4376],
@@ -285,3 +289,366 @@ def test_track_on_land():
         )
         for v in t:
             assert ma.getmaskarray(t[v]).all()
+
+
+def test_track_linear():
+    """Batched linear track must match the point by point interpolation
+
+       On coincident lat/lon/time both interpolators are equivalent, so
+       the vectorized track should reproduce track() point by point.
+    """
+    with WOA() as db:
+        params = {"doy": [136.875, 228.125, 136.875, 228.125],
+                  "depth": [0, 10, 15, 300],
+                  "lat": [17.5, 12.5, 17.5, -2.5],
+                  "lon": [-37.5, -32.5, 322.5, 2.5]}
+        t1 = db['sea_water_temperature'].track(mode='griddata', **params)
+        t2 = db['sea_water_temperature'].track(**params)
+        for v in t1:
+            assert t1[v].shape == t2[v].shape
+            assert ma.allclose(t1[v], t2[v])
+
+
+def test_interpolate_griddata():
+    """The default interpolator must match griddata on the gridpoints
+
+       The values of some tests above were obtained with griddata, thus
+       those are explicitly requested with mode='griddata'.
+    """
+    with WOA() as db:
+        params = {"var": "t_mn", "doy": [136.875, 228.125],
+                  "depth": [0, 10, 12], "lat": [17.5, 12.5],
+                  "lon": [-37.5, -32.5]}
+        t1 = db['sea_water_temperature'].extract(mode='griddata', **params)
+        t2 = db['sea_water_temperature'].extract(**params)
+        assert t1['t_mn'].shape == t2['t_mn'].shape
+        assert ma.allclose(t1['t_mn'], t2['t_mn'])
+
+        # In open ocean, both should be close
+        t1 = db['sea_water_temperature'].extract(var='t_mn', doy=10,
+                depth=[0, 10], lat=10, lon=330, mode='griddata')
+        t2 = db['sea_water_temperature'].extract(var='t_mn', doy=10,
+                depth=[0, 10], lat=10, lon=330)
+        assert ma.allclose(t1['t_mn'], t2['t_mn'], atol=0.5)
+
+
+def bilinear(db, var, lat, lon, **kwargs):
+    """Expected default interpolation, from the 2 x 2 gridpoints around
+
+       The gridpoints are extracted exactly, and combined with the
+       bilinear weights of the valid ones, renormalized.
+    """
+    y, x = db.dims['lat'], db.dims['lon']
+    lon = (lon - x[0]) % 360 + x[0]
+    j = np.searchsorted(y, lat, side='right') - 1
+    i = np.searchsorted(x, lon, side='right') - 1
+    corners = db.extract(var=var, lat=y[j:j + 2], lon=x[i:i + 2], **kwargs)
+    corners = ma.filled(corners[var].astype('f8'), np.nan)
+    wy = (lat - y[j]) / (y[j + 1] - y[j])
+    wx = (lon - x[i]) / (x[i + 1] - x[i])
+    w = np.outer([1 - wy, wy], [1 - wx, wx])
+    good = np.isfinite(corners)
+    num = (np.where(good, corners, 0) * w).sum(axis=(-2, -1))
+    den = (good * w).sum(axis=(-2, -1))
+    return ma.masked_invalid(np.where(den > 0, num, np.nan) / den)
+
+
+def test_linear_get_profile():
+    """Same profile as test_get_profile(), with the default interpolator
+    """
+    with WOA() as db:
+        t = db['sea_water_temperature'].extract(doy=10, depth=[0, 10],
+                lat=10, lon=330)
+        for v in ('t_mn', 't_sd', 't_se'):
+            ans = bilinear(db['sea_water_temperature'], v, 10, 330,
+                    doy=10, depth=[0, 10])
+            assert ma.allclose(t[v], ans)
+
+
+def test_linear_track():
+    """Same track as test_track(), with the default interpolator
+    """
+    params = {"doy": [34, 120, 34, 34], "depth": [0, 0, 300, 0],
+              "lat": [10, 10, 10, 12], "lon": [330, 330, 330, -25]}
+    with WOA() as db:
+        t = db['sea_water_temperature'].track(var='t_mn', **params)
+        for i in range(len(params['doy'])):
+            ans = bilinear(db['sea_water_temperature'], 't_mn',
+                    params['lat'][i], params['lon'][i],
+                    doy=params['doy'][i], depth=params['depth'][i])
+            assert ma.allclose(t['t_mn'][i], ans)
+
+
+def test_linear_near_land():
+    """Near land only the valid gridpoints around are used
+
+       Same positions as test_no_data_available(), test_get_point_inland()
+       and test_track_on_land(), with the default interpolator. Instead of
+       masked, these are defined if any of the gridpoints around is valid.
+    """
+    cases = [(48.1953, -69.5855, [0, 5, 20, 45, 80, 5000]),
+             (-19.9, -43.9, 0), (43.5938, 1.4357, 0), (43.5980, 1.4376, 0)]
+    with WOA() as db:
+        for lat, lon, depth in cases:
+            t = db['sea_water_temperature'].extract(var='t_mn',
+                    doy=136.875, depth=depth, lat=lat, lon=lon)
+            ans = bilinear(db['sea_water_temperature'], 't_mn', lat, lon,
+                    doy=136.875, depth=depth)
+            t = np.reshape(t['t_mn'], np.shape(ans))
+            assert (ma.getmaskarray(t) == ma.getmaskarray(ans)).all()
+            assert ma.allclose(t, ans)
+
+
+def test_preload():
+    """Preloaded in memory must give the same values than from the files
+    """
+    params = {"var": ["t_mn", "t_sd"], "doy": [10, 200],
+              "depth": [0, 10, 500], "lat": [17.5, -30.2],
+              "lon": [-37.5, 179.9]}
+    with WOA() as db:
+        t1 = db['sea_water_temperature'].extract(**params)
+    with WOA(preload=['t_mn', 't_sd']) as db:
+        assert db['sea_water_temperature'].nbytes > 0
+        t2 = db['sea_water_temperature'].extract(**params)
+    for v in params['var']:
+        assert ma.allequal(t1[v], t2[v])
+        assert (ma.getmaskarray(t1[v]) == ma.getmaskarray(t2[v])).all()
+
+
+def test_extract_many():
+    """Concurrent extraction must be the same as one at a time
+    """
+    params = {"doy": 136.875, "depth": [0, 10, 100], "lat": [17.5, 20],
+              "lon": -37.5}
+    with WOA() as db:
+        output = db.extract_many(['TEMP', 'PSAL'], **params)
+        assert list(output) == ['TEMP', 'PSAL']
+        for v in output:
+            ans = db[v].extract(**params)
+            for k in ans:
+                assert ma.allequal(output[v][k], ans[k])
+
+        output = db.extract_many({'TEMP': 't_mn', 'PSAL': ['s_mn', 's_sd']},
+                **params)
+        assert list(output['TEMP']) == ['t_mn']
+        assert list(output['PSAL']) == ['s_mn', 's_sd']
+
+
+def test_threads():
+    """Many threads sharing the same database
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    points = [(d, lat, lon) for d in [10, 100, 200]
+              for lat in [-30.2, 17.5] for lon in [-37.5, 120.3, 179.9]]
+    with WOA() as db:
+        def job(p):
+            return db['TEMP'].extract(var='t_mn', doy=p[0], depth=[0, 100],
+                    lat=p[1], lon=p[2])['t_mn']
+        ans = [job(p) for p in points]
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            output = list(executor.map(job, points))
+    for a, b in zip(ans, output):
+        assert ma.allequal(a, b)
+
+
+def test_track_workers():
+    """A track split among processes must be identical to the serial one
+    """
+    params = {"doy": [10, 45.2, 136.875, 200, 300, 364],
+              "depth": [0, 10, 15, 100, 500, 1000],
+              "lat": [17.5, -30.2, 10, 45.3, -60.1, 0],
+              "lon": [-37.5, 179.9, 350, 0, -120.2, 60]}
+    with WOA() as db:
+        ans = db['TEMP'].track(var=['t_mn', 't_dd'], **params)
+        output = db['TEMP'].track(var=['t_mn', 't_dd'], workers=2, **params)
+    for v in ans:
+        assert ans[v].dtype == output[v].dtype
+        assert ma.allequal(ans[v], output[v])
+        assert (ma.getmaskarray(ans[v]) == ma.getmaskarray(output[v])).all()
+
+
+def test_coalescer():
+    """Coalesced concurrent queries must be the same as one at a time
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from oceansdb.coalesce import Coalescer
+
+    queries = [{'doy': 10 + i, 'depth': [0, 10 * i], 'lat': 17.5 + i / 10.,
+                'lon': -37.5 + (i % 4)} for i in range(16)]
+    queries.append({'doy': 10, 'lat': 17.5, 'lon': -37.5})
+    with WOA() as db:
+        temp = Coalescer(db['TEMP'], window=0.01)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            output = list(executor.map(lambda q: temp.extract(**q), queries))
+        assert temp.stats['requests'] == len(queries)
+        assert temp.stats['groups'] < len(queries)
+        # All the queries of a batch in a single track()
+        assert temp.stats['groups'] == temp.stats['batches']
+        for q, t in zip(queries, output):
+            ans = db['TEMP'].extract(**q)
+            for v in ans:
+                assert t[v].shape == ans[v].shape
+                assert ma.allequal(t[v], ans[v])
+                assert (ma.getmaskarray(t[v]) == ma.getmaskarray(ans[v])).all()
+
+
+def test_memo():
+    """Repeated extractions from the memo are the same
+    """
+    params = {"doy": 136.875, "depth": [0, 10], "lat": 17.5, "lon": -37.5}
+    with WOA(memo=True) as db:
+        t1 = db['TEMP'].extract(**params)
+        t2 = db['TEMP'].extract(**params)
+        assert db['TEMP'].memo.stats['hits'] == 1
+    with WOA() as db:
+        assert db['TEMP'].memo is None
+        ans = db['TEMP'].extract(**params)
+    for v in ans:
+        assert ma.allequal(t1[v], ans[v])
+        assert ma.allequal(t2[v], ans[v])
+
+
+def test_memo_shared():
+    """One MemoCache shared by many variables keeps them apart
+    """
+    memo = MemoCache()
+    params = {"doy": 136.875, "depth": [0, 10], "lat": 17.5, "lon": -37.5}
+    with WOA(memo=memo) as db:
+        assert db['TEMP'].memo is memo
+        assert db['PSAL'].memo is memo
+        t = db['TEMP'].extract(**params)
+        s = db['PSAL'].extract(**params)
+        assert memo.stats['misses'] == 2
+        assert ma.allequal(db['TEMP'].extract(**params)['t_mn'], t['t_mn'])
+        assert ma.allequal(db['PSAL'].extract(**params)['s_mn'], s['s_mn'])
+        assert memo.stats['hits'] == 2
+
+
+def test_stream():
+    """A stream of records is the same as track()
+    """
+    doy = [136.875, 136.875, 10]
+    depth = [0, 10, 100]
+    lat = [17.5, 17.5, -10.2]
+    lon = [-37.5, -37.5, 5.1]
+    with WOA() as db:
+        ans = db['TEMP'].track(doy=doy, depth=depth, lat=lat, lon=lon)
+        output = db['TEMP'].stream(zip(doy, depth, lat, lon), chunk_size=2)
+        for i, t in enumerate(output):
+            for v in ans:
+                assert ma.allequal(t[v], ans[v][i])
+
+
+def test_instrument():
+    """Instrumented extractions record their stages and data read
+    """
+    records = []
+    params = {"doy": 136.875, "depth": [0, 10], "lat": 17.5, "lon": -37.5}
+    with WOA(instrument=records.append) as db:
+        t = db['TEMP'].extract(**params)
+        db['TEMP'].track(**params)
+        stats = db.stats
+    assert [r['method'] for r in records] == ['extract', 'track']
+    assert stats['calls'] == {'extract': 1, 'track': 1}
+    assert 'dbsource' in stats['stages']
+    assert 'read' in records[0]['stages']
+    assert records[0]['cells'] >= t['t_mn'].size
+    assert stats['bytes'] == sum(r['bytes'] for r in records)
+    with WOA() as db:
+        assert db.stats is None
+        ans = db['TEMP'].extract(**params)
+    for v in ans:
+        assert ma.allequal(t[v], ans[v])
+
+
+def test_profile():
+    """The profile fast path is the same as extract()
+    """
+    with WOA() as db:
+        for depth in (None, [0, 10, 12.5, 5000]):
+            kwargs = {} if depth is None else {'depth': depth}
+            ans = db['TEMP'].extract(doy=136.875, lat=17.3, lon=-37.2,
+                                     **kwargs)
+            t = db['TEMP'].profile(doy=136.875, lat=17.3, lon=-37.2,
+                                   depth=depth)
+            for v in ans:
+                assert t[v].shape == ans[v].shape
+                assert t[v].dtype == ans[v].dtype
+                assert ma.allequal(t[v], ans[v])
+                assert (ma.getmaskarray(t[v]) ==
+                        ma.getmaskarray(ans[v])).all()
+
+
+def test_profile_date_line():
+    """Only the columns around a profile are read, even at the date line
+    """
+    records = []
+    params = {"doy": 136.875, "depth": [0, 10], "lat": 17.3}
+    with WOA(instrument=records.append) as db:
+        db['TEMP'].profile(lon=-37.2, **params)
+        t = db['TEMP'].profile(lon=179.9, **params)
+        ans = db['TEMP'].extract(lon=179.9, **params)
+    assert records[1]['cells'] == records[0]['cells']
+    for v in ans:
+        assert ma.allequal(t[v], ans[v])
+
+
+def test_profiles():
+    """Many casts at once are the same as one extract() for each cast
+    """
+    doy = [136.875, 10, 300]
+    lat = [17.3, -10.2, 40.6]
+    lon = [-37.2, 5.1, -160.3]
+    depth = [0, 10, 12.5, 5000, 20, 1000, 7.5]
+    offsets = [0, 4, 4, 7]
+    with WOA() as db:
+        t = db['TEMP'].profiles(doy=doy, lat=lat, lon=lon, depth=depth,
+                                offsets=offsets)
+        for i in (0, 2):
+            ans = db['TEMP'].extract(doy=doy[i], lat=lat[i], lon=lon[i],
+                                     depth=depth[offsets[i]:offsets[i + 1]])
+            for v in ans:
+                assert t[v].shape == (len(depth),)
+                assert t[v].dtype == ans[v].dtype
+                tv = t[v][offsets[i]:offsets[i + 1]]
+                assert ma.allequal(tv, ans[v])
+                assert (ma.getmaskarray(tv) == ma.getmaskarray(ans[v])).all()
+
+
+def test_regrid():
+    """Regrid is the same as extract() on the target grid
+    """
+    lat = np.arange(10, 20, 1 / 3.)
+    lon = np.arange(-40, -25, 1 / 3.)
+    depth = [0, 12.5, 1000]
+    with WOA() as db:
+        t = db['TEMP'].regrid(doy=136.875, lat=lat, lon=lon, depth=depth)
+        ans = db['TEMP'].extract(doy=136.875, lat=lat, lon=lon, depth=depth)
+        for v in ans:
+            assert t[v].shape == ans[v].shape
+            assert t[v].dtype == ans[v].dtype
+            assert ma.allequal(t[v], ans[v])
+            assert (ma.getmaskarray(t[v]) == ma.getmaskarray(ans[v])).all()
+
+        w = db['TEMP'].regrid_weights(lat=lat, lon=lon, depth=depth)
+        t = db['TEMP'].regrid(doy=[10, 136.875], weights=w, var='t_mn')
+        assert t['t_mn'].shape == (2, 3, lat.size, lon.size)
+        assert ma.allequal(t['t_mn'][1], ans['t_mn'])
+
+
+def test_plan():
+    """A plan applied on any day is the same as track()
+    """
+    depth = [0, 10, 100, 5000]
+    lat = [17.5, 17.5, -10.2, 40.6]
+    lon = [-37.5, -37.5, 5.1, -160.3]
+    with WOA() as db:
+        plan = db['TEMP'].plan(depth=depth, lat=lat, lon=lon)
+        for doy in (136.875, [10, 100, 200, 300]):
+            t = db['TEMP'].apply(plan, doy=doy)
+            ans = db['TEMP'].track(doy=doy, depth=depth, lat=lat, lon=lon)
+            for v in ans:
+                assert t[v].dtype == ans[v].dtype
+                assert ma.allequal(t[v], ans[v])
+                assert (ma.getmaskarray(t[v]) == ma.getmaskarray(ans[v])).all()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+"""
+
+import asyncio
+
+import numpy as np
+from numpy import ma
+
+from oceansdb import WOA
+from oceansdb.aio import AsyncWOA
+
+
+def test_concurrent_requests():
+    """Concurrent requests are grouped, and give the same as WOA
+    """
+    tracks = [{"doy": [10, 200], "depth": [0, 100],
+               "lat": [17.5, -30.2], "lon": [-37.5, 179.9]},
+              {"doy": 136.875, "depth": [0, 10, 500],
+               "lat": 10.1, "lon": 330}]
+    point = {"doy": 136.875, "depth": [0, 10], "lat": 17.5, "lon": -37.5}
+
+    async def main():
+        async with AsyncWOA(window=0.01) as db:
+            output = await asyncio.gather(
+                    db['TEMP'].track(**tracks[0]),
+                    db['TEMP'].track(**tracks[1]),
+                    db['TEMP'].extract(**point))
+            assert db.stats['requests'] == 3
+            assert db.stats['batches'] == 1
+        return output
+
+    output = asyncio.run(main())
+    with WOA() as db:
+        ans = [db['TEMP'].track(**tracks[0]), db['TEMP'].track(**tracks[1]),
+               db['TEMP'].extract(**point)]
+    for a, b in zip(ans, output):
+        for v in a:
+            assert ma.allequal(a[v], b[v])
+            assert (ma.getmaskarray(a[v]) == ma.getmaskarray(b[v])).all()
+
+
+def test_invalid_request():
+    """An invalid request fails alone
+    """
+    async def main():
+        async with AsyncWOA(window=0.01) as db:
+            return await asyncio.gather(
+                    db['TEMP'].track(doy=10, depth=0, lat=[1, 2], lon=[3]),
+                    db['TEMP'].track(doy=10, depth=0, lat=[1, 2], lon=[3, 4]),
+                    return_exceptions=True)
+
+    output = asyncio.run(main())
+    assert isinstance(output[0], Exception)
+    assert output[1]['t_mn'].shape == (2,)
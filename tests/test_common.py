@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+"""
+
+import numpy as np
+import pytest
+
+from oceansdb.common import GridAxis, cropIndices
+
+
+def test_gridaxis_weights():
+    lon = GridAxis(np.arange(-179.5, 180, 1), period=360)
+    i0, i1, w, valid = lon.weights([-38.25, 179.75, 540.5])
+    assert valid.all()
+    assert np.allclose(w, [0.25, 0.25, 0])
+    assert (i0 == [141, 359, 0]).all()
+    assert (i1 == [142, 0, 1]).all()
+    assert (lon.nearest([-38.25, 179.75, 540.5]) == [141, 359, 0]).all()
+
+    depth = GridAxis([0, 10, 20, 50])
+    i0, i1, w, valid = depth.weights([5, 50, 60])
+    assert (valid == [True, True, False]).all()
+    assert (depth.nearest([4, 6, 60]) == [0, 1, 3]).all()
+
+
+def test_gridaxis_crop():
+    """Crop around a range, across the date line on a cyclic axis
+    """
+    lat = GridAxis(np.arange(-89.5, 90, 1))
+    yn, coords = lat.crop(10.5, 12.2)
+    assert yn == slice(99, 103)
+    assert np.allclose(coords, [9.5, 10.5, 11.5, 12.5])
+    with pytest.raises(ValueError):
+        lat.crop(-89.9, 0)
+
+    lon = GridAxis(np.arange(0.5, 360, 1), period=360)
+    xn, coords = lon.crop(358, 362)
+    assert xn == [357, 358, 359, 0, 1, 2]
+    assert np.allclose(coords, [357.5, 358.5, 359.5, 360.5, 361.5, 362.5])
+
+    # Same as building the axes at every call
+    dims = {'lat': np.arange(-89.5, 90, 1), 'lon': np.arange(0.5, 360, 1)}
+    axes = {'lat': GridAxis(dims['lat']), 'lon': lon}
+    args = (np.array([10, 12.2]), np.array([-2, 1]))
+    dims_out, idx = cropIndices(dims, *args)
+    axes_out, axes_idx = cropIndices(axes, *args)
+    assert idx == axes_idx
+    for d in dims_out:
+        assert np.allclose(dims_out[d], axes_out[d])
+
+
+def test_gridaxis_hyperslab():
+    """Only the neighbours are read, even across the date line
+    """
+    lon = GridAxis(np.arange(-179.5, 180, 1), period=360)
+    xn, (i0, i1, w, valid) = lon.hyperslab([179.9])
+    assert xn == [359, 0]
+    assert (i0 == [0]).all() and (i1 == [1]).all()
+    assert np.allclose(w, [0.4])
+
+    x = [178.2, 179.9, -179.2, -177.6]
+    xn, (i0, i1, w, valid) = lon.hyperslab(x)
+    assert xn == [357, 358, 359, 0, 1, 2]
+    idx = np.array(xn)
+    full = lon.weights(x)
+    assert (idx[i0] == full[0]).all()
+    assert (idx[i1] == full[1]).all()
+
+    # Away from the date line it is a slice
+    xn, (i0, i1, w, valid) = lon.hyperslab([-38.25, -36.6])
+    assert xn == slice(141, 144)
+    assert (i0 == [0, 1]).all() and (i1 == [1, 2]).all()
+
+    # Around the globe, the largest gap is left out
+    xn, _ = lon.hyperslab(np.arange(-179, 180, 90))
+    assert xn == slice(0, 272)
+
+    lat = GridAxis(np.arange(-89.5, 90, 1))
+    yn, (i0, i1, w, valid) = lat.hyperslab([-89.2, 89.2])
+    assert yn == slice(0, 180)
+
+
+def test_rectilinear_casts():
+    """Ragged profiles are the same as one rectilinear() for each cast
+    """
+    from oceansdb.common import cast_index, rectilinear, rectilinear_casts
+
+    rng = np.random.RandomState(0)
+    data = rng.rand(2, 5, 4, 6)
+    data[:, 3:, 1, 2] = np.nan
+    time = GridAxis([0, 10])
+    depth = GridAxis([0, 10, 20, 50, 100])
+    lat = GridAxis(np.arange(4.))
+    lon = GridAxis(np.arange(6.))
+    casts = [(2.5, 0.5, 1.3, [5, 60, 20]), (7, 1.2, 2.5, []),
+             (10, 2.9, 4.1, [0, 200])]
+    z = np.concatenate([c[-1] for c in casts])
+    offsets = np.cumsum([0] + [len(c[-1]) for c in casts])
+    cast = cast_index(offsets, z.size)
+    assert (cast == [0, 0, 0, 2, 2]).all()
+
+    weights = [a.weights([c[i] for c in casts])
+               for i, a in enumerate((time, lat, lon))]
+    values = rectilinear_casts(data, (weights[0], depth.weights(z),
+                                      weights[1], weights[2]), cast)
+    for i, (t, y, x, d) in enumerate(casts):
+        if len(d) == 0:
+            continue
+        ans = rectilinear(data, (time.weights([t]), depth.weights(d),
+                                 lat.weights([y]), lon.weights([x])))
+        ans = ans.reshape(-1)
+        result = values[offsets[i]:offsets[i + 1]]
+        assert np.array_equal(np.isnan(result), np.isnan(ans))
+        assert np.allclose(result[~np.isnan(ans)], ans[~np.isnan(ans)])
+
+    with pytest.raises(AssertionError):
+        cast_index([0, 2], 3)
+
+
+def test_regrid_weights():
+    """Regrid is the same as rectilinear() on the target grid
+    """
+    from oceansdb.common import RegridWeights, rectilinear
+
+    rng = np.random.RandomState(0)
+    data = rng.rand(2, 5, 4, 6)
+    data[:, 3:, 1, 2] = np.nan
+    axes = {'time': GridAxis([0, 10]), 'depth': GridAxis([0, 10, 20, 50, 90]),
+            'lat': GridAxis(np.arange(4.)),
+            'lon': GridAxis(np.arange(0, 360, 60.), period=360)}
+    lat, lon, depth = [0.3, 1.5, 2.9, 5], [30, 310, 350], [5, 60, 200]
+
+    w = RegridWeights(axes, lat, lon, depth)
+    assert w.matches(axes)
+    t = axes['time'].weights([2.5, 10])
+    values = w.apply(data[:, w.zn, w.yn, w.xn], t)
+    assert values.shape == (2, 3, 4, 3)
+    ans = rectilinear(data, (t, axes['depth'].weights(depth),
+                             axes['lat'].weights(lat),
+                             axes['lon'].weights(lon)))
+    assert np.array_equal(values, ans, equal_nan=True)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+"""
+
+import os
+import hashlib
+
+import oceansdb
+from oceansdb.utils import catalog
+
+
+def test_catalog():
+    cfg = oceansdb.catalog()
+    for db in ['WOA13', 'WOA18', 'CARS', 'ETOPO']:
+        assert db in cfg
+
+    # Parsed only once
+    assert catalog() is cfg
+
+    cfg2 = catalog(reload=True)
+    assert cfg2 is not cfg
+    assert cfg2 == cfg
+    assert catalog() is cfg2
+
+
+def test_manifest(tmpdir):
+    from oceansdb.utils import md5sum, load_manifest, save_manifest
+    from oceansdb.utils import is_verified
+
+    dbpath = str(tmpdir)
+    assert load_manifest(dbpath) == {}
+
+    datafile = tmpdir.join('sample.nc')
+    datafile.write('some content')
+    st = os.stat(str(datafile))
+    entry = {'size': st.st_size, 'mtime': st.st_mtime,
+             'md5': md5sum(str(datafile))}
+    assert entry['md5'] == hashlib.md5(b'some content').hexdigest()
+
+    assert save_manifest({'sample.nc': entry}, dbpath)
+    # Readable by others, as the data files
+    umask = os.umask(0)
+    os.umask(umask)
+    mode = os.stat(str(tmpdir.join('manifest.json'))).st_mode & 0o777
+    assert mode == 0o666 & ~umask
+    manifest = load_manifest(dbpath)
+    assert manifest == {'sample.nc': entry}
+    assert is_verified(str(datafile), manifest)
+
+    # A modified file is not verified anymore
+    datafile.write('some other content')
+    assert not is_verified(str(datafile), manifest)
+    assert not is_verified(str(tmpdir.join('missing.nc')), manifest)
+
+    # Best effort, it is not required
+    assert not save_manifest({'sample.nc': entry},
+                             str(tmpdir.join('missing')))
+
+
+def test_check_file(tmpdir):
+    """Only a file modified since recorded in the manifest is hashed again
+    """
+    import pytest
+    from oceansdb.utils import check_file, verify_file
+
+    dbpath = str(tmpdir)
+    datafile = tmpdir.join('sample.nc')
+    datafile.write('some content')
+    c = {'url': 'http://example.com/sample.nc',
+         'md5hash': hashlib.md5(b'some content').hexdigest()}
+
+    # Never verified, left to 'oceansdb verify'
+    assert check_file(c, {}, dbpath) is None
+    manifest = {'sample.nc': verify_file(c, dbpath)}
+    assert check_file(c, manifest, dbpath) is None
+
+    # Same content, only the mtime changed
+    st = os.stat(str(datafile))
+    os.utime(str(datafile), (st.st_atime, st.st_mtime + 10))
+    entry = check_file(c, manifest, dbpath)
+    assert entry['md5'] == manifest['sample.nc']['md5']
+    assert entry['mtime'] == st.st_mtime + 10
+
+    datafile.write('some other content')
+    with pytest.raises(AssertionError):
+        check_file(c, manifest, dbpath)
+
+
+def test_dataset_pool(tmpdir):
+    from netCDF4 import Dataset
+    from oceansdb.utils import DatasetPool
+
+    filenames = []
+    for i in range(3):
+        filenames.append(str(tmpdir.join('sample_%i.nc' % i)))
+        with Dataset(filenames[-1], 'w') as nc:
+            nc.createDimension('x', 2)
+
+    pool = DatasetPool(max_open=2)
+    nc1 = pool.acquire(filenames[0])
+    nc2 = pool.acquire(filenames[0])
+    assert nc1 is nc2
+    assert pool.refcount(filenames[0]) == 2
+
+    # Released datasets are kept open for later
+    pool.release(filenames[0])
+    pool.release(filenames[0])
+    assert filenames[0] in pool
+    assert nc1.isopen()
+
+    # Datasets in use are never closed, only the least recently used idle
+    nc_b = pool.acquire(filenames[1])
+    nc_c = pool.acquire(filenames[2])
+    assert len(pool) == 2
+    assert filenames[0] not in pool
+    assert not nc1.isopen()
+    assert nc_b.isopen() and nc_c.isopen()
+
+    pool.release(filenames[1])
+    pool.clear()
+    assert len(pool) == 1
+    assert nc_c.isopen()
+
+
+def test_cache(tmpdir):
+    import numpy as np
+    from numpy import ma
+    from netCDF4 import Dataset
+    from oceansdb.utils import write_cache, read_cache, Dataset_flex, pool
+
+    filename = str(tmpdir.join('sample.nc'))
+    values = ma.masked_greater(np.arange(24.).reshape(2, 3, 4), 20)
+    with Dataset(filename, 'w') as nc:
+        nc.createDimension('z', 2)
+        nc.createDimension('y', 3)
+        nc.createDimension('x', 4)
+        nc.createVariable('x', 'f8', ('x',))[:] = np.arange(4)
+        nc.createVariable('v', 'f4', ('z', 'y', 'x'), zlib=True)[:] = values
+        nc.createVariable('n', 'i2', ('z', 'y', 'x'))[:] = values.data
+        # Packed, read as floats
+        packed = nc.createVariable('p', 'i2', ('z', 'y', 'x'))
+        packed.scale_factor = 0.001
+        packed[:] = values.data / 2.3
+
+    assert read_cache(filename) == {}
+    write_cache(filename)
+    cache = read_cache(filename)
+    assert sorted(cache) == ['n', 'p', 'v']
+    assert cache['n'][1] is None
+    assert cache['n'][0].dtype == 'i2'
+    with Dataset(filename) as nc:
+        assert cache['p'][0].dtype == nc.variables['p'][:].dtype
+        assert np.allclose(cache['p'][0], values.data / 2.3, atol=1e-3)
+        assert (cache['p'][0] == nc.variables['p'][:]).all()
+
+    pool.clear()
+    nc = Dataset_flex(filename)
+    assert nc['v'].is_mapped
+    assert nc.nbytes == 0
+    for item in [(slice(None),), (0, slice(None), [3, 0, 1]), (1, 2, 3)]:
+        assert ma.allequal(nc['v'][item], nc.variables['v'][item])
+        assert (ma.getmaskarray(nc['v'][item]) ==
+                ma.getmaskarray(nc.variables['v'][item])).all()
+    nc.close()
+    pool.clear()
+
+    # An outdated cache is ignored
+    with Dataset(filename, 'a') as nc:
+        nc.variables['n'][0, 0, 0] = 5
+    assert read_cache(filename) == {}
+
+
+def test_tile_cache(tmpdir):
+    import numpy as np
+    from numpy import ma
+    from netCDF4 import Dataset
+    from oceansdb.utils import TileCache
+
+    filename = str(tmpdir.join('sample.nc'))
+    with Dataset(filename, 'w') as nc:
+        nc.createDimension('y', 10)
+        nc.createDimension('x', 12)
+        v = nc.createVariable('z', 'f4', ('y', 'x'))
+        v[:] = ma.masked_greater(np.arange(120.).reshape(10, 12), 100)
+
+    with Dataset(filename, 'r') as nc:
+        z = nc.variables['z']
+        tiles = TileCache(tile_size=4)
+        for yn, xn in [(slice(None), slice(None)), (slice(2, 9), [11, 0, 1]),
+                       (slice(8, 10), slice(3, 12))]:
+            assert ma.allequal(tiles.read(z, yn, xn), z[yn, xn])
+            assert (ma.getmaskarray(tiles.read(z, yn, xn)) ==
+                    ma.getmaskarray(z[yn, xn])).all()
+        stats = tiles.stats
+        assert stats['misses'] == len(tiles) == 9
+        assert stats['hits'] > 0
+        assert stats['evictions'] == 0
+
+        # Limited memory, only the last tiles used are kept
+        tiles = TileCache(tile_size=4, max_bytes=2 * 4 * 4 * 5)
+        tiles.read(z, slice(0, 4), slice(None))
+        assert len(tiles) == 2
+        assert tiles.stats['evictions'] == 1
+        tiles.read(z, slice(0, 4), slice(8, 12))
+        assert tiles.stats['hits'] == 1
+
+
+def test_memo_cache():
+    import pickle
+    from datetime import datetime
+    import numpy as np
+    from numpy import ma
+    from oceansdb.utils import MemoCache
+
+    calls = []
+
+    def extract(mode=None, **kwargs):
+        calls.append(kwargs)
+        return {'t_mn': ma.masked_values([kwargs['lat'], 1e20], 1e20)}
+
+    memo = MemoCache(max_entries=2, tolerance=1e-3)
+    t = memo.call('extract', extract, None, {'lat': 17.5, 'lon': -37.5})
+    # Within the tolerance, and a copy
+    t2 = memo.call('extract', extract, None, {'lat': 17.5002, 'lon': -37.5})
+    assert len(calls) == 1
+    assert ma.allequal(t['t_mn'], t2['t_mn'])
+    t2['t_mn'][0] = 0
+    assert memo.call('extract', extract, None,
+                     {'lat': 17.5, 'lon': -37.5})['t_mn'][0] == 17.5
+    memo.call('extract', extract, 'nearest', {'lat': 17.5, 'lon': -37.5})
+    assert len(calls) == 2
+    # Not cached
+    memo.call('extract', extract, None, {'lat': 1, 'doy': datetime.now()})
+    assert len(calls) == 3
+
+    memo.call('extract', extract, None, {'lat': 10, 'lon': -37.5})
+    stats = memo.stats
+    assert stats['hits'] == 2
+    assert stats['misses'] == 3
+    assert stats['entries'] == 2
+    assert stats['evictions'] == 1
+
+    memo = pickle.loads(pickle.dumps(memo))
+    assert len(memo) == 0
+    assert memo.tolerance == 1e-3
+
+
+def test_instrument():
+    import pickle
+    import numpy as np
+    from oceansdb.utils import Instrument, as_instrument, timed_call
+    from oceansdb.utils import timed_stage
+
+    assert as_instrument(None) is None
+    with timed_call(None, 'extract'):
+        with timed_stage(None, 'read') as stage:
+            stage.count(np.zeros(3))
+
+    records = []
+    instrument = as_instrument(records.append)
+    assert isinstance(instrument, Instrument)
+    with timed_stage(instrument, 'dbsource'):
+        pass
+    with timed_call(instrument, 'track'):
+        # Nested calls are part of the outer one
+        with timed_call(instrument, 'extract'):
+            with timed_stage(instrument, 'read') as stage:
+                stage.count(np.zeros((2, 3), dtype='f4'))
+        with timed_stage(instrument, 'interpolate'):
+            pass
+    assert len(records) == 1
+    assert records[0]['method'] == 'track'
+    assert set(records[0]['stages']) == {'read', 'interpolate'}
+    assert records[0]['bytes'] == 24
+    assert records[0]['cells'] == 6
+
+    stats = instrument.stats
+    assert stats['calls'] == {'track': 1}
+    assert set(stats['stages']) == {'dbsource', 'read', 'interpolate'}
+    assert stats['bytes'] == 24
+
+    instrument = pickle.loads(pickle.dumps(instrument))
+    assert instrument.callback is None
+    assert instrument.stats['calls'] == {}
+
+
+def test_stream_track():
+    import itertools
+    import numpy as np
+    from oceansdb.utils import stream_track
+
+    chunks = []
+
+    def track(lat, lon, var=None):
+        chunks.append(lat.size)
+        return {'height': lat + lon}
+
+    def feed():
+        for i in itertools.count():
+            yield (i, 10 * i)
+
+    # Lazy, even if endless, and in order
+    output = stream_track(track, feed(), ('lat', 'lon'), chunk_size=4)
+    values = [o['height'] for o in itertools.islice(output, 6)]
+    assert values == [0, 11, 22, 33, 44, 55]
+    assert chunks == [4, 4]
+
+    records = [{'lat': 1, 'lon': 2}, {'lat': 3, 'lon': 4}]
+    output = list(stream_track(track, records, ('lat', 'lon'), var='height'))
+    assert [o['height'] for o in output] == [3, 7]
+
+
+def test_cached_plan(tmpdir):
+    import pickle
+    import numpy as np
+    from oceansdb.common import GridAxis
+    from oceansdb.utils import cached_plan
+
+    axes = {'depth': GridAxis([0, 10, 20, 50]),
+            'lat': GridAxis(np.arange(-89.5, 90, 1)),
+            'lon': GridAxis(np.arange(-179.5, 180, 1), period=360)}
+    filename = str(tmpdir.join('data.nc'))
+    plan = cached_plan(filename, axes, [0, 15, 60], 17.5, [-37.2, 179.9, 3])
+    assert len(plan) == 3
+    assert len(tmpdir.join('cache').listdir()) == 1
+
+    # Loaded from the cache, and the same after pickling
+    for p in (cached_plan(filename, axes, [0, 15, 60], 17.5,
+                          [-37.2, 179.9, 3]),
+              pickle.loads(pickle.dumps(plan))):
+        assert p.matches(axes)
+        assert (p.xn, p.zn) == (plan.xn, plan.zn)
+        for a, b in zip(p.x + p.z, plan.x + plan.z):
+            assert np.array_equal(a, b)
+    assert len(tmpdir.join('cache').listdir()) == 1
+
+    cached_plan(filename, axes, [0, 15, 60], 17.5, [-37.2, 179.9, 4])
+    assert len(tmpdir.join('cache').listdir()) == 2